@@ -1,25 +1,42 @@
 import os
+import asyncio
+import atexit
+import gzip
 import logging
+import threading
 from datetime import datetime, timedelta
 from pathlib import Path
 from hashlib import sha256
 from uuid import uuid4
 from zipfile import ZipFile, ZIP_DEFLATED
 import re
-from typing import Any, Optional
-from urllib import request as urllib_request
-from urllib import error as urllib_error
+import html
+import queue
+import random
+import signal
+import sqlite3
+import sys
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing, contextmanager
+from contextvars import ContextVar, copy_context
+from functools import partial, wraps
+from typing import Any, Iterator, Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup
-from telegram.ext import Application, MessageHandler, CommandHandler, CallbackQueryHandler, filters, ContextTypes
-import anthropic
-from dateutil import parser
+from telegram.ext import Application, BaseUpdateProcessor, MessageHandler, CommandHandler, CallbackQueryHandler, filters, ContextTypes
 import pytz
 import json
 import traceback
 import time
+import httpx
 from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from tornado import httpserver as tornado_httpserver
+from tornado import web as tornado_web
+
+import log_segments
+import event_store
+import pipeline_blobs
+import raw_message_log
 
 load_dotenv()
 
@@ -34,18 +51,144 @@ logger = logging.getLogger(__name__)
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
 WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+# Bot API alternativa (server locale telegram-bot-api o stand-in dei benchmark).
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', '').strip()
 GOOGLE_SERVICE_ACCOUNT_JSON = os.getenv('GOOGLE_SERVICE_ACCOUNT_JSON')
 GOOGLE_CALENDAR_ID = os.getenv('GOOGLE_CALENDAR_ID', 'primary')
 LOG_DIR = Path(os.getenv('RINVIABOT_LOG_DIR', 'logs'))
 PIPELINE_LOG_PATH = LOG_DIR / 'pipeline' / 'jsonl' / 'pipeline.jsonl'
 TELEGRAM_RAW_LOG_PATH = LOG_DIR / 'telegram' / 'raw' / 'messages.jsonl'
+# Payload voluminosi degli eventi pipeline: un file per contenuto, l'evento tiene solo {'$blob': hash}.
+PIPELINE_BLOB_DIR = LOG_DIR / 'pipeline' / 'blobs'
+PIPELINE_BLOB_FIELDS = {
+    'raw_response',
+    'parsed_data',
+    'previous_parsed_data',
+    'original_message',
+    'followup_text',
+    'normalized_message',
+    'reply_text',
+}
+PIPELINE_BLOB_MIN_BYTES = 200
 CHAT_EXPORT_DIR = Path('exports') / 'chat'
 REMOTE_LOG_ENDPOINT = os.getenv('REMOTE_LOG_ENDPOINT', '').strip()
 REMOTE_LOG_TOKEN = os.getenv('REMOTE_LOG_TOKEN', '').strip()
 ANTHROPIC_MODEL = os.getenv('ANTHROPIC_MODEL', 'claude-3-5-haiku-latest').strip()
-
-# Client Anthropic
-client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY) if ANTHROPIC_API_KEY else None
+# Modelli dal piu' veloce al piu' forte, separati da virgola: si passa al successivo solo se la
+# lettura va confermata o e' incompleta. Vuoto = solo ANTHROPIC_MODEL.
+ANTHROPIC_MODEL_TIERS = os.getenv('RINVIABOT_MODEL_TIERS', '').strip()
+# Cassette: 'record' salva ogni chiamata Claude/Calendar, 'replay' la riproduce con la
+# latenza originale, 'replay_zero' la riproduce subito. Vuoto = chiamate reali.
+CASSETTE_MODE = os.getenv('RINVIABOT_CASSETTE_MODE', '').strip().lower()
+CASSETTE_DIR = Path(os.getenv('RINVIABOT_CASSETTE_DIR', str(LOG_DIR / 'cassettes')))
+# Profiling a campione: frazione di update profilati (0 = disattivo) e intervallo di campionamento.
+PROFILE_SAMPLE_RATE = float(os.getenv('RINVIABOT_PROFILE_SAMPLE_RATE', '0') or 0)
+PROFILE_INTERVAL_MS = float(os.getenv('RINVIABOT_PROFILE_INTERVAL_MS', '5') or 5)
+PROFILE_DIR = LOG_DIR / 'profiles'
+PROFILED_HANDLERS = {'handle_message', 'handle_turni', 'handle_export_chat'}
+# Connessioni in uscita: keep-alive periodici (0 = disattivi) solo nella fascia oraria indicata, ora di Roma.
+OUTBOUND_KEEPALIVE_INTERVAL_S = float(os.getenv('RINVIABOT_KEEPALIVE_INTERVAL_S', '45') or 0)
+OUTBOUND_KEEPALIVE_HOURS = os.getenv('RINVIABOT_KEEPALIVE_HOURS', '7-21').strip()
+GOOGLE_TOKEN_REFRESH_MARGIN_S = 600
+# Connessioni httplib2 verso Calendar condivise tra i thread: una richiesta alla volta per connessione.
+CALENDAR_HTTP_POOL_SIZE = int(os.getenv('RINVIABOT_CALENDAR_POOL_SIZE', '4') or 4)
+ANTHROPIC_BASE_URL = 'https://api.anthropic.com'
+REMOTE_LOG_QUEUE_MAX = 1000
+# Copia SQLite opzionale degli eventi pipeline (schema D1), es. logs/pipeline/events.sqlite3. Vuoto = disattiva.
+EVENT_DB_PATH = os.getenv('RINVIABOT_EVENT_DB', '').strip()
+EVENT_DB_QUEUE_MAX = 10000
+EVENT_DB_BATCH_SIZE = 200
+# Compattazione: i segmenti pipeline piu' vecchi di N giorni diventano un record 'trace_summary'
+# per trace; i dettagli restano in segments/cold/. 0 = disattiva.
+PIPELINE_COMPACT_AFTER_DAYS = int(os.getenv('RINVIABOT_COMPACT_AFTER_DAYS', '30') or 0)
+PIPELINE_COMPACT_INTERVAL_S = 6 * 3600
+PIPELINE_COMPACT_MAX_SEGMENTS = 31
+# Budget giornaliero (USD, giorno UTC) per Claude: superato, il bot passa in modalita' degradata
+# (solo lettura locale sul fast-path, il resto va in coda fino al giorno dopo). 0 = nessun limite.
+CLAUDE_DAILY_BUDGET_USD = float(os.getenv('RINVIABOT_CLAUDE_DAILY_BUDGET_USD', '0') or 0)
+# Prezzi USD per milione di token (input, output, scrittura cache, lettura cache): vince il primo
+# frammento contenuto nel nome del modello. RINVIABOT_CLAUDE_PRICING (JSON, stessa forma) ha la precedenza.
+CLAUDE_PRICING_USD_PER_MTOK = [
+    ('3-5-haiku', (0.80, 4.00, 1.00, 0.08)),
+    ('3-haiku', (0.25, 1.25, 0.30, 0.03)),
+    ('haiku', (1.00, 5.00, 1.25, 0.10)),
+    ('sonnet', (3.00, 15.00, 3.75, 0.30)),
+    ('opus', (15.00, 75.00, 18.75, 1.50)),
+]
+CLAUDE_USAGE_FIELDS = ('input_tokens', 'output_tokens', 'cache_creation_input_tokens', 'cache_read_input_tokens')
+# Eventi pipeline che portano il consumo di una chiamata Claude (anche le risposte scartate dall'hedging).
+CLAUDE_USAGE_STAGES = ('claude_response_received', 'claude_hedge_discarded')
+DEFERRED_UPDATES_PATH = LOG_DIR / 'pipeline' / 'deferred_updates.jsonl'
+# Coda presa in carico dal job: ogni update esce da qui solo dopo essere stato rielaborato.
+DEFERRED_INFLIGHT_PATH = LOG_DIR / 'pipeline' / 'deferred_updates.inflight.jsonl'
+DEFERRED_DRAIN_INTERVAL_S = 900
+# Circuit breaker su Claude: si apre dopo N errori consecutivi (0 = disattivo) o se il p95 delle ultime
+# chiamate supera l'SLO; da aperto vale la modalita' degradata e finito il cooldown passa una sola prova.
+CLAUDE_BREAKER_FAILURES = int(os.getenv('RINVIABOT_BREAKER_FAILURES', '3') or 0)
+CLAUDE_BREAKER_COOLDOWN_S = float(os.getenv('RINVIABOT_BREAKER_COOLDOWN_S', '60') or 60)
+CLAUDE_LATENCY_SLO_MS = float(os.getenv('RINVIABOT_CLAUDE_SLO_MS', '15000') or 0)
+CLAUDE_LATENCY_WINDOW = 50
+CLAUDE_LATENCY_MIN_SAMPLES = 10
+# Hedging: se la chiamata non risponde entro il p95 recente ne parte una seconda identica e vince la
+# prima risposta. Costa token in piu' sulle chiamate lente; mai attivo con le cassette.
+CLAUDE_HEDGE_ENABLED = os.getenv('RINVIABOT_CLAUDE_HEDGE', '').strip().lower() in {'1', 'true', 'on'}
+CLAUDE_HEDGE_MIN_DELAY_S = 0.5
+# Limite adattivo (AIMD) delle chiamate Claude contemporanee, condiviso da letture, riletture e
+# rielaborazioni: sale di 1 per ogni giro di risposte buone, si dimezza a un 429/529 e si ferma per
+# il retry-after indicato. In coda si passa a turno da una chat all'altra.
+CLAUDE_CONCURRENCY_INITIAL = int(os.getenv('RINVIABOT_CLAUDE_CONCURRENCY', '4') or 4)
+CLAUDE_CONCURRENCY_MAX = int(os.getenv('RINVIABOT_CLAUDE_CONCURRENCY_MAX', '16') or 16)
+CLAUDE_RATE_LIMIT_BACKOFF_S = 2.0
+CLAUDE_RETRY_AFTER_MAX_S = 60.0
+# Corsie di priorita' per il limite: prima messaggi e callback dal vivo, poi le maschere, poi il lavoro
+# in background (coda differita, rielaborazioni). Le corsie basse usano al massimo la loro quota del
+# limite, cosi' resta posto per i messaggi dal vivo; chi aspetta oltre N secondi passa comunque avanti.
+CLAUDE_LANES = ('interattiva', 'maschera', 'batch')
+CLAUDE_LANE_SHARE = {'interattiva': 1.0, 'maschera': 0.75, 'batch': 0.5}
+CLAUDE_LANE_MAX_WAIT_S = float(os.getenv('RINVIABOT_LANE_MAX_WAIT_S', '30') or 30)
+HANDLER_LANES = {'handle_mask_start': 'maschera', 'handle_mask_callback': 'maschera'}
+# Update Telegram elaborati in parallelo; quelli dello stesso utente nella stessa chat restano in
+# ordine (chiarimenti e maschere dipendono dal messaggio prima). 1 = uno alla volta come in origine.
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv('RINVIABOT_CONCURRENT_UPDATES', '256') or 1)
+
+# Client Anthropic: anthropic, googleapiclient, google.oauth2 e dateutil vengono importati
+# al primo uso (o dal warm-up dopo l'avvio), per non pagarli a ogni cold start.
+client: Any = None
+_CLIENT_INIT_LOCK = threading.RLock()
+_OUTBOUND_HTTP: Optional[httpx.Client] = None
+
+
+def get_outbound_http() -> httpx.Client:
+    """Pool httpx condiviso da Claude e dal logger remoto, con keep-alive piu' lungo dei ping."""
+    global _OUTBOUND_HTTP
+    if _OUTBOUND_HTTP is None:
+        with _CLIENT_INIT_LOCK:
+            if _OUTBOUND_HTTP is None:
+                _OUTBOUND_HTTP = httpx.Client(
+                    timeout=httpx.Timeout(30.0, connect=5.0),
+                    limits=httpx.Limits(
+                        max_connections=20,
+                        max_keepalive_connections=10,
+                        keepalive_expiry=max(120.0, OUTBOUND_KEEPALIVE_INTERVAL_S * 3),
+                    ),
+                )
+    return _OUTBOUND_HTTP
+
+
+def get_anthropic_client() -> Any:
+    global client
+    if client is None and ANTHROPIC_API_KEY:
+        with _CLIENT_INIT_LOCK:
+            if client is None:
+                import anthropic
+                # Niente retry interni dell'SDK: tentativi e retry-after li gestisce request_claude_message.
+                client = anthropic.Anthropic(
+                    api_key=ANTHROPIC_API_KEY,
+                    http_client=get_outbound_http(),
+                    timeout=anthropic.DEFAULT_TIMEOUT,
+                    max_retries=0,
+                )
+    return client
 
 # Google Calendar scopes
 SCOPES = ['https://www.googleapis.com/auth/calendar']
@@ -216,28 +359,46 @@ def safe_json_value(value: Any) -> Any:
     return str(value)
 
 
-def append_jsonl(path: Path, payload: dict[str, Any]) -> None:
-    ensure_runtime_directories()
-    with path.open('a', encoding='utf-8') as fh:
-        fh.write(json.dumps(safe_json_value(payload), ensure_ascii=False) + '\n')
-
+_JSONL_APPEND_LOCKS: dict[Path, threading.Lock] = {}
+_JSONL_APPEND_LOCKS_GUARD = threading.Lock()
 
-def read_jsonl(path: Path) -> list[dict[str, Any]]:
-    if not path.exists():
-        return []
 
+def append_jsonl(path: Path, payload: dict[str, Any]) -> None:
+    line = json.dumps(safe_json_value(payload), ensure_ascii=False) + '\n'
+    ensure_runtime_directories()
+    with _JSONL_APPEND_LOCKS_GUARD:
+        append_lock = _JSONL_APPEND_LOCKS.setdefault(path, threading.Lock())
+    # Rotazione e append sotto lo stesso lock: nessuna riga finisce in un segmento gia' spostato
+    # (e magari gia' compresso) da un altro thread; il flock copre la rotazione di un altro processo.
+    with append_lock:
+        log_segments.maybe_rotate(path)
+        with log_segments.file_lock(path), path.open('a', encoding='utf-8') as fh:
+            fh.write(line)
+
+
+def read_jsonl(path: Path, since: Optional[str] = None, until: Optional[str] = None) -> list[dict[str, Any]]:
+    """Record di tutti i segmenti del log; con since/until (ts ISO UTC) salta i segmenti e i record fuori intervallo."""
     records: list[dict[str, Any]] = []
-    with path.open('r', encoding='utf-8') as fh:
-        for line in fh:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                payload = json.loads(line)
-            except json.JSONDecodeError:
-                logger.warning(f"Riga JSONL non valida ignorata in {path}")
-                continue
-            if isinstance(payload, dict):
+    for segment in log_segments.segment_files(path, since, until):
+        try:
+            fh = log_segments.open_segment(segment)
+        except FileNotFoundError:
+            continue
+        with fh:
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    payload = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Riga JSONL non valida ignorata in {segment}")
+                    continue
+                if not isinstance(payload, dict):
+                    continue
+                ts = payload.get('ts')
+                if ts and ((since and ts < since) or (until and ts > until)):
+                    continue
                 records.append(payload)
     return records
 
@@ -254,6 +415,8 @@ def sanitize_export_component(value: Any) -> str:
 def format_export_ts(value: Optional[str]) -> str:
     if not value:
         return 'N/A'
+    from dateutil import parser
+
     try:
         dt = parser.isoparse(value)
         if dt.tzinfo is None:
@@ -269,10 +432,28 @@ def sort_key_for_ts(value: Optional[str]) -> tuple[int, str]:
     return (0, value)
 
 
-def build_chat_export(chat_id: Any) -> dict[str, Any]:
+def query_event_db(query: Any, *args: Any) -> Optional[list[dict[str, Any]]]:
+    """Esegue una query di event_store sul database locale; None se disattivo o in errore (si legge il JSONL)."""
+    if not EVENT_DB_PATH:
+        return None
+    try:
+        with closing(event_store.connect(Path(EVENT_DB_PATH))) as conn:
+            return query(conn, *args)
+    except sqlite3.Error as exc:
+        logger.warning(f"Query sul database eventi fallita, uso i JSONL: {exc}")
+        return None
+
+
+def load_chat_pipeline_records(chat_id: str, trace_ids: set[str], since: Optional[str] = None) -> list[dict[str, Any]]:
+    records = query_event_db(event_store.chat_events, chat_id, trace_ids, since)
+    if records is None:
+        records = read_jsonl(PIPELINE_LOG_PATH, since=since)
+    return records
+
+
+def build_chat_export(chat_id: Any, since: Optional[str] = None) -> dict[str, Any]:
     normalized_chat_id = normalize_chat_id(chat_id)
-    raw_records = read_jsonl(TELEGRAM_RAW_LOG_PATH)
-    pipeline_records = read_jsonl(PIPELINE_LOG_PATH)
+    raw_records = read_jsonl(TELEGRAM_RAW_LOG_PATH, since=since)
     conversations: dict[str, dict[str, Any]] = {}
     trace_ids_for_chat: set[str] = set()
 
@@ -292,6 +473,7 @@ def build_chat_export(chat_id: Any) -> dict[str, Any]:
             'user_message': None,
             'replies': [],
             'events': [],
+            'spans': [],
         })
         conversation['started_at'] = min(
             [value for value in (conversation.get('started_at'), record.get('ts')) if value],
@@ -306,6 +488,7 @@ def build_chat_export(chat_id: Any) -> dict[str, Any]:
             'text': record.get('text', ''),
         }
 
+    pipeline_records = load_chat_pipeline_records(normalized_chat_id, trace_ids_for_chat, since)
     for record in pipeline_records:
         trace_id = str(record.get('trace_id') or '')
         if not trace_id:
@@ -325,6 +508,7 @@ def build_chat_export(chat_id: Any) -> dict[str, Any]:
             'user_message': None,
             'replies': [],
             'events': [],
+            'spans': [],
         })
         if record.get('ts') and (
             not conversation.get('started_at') or sort_key_for_ts(record.get('ts')) < sort_key_for_ts(conversation.get('started_at'))
@@ -333,7 +517,7 @@ def build_chat_export(chat_id: Any) -> dict[str, Any]:
         if conversation.get('chat_id') is None and record.get('chat_id') is not None:
             conversation['chat_id'] = record.get('chat_id')
 
-        if record.get('stage') == 'telegram_received' and not conversation.get('user_message'):
+        if record.get('stage') in {'telegram_received', 'trace_summary'} and not conversation.get('user_message'):
             conversation['user_message'] = {
                 'ts': record.get('ts'),
                 'message_id': record.get('message_id'),
@@ -346,9 +530,18 @@ def build_chat_export(chat_id: Any) -> dict[str, Any]:
             conversation['replies'].append({
                 'ts': record.get('ts'),
                 'category': record.get('data', {}).get('reply_category'),
-                'text': record.get('data', {}).get('reply_text', ''),
+                'text': resolve_blob_refs(record.get('data', {}).get('reply_text', '')),
             })
 
+        if record.get('stage') == 'trace_summary':
+            # Trace compattata: le risposte stanno nel riepilogo, i dettagli nei segmenti cold.
+            for reply in record.get('data', {}).get('replies', []):
+                conversation['replies'].append(dict(reply, text=resolve_blob_refs(reply.get('text', ''))))
+
+        if record.get('stage') == 'span_finished':
+            conversation['spans'].append(span_from_record(record))
+            continue
+
         conversation['events'].append({
             'ts': record.get('ts'),
             'stage': record.get('stage'),
@@ -356,7 +549,7 @@ def build_chat_export(chat_id: Any) -> dict[str, Any]:
             'user_id': record.get('user_id'),
             'username': record.get('username'),
             'text': record.get('text'),
-            'data': safe_json_value(record.get('data', {})),
+            'data': safe_json_value(resolve_blob_refs(record.get('data', {}))),
         })
 
     ordered_conversations = sorted(
@@ -367,10 +560,16 @@ def build_chat_export(chat_id: Any) -> dict[str, Any]:
     for conversation in ordered_conversations:
         conversation['replies'].sort(key=lambda item: sort_key_for_ts(item.get('ts')))
         conversation['events'].sort(key=lambda item: sort_key_for_ts(item.get('ts')))
+        conversation['spans'].sort(key=lambda item: item.get('start_mono_ns') or 0)
+        conversation['timings_ms'] = aggregate_span_timings(conversation['spans']) or next(
+            (event['data'].get('durations_ms', {}) for event in conversation['events'] if event.get('stage') == 'trace_summary'),
+            {},
+        )
 
     return {
         'generated_at': utc_now_iso(),
         'chat_id': normalized_chat_id,
+        'since': since,
         'total_conversations': len(ordered_conversations),
         'total_replies': sum(len(item.get('replies', [])) for item in ordered_conversations),
         'conversations': ordered_conversations,
@@ -431,9 +630,264 @@ def render_chat_export_markdown(export_data: dict[str, Any]) -> str:
             )
         lines.append('')
 
+        timings = conversation.get('timings_ms') or {}
+        if timings:
+            lines.extend([
+                '### Tempi per fase',
+                '',
+            ])
+            for name, timing in timings.items():
+                lines.append(
+                    f"- `{name}`: {timing['total_ms']:.1f} ms"
+                    + (f" ({timing['count']} chiamate, max {timing['max_ms']:.1f} ms)" if timing['count'] > 1 else '')
+                )
+            lines.append('')
+
     return '\n'.join(lines).strip() + '\n'
 
 
+def span_from_record(record: dict[str, Any]) -> dict[str, Any]:
+    data = dict(record.get('data') or {})
+    span = {
+        'ts': record.get('ts'),
+        'name': data.pop('span', None),
+        'span_id': data.pop('span_id', None),
+        'parent_span_id': data.pop('parent_span_id', None),
+        'start_mono_ns': data.pop('start_mono_ns', None),
+        'duration_ns': data.pop('duration_ns', None),
+        'duration_ms': data.pop('duration_ms', None),
+        'error': data.pop('error', None),
+    }
+    span['data'] = safe_json_value(data)
+    return span
+
+
+def aggregate_span_timings(spans: list[dict[str, Any]]) -> dict[str, dict[str, Any]]:
+    timings: dict[str, dict[str, Any]] = {}
+    for span in spans:
+        duration_ms = float(span.get('duration_ms') or 0)
+        timing = timings.setdefault(str(span.get('name')), {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        timing['count'] += 1
+        timing['total_ms'] = round(timing['total_ms'] + duration_ms, 3)
+        timing['max_ms'] = max(timing['max_ms'], duration_ms)
+    return timings
+
+
+def load_trace_spans(trace_id: str) -> list[dict[str, Any]]:
+    records = query_event_db(event_store.trace_events, trace_id, 'span_finished')
+    if records is None:
+        records = read_jsonl(PIPELINE_LOG_PATH)
+    spans = [
+        span_from_record(record)
+        for record in records
+        if record.get('trace_id') == trace_id and record.get('stage') == 'span_finished'
+    ]
+    spans.sort(key=lambda item: item.get('start_mono_ns') or 0)
+    return spans
+
+
+def summarize_trace(trace_id: str, records: list[dict[str, Any]]) -> dict[str, Any]:
+    """Un record al posto delle 8-15 righe di una trace: messaggio, esito, eventi creati, risposte, tempi, errori."""
+    records = sorted(records, key=lambda item: sort_key_for_ts(item.get('ts')))
+    identity: dict[str, Any] = {'chat_id': None, 'message_id': None, 'user_id': None, 'username': None}
+    summary: dict[str, Any] = {
+        'started_at': records[0].get('ts'),
+        'finished_at': records[-1].get('ts'),
+        'tipo': None,
+        'confidence': None,
+        'confirmation_required': None,
+        'fast_path': None,
+        'prompt_version': None,
+        'usage': None,
+        'events_created': [],
+        'replies': [],
+        'errors': [],
+        'stages': {},
+        'record_count': len(records),
+    }
+    text = None
+    spans = []
+    formatted: dict[str, Any] = {}
+    for record in records:
+        stage = str(record.get('stage') or '')
+        data = record.get('data') or {}
+        summary['stages'][stage] = summary['stages'].get(stage, 0) + 1
+        for key in identity:
+            if identity[key] is None and record.get(key) is not None:
+                identity[key] = record.get(key)
+        if stage == 'telegram_received' and text is None:
+            text = record.get('text')
+        elif stage == 'parsed_data_normalized':
+            summary['tipo'] = data.get('tipo')
+            summary['confidence'] = data.get('confidence')
+        elif stage == 'confirmation_decision':
+            summary['confirmation_required'] = data.get('confirmation_required')
+            summary['fast_path'] = data.get('fast_path')
+        elif stage in CLAUDE_USAGE_STAGES and isinstance(data.get('usage'), dict):
+            usage = summary['usage'] or {'model': None, 'calls': 0, 'cost_usd': 0.0, **{field: 0 for field in CLAUDE_USAGE_FIELDS}}
+            usage['model'] = data['usage'].get('model') or usage['model']
+            usage['calls'] += 1
+            usage['cost_usd'] = round(usage['cost_usd'] + float(data['usage'].get('cost_usd') or 0), 6)
+            for field in CLAUDE_USAGE_FIELDS:
+                usage[field] += int(data['usage'].get(field) or 0)
+            summary['usage'] = usage
+            if stage == 'claude_response_received':
+                summary['prompt_version'] = data.get('prompt_version')
+        elif stage == 'calendar_event_formatted':
+            formatted = {'title': data.get('title'), 'start': data.get('start')}
+        elif stage in {'calendar_event_created', 'calendar_all_day_event_created', 'mask_event_created'} and data.get('success', True):
+            summary['events_created'].append({
+                'ts': record.get('ts'),
+                'stage': stage,
+                'event_id': data.get('event_id'),
+                'html_link': data.get('html_link'),
+                'title': data.get('title') or formatted.get('title') or (data.get('evento') or {}).get('parte'),
+                'start': data.get('date') or formatted.get('start'),
+            })
+            formatted = {}
+        elif stage == 'telegram_reply_sent':
+            summary['replies'].append({
+                'ts': record.get('ts'),
+                'category': data.get('reply_category'),
+                'text': data.get('reply_text', ''),
+            })
+        elif stage == 'span_finished':
+            spans.append(span_from_record(record))
+        if stage == 'pipeline_failed' or data.get('error'):
+            summary['errors'].append({
+                'ts': record.get('ts'),
+                'stage': stage,
+                'failed_stage': data.get('failed_stage'),
+                'error': data.get('error'),
+            })
+    summary['durations_ms'] = aggregate_span_timings(spans)
+    return {
+        'ts': summary['started_at'],
+        'trace_id': trace_id,
+        'stage': 'trace_summary',
+        **identity,
+        'text': text,
+        'source': 'rinviabot-compaction',
+        'data': summary,
+    }
+
+
+def compact_pipeline_log(path: Path = PIPELINE_LOG_PATH, older_than_days: int = PIPELINE_COMPACT_AFTER_DAYS) -> dict[str, Any]:
+    """Compatta i segmenti chiusi con tutti i record piu' vecchi di older_than_days, i piu' vecchi per primi."""
+    cutoff = (datetime.utcnow() - timedelta(days=older_than_days)).replace(microsecond=0).isoformat() + 'Z'
+    segments = log_segments.load_manifest(path)['segments']
+    candidates = [
+        entry
+        for entry in segments
+        if entry.get('compressed') and not entry.get('compacted') and entry.get('last_ts') and entry['last_ts'] < cutoff
+    ][:PIPELINE_COMPACT_MAX_SEGMENTS]
+    if not candidates:
+        return {'segments': 0, 'lines_in': 0, 'lines_out': 0}
+    # Una trace a cavallo del lotto (rotazione a mezzanotte, limite di segmenti) resta in righe originali:
+    # ogni trace e' un solo trace_summary oppure solo righe originali, mai le due cose insieme.
+    boundary_traces = compaction_boundary_trace_ids(path, segments, candidates)
+
+    traces: dict[str, list[dict[str, Any]]] = {}
+    untraced: list[dict[str, Any]] = []
+    lines_in = 0
+    for entry in candidates:
+        with log_segments.open_segment(log_segments.segment_path(path, entry)) as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if not isinstance(record, dict):
+                    continue
+                lines_in += 1
+                trace_id = str(record.get('trace_id') or '')
+                if trace_id and record.get('stage') != 'trace_summary' and trace_id not in boundary_traces:
+                    traces.setdefault(trace_id, []).append(record)
+                else:
+                    untraced.append(record)
+    records = [summarize_trace(trace_id, items) for trace_id, items in traces.items()] + untraced
+    records.sort(key=lambda item: sort_key_for_ts(item.get('ts')))
+    compacted = log_segments.replace_with_compacted(path, candidates, records)
+    if compacted is None:
+        return {'segments': 0, 'lines_in': 0, 'lines_out': 0}
+    return {'segments': len(candidates), 'lines_in': lines_in, 'lines_out': len(records), 'file': compacted['file']}
+
+
+def compaction_boundary_trace_ids(path: Path, segments: list[dict[str, Any]], candidates: list[dict[str, Any]]) -> set[str]:
+    """trace_id presenti nei segmenti subito prima e subito dopo i candidati (o nel file attivo, se dopo non c'e' altro)."""
+    files = []
+    chosen = {entry['file'] for entry in candidates}
+    for index, entry in enumerate(segments):
+        if entry['file'] not in chosen:
+            continue
+        if index > 0 and segments[index - 1]['file'] not in chosen:
+            files.append(log_segments.segment_path(path, segments[index - 1]))
+        if index + 1 < len(segments):
+            if segments[index + 1]['file'] not in chosen:
+                files.append(log_segments.segment_path(path, segments[index + 1]))
+        else:
+            files.append(path)
+    trace_ids: set[str] = set()
+    for target in files:
+        try:
+            fh = log_segments.open_segment(target)
+        except FileNotFoundError:
+            continue
+        with fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(record, dict) and record.get('trace_id'):
+                    trace_ids.add(str(record['trace_id']))
+    return trace_ids
+
+
+async def compact_pipeline_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        result = await asyncio.to_thread(compact_pipeline_log)
+    except Exception as exc:
+        logger.warning(f"Compattazione log pipeline non riuscita: {exc}")
+        return
+    if result['segments']:
+        logger.info(
+            f"Compattati {result['segments']} segmenti pipeline: {result['lines_in']} righe -> {result['lines_out']}"
+        )
+        metric_inc('rinviabot_pipeline_compacted_lines_total', result['lines_in'] - result['lines_out'])
+
+
+def render_trace_waterfall(trace_id: str, spans: list[dict[str, Any]], width: int = 24) -> str:
+    if not spans:
+        return f"Nessuno span registrato per {trace_id}."
+
+    trace_start = min(span.get('start_mono_ns') or 0 for span in spans)
+    trace_end = max((span.get('start_mono_ns') or 0) + (span.get('duration_ns') or 0) for span in spans)
+    total_ns = max(trace_end - trace_start, 1)
+    known_ids = {span.get('span_id') for span in spans}
+    children: dict[Optional[str], list[dict[str, Any]]] = {}
+    for span in spans:
+        parent_id = span.get('parent_span_id') if span.get('parent_span_id') in known_ids else None
+        children.setdefault(parent_id, []).append(span)
+
+    lines = [f"{trace_id} - {total_ns / 1_000_000:.1f} ms"]
+
+    def walk(parent_id: Optional[str], depth: int) -> None:
+        for span in children.get(parent_id, []):
+            offset = (span.get('start_mono_ns') or 0) - trace_start
+            duration = span.get('duration_ns') or 0
+            bar_start = min(width - 1, int(offset * width / total_ns))
+            bar_length = max(1, int(round(duration * width / total_ns)))
+            bar = ' ' * bar_start + '█' * min(bar_length, width - bar_start)
+            label = ('  ' * depth + str(span.get('name')))[:22]
+            marker = ' !' if span.get('error') else ''
+            lines.append(f"{label:<22} {bar:<{width}} {duration / 1_000_000:>8.1f} ms{marker}")
+            walk(span.get('span_id'), depth + 1)
+
+    walk(None, 0)
+    return '\n'.join(lines)
+
+
 def write_chat_export_files(export_data: dict[str, Any]) -> dict[str, Path]:
     ensure_runtime_directories()
     stamp = datetime.now(ROME_TZ).strftime('%Y%m%d-%H%M%S')
@@ -463,45 +917,204 @@ def hash_text(value: str) -> str:
     return sha256((value or '').encode('utf-8')).hexdigest()
 
 
+_KNOWN_BLOBS: set[str] = set()
+_BLOB_CACHE: dict[str, Any] = {}
+
+
+def blob_path(digest: str) -> Path:
+    return pipeline_blobs.blob_path(PIPELINE_BLOB_DIR, digest)
+
+
+def store_blob(value: Any) -> dict[str, str]:
+    """Scrive il contenuto una sola volta. Per i testi la chiave e' hash_text, come raw_response_hash."""
+    value = safe_json_value(value)
+    if isinstance(value, str):
+        digest = hash_text(value)
+    else:
+        digest = hash_text('json\n' + json.dumps(value, ensure_ascii=False, sort_keys=True))
+    path = blob_path(digest)
+    if digest in _KNOWN_BLOBS or path.exists():
+        metric_inc('rinviabot_pipeline_blobs_total', esito='riusato')
+    else:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp_path.write_text(json.dumps(value, ensure_ascii=False), encoding='utf-8')
+        tmp_path.replace(path)
+        metric_inc('rinviabot_pipeline_blobs_total', esito='scritto')
+    if len(_KNOWN_BLOBS) >= 10_000:
+        _KNOWN_BLOBS.clear()
+    _KNOWN_BLOBS.add(digest)
+    return {'$blob': digest}
+
+
+def externalize_blobs(data: dict[str, Any]) -> dict[str, Any]:
+    stored = {}
+    for key, value in data.items():
+        if key in PIPELINE_BLOB_FIELDS and value:
+            size = len(value) if isinstance(value, str) else len(json.dumps(safe_json_value(value), ensure_ascii=False))
+            if size >= PIPELINE_BLOB_MIN_BYTES:
+                value = store_blob(value)
+        stored[key] = value
+    return stored
+
+
+def load_blob(digest: str) -> Any:
+    if digest in _BLOB_CACHE:
+        return _BLOB_CACHE[digest]
+    try:
+        value = pipeline_blobs.read_blob(PIPELINE_BLOB_DIR, digest)
+    except (OSError, json.JSONDecodeError):
+        logger.warning(f"Blob pipeline mancante o illeggibile: {digest}")
+        return {'$blob': digest}
+    if len(_BLOB_CACHE) >= 512:
+        _BLOB_CACHE.clear()
+    _BLOB_CACHE[digest] = value
+    return value
+
+
+def resolve_blob_refs(value: Any) -> Any:
+    """Sostituisce i riferimenti {'$blob': hash} col contenuto; si chiama solo sui record che servono."""
+    return pipeline_blobs.resolve_blob_refs(value, load_blob)
+
+
 def build_trace_id(update: Optional[Update]) -> str:
     if update and update.effective_chat and update.effective_message:
         return f"tg-{update.effective_chat.id}-{update.effective_message.message_id}"
     return f"tg-{uuid4().hex}"
 
 
-def send_remote_log(payload: dict[str, Any]) -> None:
-    if not REMOTE_LOG_ENDPOINT or not REMOTE_LOG_TOKEN:
+_REMOTE_LOG_QUEUE: queue.Queue = queue.Queue(maxsize=REMOTE_LOG_QUEUE_MAX)
+_REMOTE_LOG_WRITER: Optional[threading.Thread] = None
+_REMOTE_LOG_WRITER_LOCK = threading.Lock()
+
+
+def record_remote_log_failure(payload: dict[str, Any], error: str) -> None:
+    logger.warning(f"Remote logging failed: {error}")
+    try:
+        failure = {
+            'ts': utc_now_iso(),
+            'trace_id': payload.get('trace_id', 'remote-log'),
+            'stage': 'remote_log_failed',
+            'data': {
+                'target': REMOTE_LOG_ENDPOINT,
+                'failed_stage': payload.get('stage'),
+                'error': error,
+            },
+        }
+        append_jsonl(PIPELINE_LOG_PATH, failure)
+        store_local_event(failure)
+    except Exception:
+        pass
+
+
+_EVENT_DB_QUEUE: queue.Queue = queue.Queue(maxsize=EVENT_DB_QUEUE_MAX)
+_EVENT_DB_WRITER: Optional[threading.Thread] = None
+_EVENT_DB_WRITER_LOCK = threading.Lock()
+
+
+def event_db_writer_loop() -> None:
+    """Unico scrittore del database: prende gli eventi in coda a blocchi, una transazione per blocco."""
+    conn = event_store.connect(Path(EVENT_DB_PATH))
+    while True:
+        batch = [_EVENT_DB_QUEUE.get()]
+        while len(batch) < EVENT_DB_BATCH_SIZE:
+            try:
+                batch.append(_EVENT_DB_QUEUE.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            event_store.insert_events(conn, batch)
+        except sqlite3.Error as exc:
+            logger.warning(f"Scrittura sul database eventi fallita ({len(batch)} eventi): {exc}")
+            metric_inc('rinviabot_event_db_dropped_total', len(batch))
+        finally:
+            for _ in batch:
+                _EVENT_DB_QUEUE.task_done()
+
+
+def flush_event_db_writer(timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while _EVENT_DB_QUEUE.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def ensure_event_db_writer() -> None:
+    global _EVENT_DB_WRITER
+    if _EVENT_DB_WRITER is not None:
         return
+    with _EVENT_DB_WRITER_LOCK:
+        if _EVENT_DB_WRITER is None:
+            _EVENT_DB_WRITER = threading.Thread(target=event_db_writer_loop, name='rinviabot-event-db', daemon=True)
+            _EVENT_DB_WRITER.start()
+            atexit.register(flush_event_db_writer)
 
-    req = urllib_request.Request(
-        REMOTE_LOG_ENDPOINT,
-        data=json.dumps(safe_json_value(payload), ensure_ascii=False).encode('utf-8'),
-        headers={
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {REMOTE_LOG_TOKEN}',
-        },
-        method='POST',
-    )
 
+def store_local_event(payload: dict[str, Any]) -> None:
+    """Accoda l'evento per il database locale, se configurato, con i payload inline come in D1."""
+    if not EVENT_DB_PATH:
+        return
+
+    ensure_event_db_writer()
+    try:
+        _EVENT_DB_QUEUE.put_nowait(safe_json_value(payload))
+    except queue.Full:
+        metric_inc('rinviabot_event_db_dropped_total')
+
+
+def post_remote_log(payload: dict[str, Any]) -> None:
     try:
-        with urllib_request.urlopen(req, timeout=2.0) as response:
-            if response.status >= 400:
-                raise RuntimeError(f"Remote log endpoint returned status {response.status}")
+        response = get_outbound_http().post(
+            REMOTE_LOG_ENDPOINT,
+            content=json.dumps(safe_json_value(payload), ensure_ascii=False).encode('utf-8'),
+            headers={
+                'Content-Type': 'application/json',
+                'Authorization': f'Bearer {REMOTE_LOG_TOKEN}',
+            },
+            timeout=2.0,
+        )
+        if response.status_code >= 400:
+            raise RuntimeError(f"Remote log endpoint returned status {response.status_code}")
     except Exception as exc:
-        logger.warning(f"Remote logging failed: {exc}")
+        record_remote_log_failure(payload, str(exc))
+
+
+def remote_log_writer_loop() -> None:
+    while True:
+        payload = _REMOTE_LOG_QUEUE.get()
         try:
-            append_jsonl(PIPELINE_LOG_PATH, {
-                'ts': utc_now_iso(),
-                'trace_id': payload.get('trace_id', 'remote-log'),
-                'stage': 'remote_log_failed',
-                'data': {
-                    'target': REMOTE_LOG_ENDPOINT,
-                    'failed_stage': payload.get('stage'),
-                    'error': str(exc),
-                },
-            })
-        except Exception:
-            pass
+            post_remote_log(payload)
+        finally:
+            _REMOTE_LOG_QUEUE.task_done()
+
+
+def flush_remote_log_writer(timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while _REMOTE_LOG_QUEUE.unfinished_tasks and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+def ensure_remote_log_writer() -> None:
+    global _REMOTE_LOG_WRITER
+    if _REMOTE_LOG_WRITER is not None:
+        return
+    with _REMOTE_LOG_WRITER_LOCK:
+        if _REMOTE_LOG_WRITER is None:
+            _REMOTE_LOG_WRITER = threading.Thread(target=remote_log_writer_loop, name='rinviabot-remote-log', daemon=True)
+            _REMOTE_LOG_WRITER.start()
+            atexit.register(flush_remote_log_writer)
+
+
+def send_remote_log(payload: dict[str, Any]) -> None:
+    """Accoda l'evento per il thread di invio: l'event loop non aspetta mai il logger remoto."""
+    if not REMOTE_LOG_ENDPOINT or not REMOTE_LOG_TOKEN:
+        return
+
+    ensure_remote_log_writer()
+    try:
+        _REMOTE_LOG_QUEUE.put_nowait(payload)
+    except queue.Full:
+        metric_inc('rinviabot_remote_log_dropped_total')
+        record_remote_log_failure(payload, 'coda di invio piena')
 
 
 def log_pipeline_event(
@@ -514,6 +1127,7 @@ def log_pipeline_event(
     username: Any = None,
     text: Optional[str] = None,
     source: str = 'rinviabot-render',
+    remote: bool = True,
     **data: Any,
 ) -> None:
     payload = {
@@ -528,12 +1142,378 @@ def log_pipeline_event(
         'source': source,
         'data': data,
     }
-    append_jsonl(PIPELINE_LOG_PATH, payload)
-    send_remote_log(payload)
+    # In locale i payload voluminosi vanno nel blob store; il logger remoto riceve l'evento completo.
+    append_jsonl(PIPELINE_LOG_PATH, dict(payload, data=externalize_blobs(data)))
+    store_local_event(payload)
+    if remote:
+        send_remote_log(payload)
+
+
+_CURRENT_SPAN: ContextVar[Optional[dict[str, Any]]] = ContextVar('rinviabot_current_span', default=None)
+
+
+def start_span(trace_id: Optional[str], name: str, **data: Any) -> Optional[dict[str, Any]]:
+    if not trace_id:
+        return None
+    parent = _CURRENT_SPAN.get()
+    span = {
+        'trace_id': trace_id,
+        'name': name,
+        'span_id': uuid4().hex[:16],
+        'parent_span_id': parent['span_id'] if parent and parent['trace_id'] == trace_id else None,
+        'start_ns': time.monotonic_ns(),
+        'data': dict(data),
+    }
+    span['token'] = _CURRENT_SPAN.set(span)
+    return span
+
+
+def end_span(span: Optional[dict[str, Any]], *, error: Optional[str] = None, **data: Any) -> None:
+    if not span:
+        return
+    duration_ns = time.monotonic_ns() - span['start_ns']
+    try:
+        _CURRENT_SPAN.reset(span['token'])
+    except ValueError:
+        # Span chiuso in un contesto diverso da quello di apertura: torna al padre.
+        _CURRENT_SPAN.set(None)
+    span['data'].update(data)
+    # Solo JSONL locale: gli span sono tanti e non servono nel logger remoto.
+    log_pipeline_event(
+        'span_finished',
+        span['trace_id'],
+        remote=False,
+        span=span['name'],
+        span_id=span['span_id'],
+        parent_span_id=span['parent_span_id'],
+        start_mono_ns=span['start_ns'],
+        duration_ns=duration_ns,
+        duration_ms=round(duration_ns / 1_000_000, 3),
+        error=error,
+        **span['data'],
+    )
+
+
+@contextmanager
+def pipeline_span(trace_id: Optional[str], name: str, **data: Any) -> Iterator[Optional[dict[str, Any]]]:
+    span = start_span(trace_id, name, **data)
+    error = None
+    try:
+        yield span
+    except Exception as exc:
+        error = str(exc)
+        raise
+    finally:
+        end_span(span, error=error)
+
+
+def instrument_handler(name: str, callback: Any) -> Any:
+    """Avvolge un handler Telegram nello span radice della trace."""
+    @wraps(callback)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Any:
+        started = time.perf_counter()
+        outcome = 'ok'
+        trace_id = build_trace_id(update)
+        sampler = start_stack_sampler() if should_profile_update(name) else None
+        sampler_token = _ACTIVE_SAMPLER.set(sampler)
+        try:
+            # Un update rielaborato da un job resta nella corsia del job.
+            with claude_lane(_CLAUDE_LANE.get() or HANDLER_LANES.get(name, 'interattiva')), pipeline_span(trace_id, name):
+                return await callback(update, context)
+        except Exception:
+            outcome = 'error'
+            raise
+        finally:
+            _ACTIVE_SAMPLER.reset(sampler_token)
+            metric_inc('rinviabot_updates_total', handler=name, outcome=outcome)
+            metric_observe('rinviabot_handler_duration_seconds', time.perf_counter() - started, handler=name)
+            if sampler:
+                write_trace_profile(trace_id, name, stop_stack_sampler(sampler))
+    return wrapper
+
+
+_ACTIVE_SAMPLER: ContextVar[Optional[dict[str, Any]]] = ContextVar('rinviabot_active_sampler', default=None)
+
+
+def run_profiled(func: Any, *args: Any, **kwargs: Any) -> Any:
+    """Esegue func nel thread corrente; se l'update e' profilato, il campionatore segue anche questo thread."""
+    sampler = _ACTIVE_SAMPLER.get()
+    if sampler is None:
+        return func(*args, **kwargs)
+    thread_id = threading.get_ident()
+    sampler['threads'][thread_id] = 'worker'
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sampler['threads'].pop(thread_id, None)
+
+
+# Un pool di thread per corsia, grande quanto il limite massimo di Claude: chi aspetta uno slot
+# aspetta in un thread della propria corsia, e le maschere o la coda differita non occupano mai i
+# thread dei messaggi dal vivo (il default executor di asyncio ne ha pochi e li condivide con tutti).
+_BLOCKING_EXECUTORS: dict[str, ThreadPoolExecutor] = {}
+
+
+def get_blocking_executor(lane: str) -> ThreadPoolExecutor:
+    executor = _BLOCKING_EXECUTORS.get(lane)
+    if executor is None:
+        with _CLIENT_INIT_LOCK:
+            executor = _BLOCKING_EXECUTORS.get(lane)
+            if executor is None:
+                executor = ThreadPoolExecutor(max_workers=CLAUDE_CONCURRENCY_MAX + 4, thread_name_prefix=f'blocking-{lane}')
+                _BLOCKING_EXECUTORS[lane] = executor
+    return executor
+
+
+async def run_blocking(func: Any, *args: Any, **kwargs: Any) -> Any:
+    """Lavoro bloccante di un handler (Claude, Calendar) fuori dall'event loop, nel pool della sua corsia
+    e visibile nel profilo dell'update."""
+    call = partial(copy_context().run, run_profiled, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(get_blocking_executor(current_claude_lane()), call)
+
+
+def should_profile_update(handler_name: str) -> bool:
+    return PROFILE_SAMPLE_RATE > 0 and handler_name in PROFILED_HANDLERS and random.random() < PROFILE_SAMPLE_RATE
+
+
+def start_stack_sampler(interval_ms: Optional[float] = None) -> dict[str, Any]:
+    """Campiona da un thread separato, senza hook di tracing, lo stack del thread chiamante (l'event loop)
+    e dei worker che eseguono il lavoro bloccante dell'update; ogni stack parte da 'thread:<ruolo>'."""
+    sampler = {
+        'threads': {threading.get_ident(): 'event_loop'},
+        'interval_s': max(0.001, (interval_ms or PROFILE_INTERVAL_MS) / 1000),
+        'started_ns': time.monotonic_ns(),
+        'stacks': {},
+        'samples': 0,
+        'stop': threading.Event(),
+    }
+
+    def run() -> None:
+        stacks = sampler['stacks']
+        while not sampler['stop'].wait(sampler['interval_s']):
+            frames = sys._current_frames()
+            for thread_id, role in list(sampler['threads'].items()):
+                frame = frames.get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{Path(code.co_filename).name}:{code.co_name}:{code.co_firstlineno}")
+                    frame = frame.f_back
+                if stack:
+                    key = (f'thread:{role}', *reversed(stack))
+                    stacks[key] = stacks.get(key, 0) + 1
+            sampler['samples'] += 1
+
+    sampler['thread'] = threading.Thread(target=run, name='rinviabot-profiler', daemon=True)
+    sampler['thread'].start()
+    return sampler
+
+
+def stop_stack_sampler(sampler: dict[str, Any]) -> dict[str, Any]:
+    sampler['stop'].set()
+    sampler['thread'].join()
+    self_samples: dict[str, int] = {}
+    total_samples: dict[str, int] = {}
+    for stack, count in sampler['stacks'].items():
+        if not stack:
+            continue
+        self_samples[stack[-1]] = self_samples.get(stack[-1], 0) + count
+        for function in set(stack):
+            total_samples[function] = total_samples.get(function, 0) + count
+    functions = sorted(
+        (
+            {'function': function, 'self_samples': self_samples.get(function, 0), 'total_samples': total}
+            for function, total in total_samples.items()
+        ),
+        key=lambda item: (-item['self_samples'], -item['total_samples'], item['function']),
+    )
+    folded = sorted(sampler['stacks'].items(), key=lambda item: -item[1])
+    return {
+        'interval_ms': round(sampler['interval_s'] * 1000, 3),
+        'duration_ms': round((time.monotonic_ns() - sampler['started_ns']) / 1_000_000, 3),
+        'samples': sampler['samples'],
+        'functions': functions,
+        # Formato "folded" compatibile con flamegraph.pl / speedscope.
+        'folded_stacks': [f"{';'.join(stack)} {count}" for stack, count in folded[:200]],
+    }
+
+
+def write_trace_profile(trace_id: str, handler_name: str, profile: dict[str, Any]) -> None:
+    try:
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        path = PROFILE_DIR / f"{sanitize_export_component(trace_id)}.json"
+        path.write_text(
+            json.dumps({'trace_id': trace_id, 'handler': handler_name, 'ts': utc_now_iso(), **profile}, ensure_ascii=False),
+            encoding='utf-8',
+        )
+    except Exception as exc:
+        logger.warning(f"Impossibile salvare il profilo {trace_id}: {exc}")
+
+
+def aggregate_recent_profiles(window_s: float = 3600.0) -> dict[str, Any]:
+    cutoff = time.time() - window_s
+    self_samples: dict[str, int] = {}
+    total_samples: dict[str, int] = {}
+    profiles = 0
+    samples = 0
+    for path in PROFILE_DIR.glob('*.json') if PROFILE_DIR.exists() else []:
+        try:
+            if path.stat().st_mtime < cutoff:
+                continue
+            profile = json.loads(path.read_text(encoding='utf-8'))
+        except (OSError, json.JSONDecodeError):
+            continue
+        profiles += 1
+        samples += int(profile.get('samples') or 0)
+        for item in profile.get('functions', []):
+            function = item.get('function')
+            self_samples[function] = self_samples.get(function, 0) + int(item.get('self_samples') or 0)
+            total_samples[function] = total_samples.get(function, 0) + int(item.get('total_samples') or 0)
+    return {
+        'profiles': profiles,
+        'samples': samples,
+        'self_samples': self_samples,
+        'total_samples': total_samples,
+    }
+
+
+def render_profile_top(aggregate: dict[str, Any], limit: int = 15) -> str:
+    if not aggregate['profiles']:
+        return "Nessun profilo nell'ultima ora (RINVIABOT_PROFILE_SAMPLE_RATE attivo?)."
+    samples = max(aggregate['samples'], 1)
+    lines = [
+        f"Profili: {aggregate['profiles']} | campioni: {aggregate['samples']}",
+        f"{'self%':>6} {'tot%':>6}  funzione",
+    ]
+    ranked = sorted(aggregate['self_samples'].items(), key=lambda item: (-item[1], item[0]))[:limit]
+    for function, self_count in ranked:
+        total_count = aggregate['total_samples'].get(function, self_count)
+        lines.append(f"{self_count * 100 / samples:>6.1f} {total_count * 100 / samples:>6.1f}  {function}")
+    return '\n'.join(lines)
+
+
+# Metriche in memoria, esposte in formato testo Prometheus su /metrics in modalita' webhook.
+METRIC_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+METRIC_DEFINITIONS = {
+    'rinviabot_updates_total': ('counter', 'Update Telegram gestiti, per handler ed esito.'),
+    'rinviabot_handler_duration_seconds': ('histogram', 'Durata degli handler Telegram.'),
+    'rinviabot_parse_outcome_total': ('counter', 'Esito della lettura dei messaggi, per tipo.'),
+    'rinviabot_claude_request_duration_seconds': ('histogram', 'Latenza delle singole chiamate a Claude, per modello.'),
+    'rinviabot_claude_requests_total': ('counter', 'Chiamate a Claude, per esito.'),
+    'rinviabot_claude_retries_total': ('counter', 'Tentativi ripetuti verso Claude dopo un errore.'),
+    'rinviabot_model_tier_total': ('counter', 'Letture per modello: accettate o scalate al modello successivo.'),
+    'rinviabot_claude_decode_total': ('counter', 'Risposte Claude decodificate, per formato (tool_use o testo) ed esito.'),
+    'rinviabot_claude_tool_input_repairs_total': ('counter', 'Campi facoltativi dello strumento convertiti o scartati invece di rifiutare la lettura, per campo.'),
+    'rinviabot_claude_tokens_total': ('counter', 'Token Claude consumati, per tipo (input, output, cache) e modello.'),
+    'rinviabot_claude_cost_usd_total': ('counter', 'Costo stimato delle chiamate Claude in USD, per modello e prompt_version.'),
+    'rinviabot_claude_spend_today_usd': ('gauge', 'Spesa Claude stimata del giorno UTC corrente.'),
+    'rinviabot_degraded_mode': ('gauge', '1 se il budget giornaliero Claude e\' esaurito e il bot e\' in modalita\' degradata.'),
+    'rinviabot_degraded_messages_total': ('counter', 'Messaggi gestiti in modalita\' degradata, per motivo ed esito (fast_path o in_coda).'),
+    'rinviabot_claude_breaker_state': ('gauge', 'Circuit breaker Claude: 0 chiuso, 1 semiaperto (prova), 2 aperto.'),
+    'rinviabot_claude_breaker_transitions_total': ('counter', 'Cambi di stato del circuit breaker Claude, per stato e motivo.'),
+    'rinviabot_claude_hedges_total': ('counter', 'Richieste Claude duplicate dall\'hedging: lanciate, vinte dalla copia o saltate per il limite.'),
+    'rinviabot_claude_concurrency_limit': ('gauge', 'Limite adattivo corrente delle chiamate Claude contemporanee.'),
+    'rinviabot_claude_in_flight': ('gauge', 'Chiamate Claude in corso.'),
+    'rinviabot_claude_queue_depth': ('gauge', 'Chiamate Claude in attesa di un posto nel limite.'),
+    'rinviabot_claude_queue_wait_seconds': ('histogram', 'Attesa in coda prima di ogni tentativo verso Claude, per corsia.'),
+    'rinviabot_claude_lane_starvation_total': ('counter', 'Chiamate Claude passate avanti per attesa oltre RINVIABOT_LANE_MAX_WAIT_S, per corsia.'),
+    'rinviabot_claude_rate_limited_total': ('counter', 'Risposte 429/529 di Claude, per status.'),
+    'rinviabot_calendar_request_duration_seconds': ('histogram', 'Latenza delle chiamate a Google Calendar.'),
+    'rinviabot_calendar_errors_total': ('counter', 'Errori delle chiamate a Google Calendar, per metodo.'),
+    'rinviabot_cache_requests_total': ('counter', 'Accessi alle cache in memoria, per cache ed esito.'),
+    'rinviabot_pending_clarifications': ('gauge', 'Richieste di chiarimento in attesa di risposta.'),
+    'rinviabot_input_masks': ('gauge', 'Maschere di inserimento aperte.'),
+    'rinviabot_log_writer_queue_depth': ('gauge', 'Eventi in coda per il logger remoto.'),
+    'rinviabot_remote_log_dropped_total': ('counter', 'Eventi scartati perche\' la coda del logger remoto era piena.'),
+    'rinviabot_keepalive_total': ('counter', 'Keep-alive verso gli upstream, per upstream ed esito.'),
+    'rinviabot_google_token_refresh_total': ('counter', 'Rinnovi anticipati del token Google.'),
+    'rinviabot_event_db_queue_depth': ('gauge', 'Eventi in coda per il database SQLite locale.'),
+    'rinviabot_event_db_dropped_total': ('counter', 'Eventi non scritti nel database SQLite locale (coda piena o errore).'),
+    'rinviabot_pipeline_compacted_lines_total': ('counter', 'Righe pipeline eliminate dalla compattazione delle trace vecchie.'),
+    'rinviabot_pipeline_blobs_total': ('counter', 'Payload pipeline salvati nel blob store, scritti o gia\' presenti.'),
+}
+_METRICS_LOCK = threading.Lock()
+_METRIC_COUNTERS: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+_METRIC_HISTOGRAMS: dict[tuple[str, tuple[tuple[str, str], ...]], dict[str, Any]] = {}
+_METRIC_GAUGES: dict[str, Any] = {}
+
+
+def metric_labels(labels: dict[str, Any]) -> tuple[tuple[str, str], ...]:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def metric_inc(name: str, value: float = 1.0, **labels: Any) -> None:
+    key = (name, metric_labels(labels))
+    with _METRICS_LOCK:
+        _METRIC_COUNTERS[key] = _METRIC_COUNTERS.get(key, 0.0) + value
+
+
+def metric_observe(name: str, value: float, **labels: Any) -> None:
+    key = (name, metric_labels(labels))
+    with _METRICS_LOCK:
+        histogram = _METRIC_HISTOGRAMS.setdefault(key, {
+            'buckets': [0] * len(METRIC_LATENCY_BUCKETS),
+            'sum': 0.0,
+            'count': 0,
+        })
+        for index, bound in enumerate(METRIC_LATENCY_BUCKETS):
+            if value <= bound:
+                histogram['buckets'][index] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+def register_metric_gauge(name: str, provider: Any) -> None:
+    """Il provider viene letto a ogni scrape: deve essere veloce e non bloccante."""
+    _METRIC_GAUGES[name] = provider
+
+
+def escape_metric_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_metric_labels(labels: tuple[tuple[str, str], ...], extra: tuple[tuple[str, str], ...] = ()) -> str:
+    items = labels + extra
+    if not items:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_metric_label_value(value)}"' for key, value in items) + '}'
+
+
+def render_metrics() -> str:
+    with _METRICS_LOCK:
+        counters = dict(_METRIC_COUNTERS)
+        histograms = {key: {**value, 'buckets': list(value['buckets'])} for key, value in _METRIC_HISTOGRAMS.items()}
+    gauges: dict[tuple[str, tuple[tuple[str, str], ...]], float] = {}
+    for name, provider in list(_METRIC_GAUGES.items()):
+        try:
+            gauges[(name, ())] = float(provider())
+        except Exception as exc:
+            logger.warning(f"Gauge {name} non disponibile: {exc}")
+
+    lines: list[str] = []
+    for name, (metric_type, help_text) in METRIC_DEFINITIONS.items():
+        lines.extend([f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}'])
+        if metric_type == 'histogram':
+            for (metric_name, labels), histogram in sorted(histograms.items()):
+                if metric_name != name:
+                    continue
+                for bound, bucket_count in zip(METRIC_LATENCY_BUCKETS, histogram['buckets']):
+                    lines.append(f"{name}_bucket{format_metric_labels(labels, (('le', repr(bound)),))} {bucket_count}")
+                lines.append(f"{name}_bucket{format_metric_labels(labels, (('le', '+Inf'),))} {histogram['count']}")
+                lines.append(f"{name}_sum{format_metric_labels(labels)} {histogram['sum']:.6f}")
+                lines.append(f"{name}_count{format_metric_labels(labels)} {histogram['count']}")
+            continue
+        values = counters if metric_type == 'counter' else gauges
+        for (metric_name, labels), value in sorted(values.items()):
+            if metric_name == name:
+                lines.append(f"{name}{format_metric_labels(labels)} {value:g}")
+    return '\n'.join(lines) + '\n'
 
 
 def log_telegram_raw_message(update: Update, trace_id: str, message_text: str) -> None:
-    append_jsonl(TELEGRAM_RAW_LOG_PATH, {
+    # Stesso file del userbot e degli export storici: lock tra processi e un solo record per messaggio.
+    ensure_runtime_directories()
+    raw_message_log.append_messages(TELEGRAM_RAW_LOG_PATH, [safe_json_value({
         'ts': utc_now_iso(),
         'trace_id': trace_id,
         'chat_id': update.effective_chat.id if update.effective_chat else None,
@@ -541,7 +1521,371 @@ def log_telegram_raw_message(update: Update, trace_id: str, message_text: str) -
         'user_id': update.effective_user.id if update.effective_user else None,
         'username': update.effective_user.username if update.effective_user else None,
         'text': message_text,
-    })
+    })])
+
+
+_CASSETTE_LOCK = threading.Lock()
+_CASSETTE_INDEX: Optional[dict[str, dict[Any, list[dict[str, Any]]]]] = None
+
+
+def cassette_replay_enabled() -> bool:
+    return CASSETTE_MODE in {'replay', 'replay_zero'}
+
+
+def cassette_path(trace_id: Optional[str]) -> Path:
+    return CASSETTE_DIR / f"{sanitize_export_component(trace_id or 'no-trace')}.jsonl.gz"
+
+
+def cassette_request_hash(kind: str, request: dict[str, Any]) -> str:
+    return hash_text(kind + '\n' + json.dumps(safe_json_value(request), ensure_ascii=False, sort_keys=True))
+
+
+def record_cassette_entry(
+    kind: str,
+    trace_id: Optional[str],
+    request: dict[str, Any],
+    *,
+    latency_ms: float,
+    response: Any = None,
+    error: Optional[str] = None,
+) -> None:
+    entry = {
+        'ts': utc_now_iso(),
+        'trace_id': trace_id,
+        'kind': kind,
+        'request_hash': cassette_request_hash(kind, request),
+        'request': safe_json_value(request),
+        'response': safe_json_value(response),
+        'error': error,
+        'latency_ms': round(latency_ms, 3),
+    }
+    line = json.dumps(entry, ensure_ascii=False) + '\n'
+    try:
+        with _CASSETTE_LOCK:
+            CASSETTE_DIR.mkdir(parents=True, exist_ok=True)
+            # Ogni append e' un membro gzip indipendente: gzip.open li rilegge in sequenza.
+            with gzip.open(cassette_path(trace_id), 'at', encoding='utf-8') as fh:
+                fh.write(line)
+    except Exception as exc:
+        logger.warning(f"Registrazione cassette fallita: {exc}")
+
+
+def load_cassette_index() -> dict[str, dict[Any, list[dict[str, Any]]]]:
+    global _CASSETTE_INDEX
+    with _CASSETTE_LOCK:
+        if _CASSETTE_INDEX is not None:
+            return _CASSETTE_INDEX
+        by_hash: dict[Any, list[dict[str, Any]]] = {}
+        by_trace: dict[Any, list[dict[str, Any]]] = {}
+        for path in sorted(CASSETTE_DIR.glob('*.jsonl.gz')) if CASSETTE_DIR.exists() else []:
+            try:
+                with gzip.open(path, 'rt', encoding='utf-8') as fh:
+                    for line in fh:
+                        if not line.strip():
+                            continue
+                        entry = json.loads(line)
+                        by_hash.setdefault((entry.get('kind'), entry.get('request_hash')), []).append(entry)
+                        by_trace.setdefault((entry.get('kind'), entry.get('trace_id')), []).append(entry)
+            except (OSError, EOFError, json.JSONDecodeError) as exc:
+                logger.warning(f"Cassette non leggibile ignorata {path}: {exc}")
+        _CASSETTE_INDEX = {'by_hash': by_hash, 'by_trace': by_trace}
+        return _CASSETTE_INDEX
+
+
+def take_cassette_entry(kind: str, trace_id: Optional[str], request: dict[str, Any]) -> dict[str, Any]:
+    """Cerca prima la richiesta identica, poi la prossima chiamata dello stesso tipo nella stessa trace."""
+    index = load_cassette_index()
+    with _CASSETTE_LOCK:
+        candidates = index['by_hash'].get((kind, cassette_request_hash(kind, request)))
+        if not candidates:
+            candidates = index['by_trace'].get((kind, trace_id))
+        if not candidates:
+            raise LookupError(f"Nessuna cassette per {kind} trace_id={trace_id}")
+        entry = candidates[0]
+        for bucket_name, key in (('by_hash', entry.get('request_hash')), ('by_trace', entry.get('trace_id'))):
+            bucket = index[bucket_name].get((kind, key))
+            if bucket:
+                bucket[:] = [item for item in bucket if item is not entry]
+        return entry
+
+
+def call_through_cassette(
+    kind: str,
+    trace_id: Optional[str],
+    request: dict[str, Any],
+    perform: Any,
+    *,
+    encode: Any = safe_json_value,
+    decode: Any = lambda value: value,
+) -> Any:
+    if cassette_replay_enabled():
+        entry = take_cassette_entry(kind, trace_id, request)
+        if CASSETTE_MODE == 'replay':
+            time.sleep(float(entry.get('latency_ms') or 0) / 1000)
+        if entry.get('error'):
+            raise RuntimeError(f"[cassette] {entry['error']}")
+        return decode(entry.get('response'))
+
+    if CASSETTE_MODE != 'record':
+        return perform()
+
+    started = time.perf_counter()
+    try:
+        response = perform()
+    except Exception as exc:
+        record_cassette_entry(kind, trace_id, request, latency_ms=(time.perf_counter() - started) * 1000, error=str(exc))
+        raise
+    record_cassette_entry(kind, trace_id, request, latency_ms=(time.perf_counter() - started) * 1000, response=encode(response))
+    return response
+
+
+def encode_claude_message(message: Any) -> Any:
+    if hasattr(message, 'model_dump'):
+        return message.model_dump(mode='json')
+    return safe_json_value(message)
+
+
+def decode_claude_message(payload: Any) -> Any:
+    import anthropic
+    return anthropic.types.Message.model_validate(payload)
+
+
+def create_claude_message(trace_id: Optional[str], **request: Any) -> Any:
+    started = time.perf_counter()
+    outcome = 'ok'
+    try:
+        return call_through_cassette(
+            'anthropic.messages.create',
+            trace_id,
+            request,
+            lambda: get_anthropic_client().messages.create(**request),
+            encode=encode_claude_message,
+            decode=decode_claude_message,
+        )
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        metric_inc('rinviabot_claude_requests_total', outcome=outcome)
+        metric_observe('rinviabot_claude_request_duration_seconds', time.perf_counter() - started, model=request.get('model'))
+
+
+def claude_pricing() -> list[tuple[str, tuple[float, ...]]]:
+    pricing = list(CLAUDE_PRICING_USD_PER_MTOK)
+    raw = os.getenv('RINVIABOT_CLAUDE_PRICING', '').strip()
+    if raw:
+        try:
+            pricing[:0] = [(str(fragment), tuple(float(price) for price in prices)) for fragment, prices in json.loads(raw).items()]
+        except (ValueError, TypeError, AttributeError) as exc:
+            logger.warning(f"RINVIABOT_CLAUDE_PRICING non valido, uso i prezzi di default: {exc}")
+    return pricing
+
+
+def claude_model_prices(model: str) -> tuple[float, ...]:
+    name = (model or '').lower()
+    for fragment, prices in claude_pricing():
+        if fragment.lower() in name:
+            return prices
+    # Modello sconosciuto: meglio sovrastimare il costo che sforare il budget.
+    return dict(CLAUDE_PRICING_USD_PER_MTOK)['sonnet']
+
+
+def claude_usage(message: Any, model: str) -> dict[str, Any]:
+    """Token e costo di una risposta Claude, da message.usage."""
+    usage = getattr(message, 'usage', None)
+    counts = {field: int(getattr(usage, field, 0) or 0) for field in CLAUDE_USAGE_FIELDS}
+    model = str(getattr(message, 'model', None) or model)
+    prices = claude_model_prices(model)
+    cost = sum(counts[field] * price for field, price in zip(CLAUDE_USAGE_FIELDS, prices)) / 1_000_000
+    return {'model': model, **counts, 'cost_usd': round(cost, 6)}
+
+
+_CLAUDE_SPEND_LOCK = threading.Lock()
+_CLAUDE_SPEND: dict[str, Any] = {'day': None, 'cost_usd': 0.0}
+
+
+def utc_today() -> str:
+    return datetime.utcnow().strftime('%Y-%m-%d')
+
+
+def usage_records(since: Optional[str] = None) -> Iterator[tuple[dict[str, Any], dict[str, Any], Optional[str]]]:
+    """(record, usage, prompt_version) di ogni risposta Claude nei log, trace compattate comprese."""
+    for record in read_jsonl(PIPELINE_LOG_PATH, since=since):
+        data = record.get('data') or {}
+        if (record.get('stage') in CLAUDE_USAGE_STAGES or record.get('stage') == 'trace_summary') and isinstance(data.get('usage'), dict):
+            yield record, data['usage'], data.get('prompt_version')
+
+
+def claude_spend_today() -> float:
+    """Spesa Claude del giorno UTC; al primo uso (o a cambio giorno) si riparte dai log di oggi."""
+    today = utc_today()
+    with _CLAUDE_SPEND_LOCK:
+        if _CLAUDE_SPEND['day'] != today:
+            _CLAUDE_SPEND['day'] = today
+            _CLAUDE_SPEND['cost_usd'] = sum(
+                float(usage.get('cost_usd') or 0)
+                for record, usage, _ in usage_records(since=f'{today}T00:00:00Z')
+                if str(record.get('ts') or '').startswith(today)
+            )
+        return _CLAUDE_SPEND['cost_usd']
+
+
+def claude_budget_exceeded() -> bool:
+    return CLAUDE_DAILY_BUDGET_USD > 0 and claude_spend_today() >= CLAUDE_DAILY_BUDGET_USD
+
+
+def record_claude_usage(usage: dict[str, Any], prompt_version: str) -> None:
+    claude_spend_today()
+    with _CLAUDE_SPEND_LOCK:
+        _CLAUDE_SPEND['cost_usd'] += usage['cost_usd']
+    for field in CLAUDE_USAGE_FIELDS:
+        if usage[field]:
+            metric_inc('rinviabot_claude_tokens_total', usage[field], kind=field, model=usage['model'])
+    metric_inc('rinviabot_claude_cost_usd_total', usage['cost_usd'], model=usage['model'], prompt_version=prompt_version)
+
+
+def trace_chat_id(trace_id: str) -> Optional[str]:
+    match = re.match(r'^tg-(-?\d+)-\d+$', trace_id or '')
+    return match.group(1) if match else None
+
+
+def aggregate_claude_costs(days: int = 7, chat_id: Optional[str] = None) -> dict[str, Any]:
+    """Token e costi degli ultimi N giorni UTC (oggi compreso), per giorno, chat, prompt_version e modello;
+    con chat_id solo quelli di quella chat."""
+    since = (datetime.utcnow() - timedelta(days=days - 1)).strftime('%Y-%m-%dT00:00:00Z')
+    totals: dict[str, dict[str, dict[str, Any]]] = {'giorno': {}, 'chat': {}, 'prompt_version': {}, 'modello': {}}
+    for record, usage, prompt_version in usage_records(since=since):
+        ts = str(record.get('ts') or '')
+        if ts < since:
+            continue
+        record_chat_id = record.get('chat_id') or trace_chat_id(str(record.get('trace_id') or ''))
+        if chat_id is not None and str(record_chat_id) != chat_id:
+            continue
+        keys = {
+            'giorno': ts[:10],
+            'chat': str(record_chat_id or '?'),
+            'prompt_version': str(prompt_version or '?'),
+            'modello': str(usage.get('model') or '?'),
+        }
+        for dimension, key in keys.items():
+            bucket = totals[dimension].setdefault(key, {'calls': 0, 'cost_usd': 0.0, **{field: 0 for field in CLAUDE_USAGE_FIELDS}})
+            bucket['calls'] += int(usage.get('calls') or 1)
+            bucket['cost_usd'] += float(usage.get('cost_usd') or 0)
+            for field in CLAUDE_USAGE_FIELDS:
+                bucket[field] += int(usage.get(field) or 0)
+    return {'days': days, 'since': since, 'chat_id': chat_id, 'totals': totals}
+
+
+def render_claude_costs(aggregate: dict[str, Any], limit: int = 10) -> str:
+    scope = f" della chat {aggregate['chat_id']}" if aggregate.get('chat_id') else ''
+    lines = [f"Costi Claude{scope} dal {aggregate['since'][:10]} (UTC)"]
+    if aggregate.get('chat_id'):
+        # La spesa del giorno e' di tutto il bot: a una sola chat si mostra solo la modalita'.
+        if CLAUDE_DAILY_BUDGET_USD > 0:
+            lines.append(f"Oggi: modalita' {'DEGRADATA' if claude_budget_exceeded() else 'normale'}")
+    elif CLAUDE_DAILY_BUDGET_USD > 0:
+        state = 'DEGRADATA' if claude_budget_exceeded() else 'normale'
+        lines.append(f"Oggi: ${claude_spend_today():.4f} su ${CLAUDE_DAILY_BUDGET_USD:g} | modalita' {state}")
+    else:
+        lines.append(f"Oggi: ${claude_spend_today():.4f} (nessun budget)")
+    if not aggregate['totals']['giorno']:
+        lines.append('Nessuna chiamata Claude registrata nel periodo.')
+        return '\n'.join(lines)
+    for dimension, buckets in aggregate['totals'].items():
+        ranked = sorted(buckets.items(), reverse=True) if dimension == 'giorno' else sorted(
+            buckets.items(), key=lambda item: (-item[1]['cost_usd'], item[0])
+        )
+        lines.extend(['', f"{dimension:<18} {'chiam.':>6} {'in':>9} {'out':>8} {'cache':>9} {'USD':>9}"])
+        for key, bucket in ranked[:limit]:
+            cache = bucket['cache_creation_input_tokens'] + bucket['cache_read_input_tokens']
+            lines.append(
+                f"{key[:18]:<18} {bucket['calls']:>6} {bucket['input_tokens']:>9} {bucket['output_tokens']:>8} {cache:>9} {bucket['cost_usd']:>9.4f}"
+            )
+    return '\n'.join(lines)
+
+
+def defer_update(update: Update, trace_id: str) -> None:
+    """Modalita' degradata: l'update viene rimesso in elaborazione quando Claude torna disponibile."""
+    DEFERRED_UPDATES_PATH.parent.mkdir(parents=True, exist_ok=True)
+    line = json.dumps({'ts': utc_now_iso(), 'trace_id': trace_id, 'update': update.to_dict()}, ensure_ascii=False)
+    with log_segments.file_lock(DEFERRED_UPDATES_PATH):
+        with DEFERRED_UPDATES_PATH.open('a', encoding='utf-8') as fh:
+            fh.write(line + '\n')
+
+
+def take_deferred_updates() -> list[dict[str, Any]]:
+    """Sposta la coda nel file in corso e la restituisce; prima gli update rimasti da un drain interrotto."""
+    with log_segments.file_lock(DEFERRED_UPDATES_PATH):
+        if DEFERRED_UPDATES_PATH.exists():
+            if DEFERRED_INFLIGHT_PATH.exists():
+                with DEFERRED_INFLIGHT_PATH.open('a', encoding='utf-8') as fh:
+                    fh.write(DEFERRED_UPDATES_PATH.read_text(encoding='utf-8'))
+                DEFERRED_UPDATES_PATH.unlink()
+            else:
+                DEFERRED_UPDATES_PATH.replace(DEFERRED_INFLIGHT_PATH)
+        if not DEFERRED_INFLIGHT_PATH.exists():
+            return []
+        lines = DEFERRED_INFLIGHT_PATH.read_text(encoding='utf-8').splitlines()
+    entries = []
+    for line in lines:
+        try:
+            entries.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return entries
+
+
+def complete_deferred_updates(remaining: list[dict[str, Any]]) -> None:
+    """Riscrive il file in corso con gli update non ancora rielaborati (nessuno: lo cancella)."""
+    with log_segments.file_lock(DEFERRED_UPDATES_PATH):
+        if not remaining:
+            DEFERRED_INFLIGHT_PATH.unlink(missing_ok=True)
+            return
+        tmp_path = DEFERRED_INFLIGHT_PATH.with_name(f"{DEFERRED_INFLIGHT_PATH.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in remaining), encoding='utf-8')
+        tmp_path.replace(DEFERRED_INFLIGHT_PATH)
+
+
+async def drain_deferred_updates_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    # A breaker semiaperto la prova la fa il prossimo messaggio nuovo, non l'intera coda.
+    queued = DEFERRED_UPDATES_PATH.exists() or DEFERRED_INFLIGHT_PATH.exists()
+    if not queued or claude_breaker_state() != 'closed' or await asyncio.to_thread(claude_budget_exceeded):
+        return
+    entries = await asyncio.to_thread(take_deferred_updates)
+    logger.info(f"Claude disponibile: rielaboro {len(entries)} messaggi in coda")
+    with claude_lane('batch'):
+        for index, entry in enumerate(entries):
+            # Se budget o breaker tornano a bloccare a meta', handle_message rimette in coda i successivi.
+            update = Update.de_json(entry['update'], context.bot)
+            log_pipeline_event('deferred_update_replayed', entry.get('trace_id') or build_trace_id(update), queued_at=entry.get('ts'))
+            # Dall'update processor, come gli update dal vivo: resta l'ordine per chat e utente.
+            application = context.application
+            await application.update_processor.process_update(update, application.process_update(update))
+            # Tolto solo adesso: un crash o un redeploy a meta' drain lascia in coda i restanti (e questo).
+            await asyncio.to_thread(complete_deferred_updates, entries[index + 1:])
+
+
+def execute_calendar_request(kind: str, trace_id: Optional[str], service: Any, request: dict[str, Any]) -> Any:
+    method = kind.rsplit('.', 1)[-1]
+    started = time.perf_counter()
+    try:
+        with pipeline_span(trace_id, f'calendar_{method}'):
+            return call_through_cassette(
+                kind,
+                trace_id,
+                request,
+                lambda: run_calendar_request(service, method, request),
+            )
+    except Exception:
+        metric_inc('rinviabot_calendar_errors_total', method=method)
+        raise
+    finally:
+        metric_observe('rinviabot_calendar_request_duration_seconds', time.perf_counter() - started, method=method)
+
+
+def run_calendar_request(service: Any, method: str, request: dict[str, Any]) -> Any:
+    with calendar_http() as authed_http:
+        return getattr(service.events(), method)(**request).execute(http=authed_http)
 
 
 def normalize_whitespace(value: str) -> str:
@@ -682,8 +2026,8 @@ def build_message_analysis(message_text: str) -> dict[str, Any]:
         'date_candidates': dates,
         'time_candidates': times,
         'has_multiple_dates': len(set(dates)) > 1,
-        'has_non_hearing_keywords': [kw for kw in NON_HEARING_KEYWORDS if kw in lowered],
-        'has_hearing_hints': [kw for kw in HEARING_HINTS if kw in lowered],
+        'has_non_hearing_keywords': [kw for kw in sorted(NON_HEARING_KEYWORDS) if kw in lowered],
+        'has_hearing_hints': [kw for kw in sorted(HEARING_HINTS) if kw in lowered],
         'first_token': normalize_whitespace(re.split(r'[:\n, ]', normalized, maxsplit=1)[0]) if normalized else '',
         'reliable_hints': reliable_hints,
     }
@@ -837,7 +2181,7 @@ def extract_reference_segments(message_text: str) -> list[str]:
 def extract_recurring_activities(message_text: str) -> list[str]:
     lowered = normalize_message_text(message_text).lower()
     found: list[str] = []
-    for activity in sorted(RECURRING_ACTIVITIES, key=len, reverse=True):
+    for activity in sorted(RECURRING_ACTIVITIES, key=lambda item: (-len(item), item)):
         if activity in lowered and activity not in found:
             found.append(activity)
     return found
@@ -1213,6 +2557,8 @@ def normalize_event_date(date_value: str) -> Optional[str]:
     if relative:
         return relative
 
+    from dateutil import parser
+
     try:
         dt = parser.parse(raw, dayfirst=True, default=datetime.now(ROME_TZ).replace(hour=9, minute=0, second=0, microsecond=0))
         if dt.year < 100:
@@ -1233,6 +2579,8 @@ def normalize_event_time(time_value: str) -> Optional[str]:
     elif re.fullmatch(r'\d{1,2}\.\d{1,2}', raw):
         raw = raw.replace('.', ':')
 
+    from dateutil import parser
+
     try:
         dt = parser.parse(raw, default=datetime.now(ROME_TZ).replace(hour=9, minute=0, second=0, microsecond=0))
         return dt.strftime('%H:%M')
@@ -1255,6 +2603,75 @@ def infer_tipo_from_text(message_text: str) -> str:
     return 'nota'
 
 
+def build_local_parsed_data(message_text: str) -> dict[str, Any]:
+    """Lettura deterministica costruita solo con gli estrattori locali, senza Claude."""
+    tipo = infer_tipo_from_text(message_text)
+    if tipo != 'rinvio':
+        return {'tipo': tipo, 'messaggio': ''}
+
+    eventi = []
+    for block in split_message_blocks(message_text) or [message_text]:
+        hints = build_message_analysis(block)['reliable_hints']
+        judges = hints.get('known_judges_mentioned') or []
+        locations = hints.get('location_or_office_mentions') or []
+        dates = hints.get('date_candidates') or []
+        times = hints.get('time_candidates') or []
+        eventi.append({
+            'parte': hints.get('possible_party_from_opening') or '',
+            'giudice': judges[0] if judges else '',
+            'luogo': locations[0] if locations else '',
+            'data': dates[0] if dates else '',
+            'ora': times[0] if times else '',
+            'note': '',
+        })
+
+    complete = all(evento['parte'] and evento['data'] and evento['ora'] for evento in eventi)
+    return {
+        'tipo': 'rinvio',
+        'confidence': 0.85 if complete else 0.5,
+        'eventi': eventi,
+        'correzioni': [],
+        'warnings': [] if complete else ['Dati incompleti nella lettura locale'],
+    }
+
+
+def parse_message_degraded(
+    message_text: str,
+    analysis: dict[str, Any],
+    trace_id: Optional[str],
+    reason: str = 'budget',
+) -> dict[str, Any]:
+    """Claude non disponibile (budget esaurito o circuit breaker aperto): vale solo la lettura locale
+    che passa il fast-path, il resto va in coda."""
+    parsed_data = validate_and_normalize_parsed_data(build_local_parsed_data(message_text), analysis['normalized_message'])
+    fast_path = is_confirmation_fast_path(parsed_data) and has_judicial_context(message_text)
+    outcome = 'fast_path' if fast_path else 'in_coda'
+    metric_inc('rinviabot_degraded_messages_total', motivo=reason, esito=outcome)
+    if trace_id:
+        log_pipeline_event(
+            'degraded_mode',
+            trace_id,
+            outcome=outcome,
+            reason=reason,
+            spend_usd=round(claude_spend_today(), 6),
+            budget_usd=CLAUDE_DAILY_BUDGET_USD,
+        )
+    if not fast_path:
+        return {'tipo': 'in_coda', 'motivo': reason}
+    if trace_id:
+        log_pipeline_event(
+            'parsed_data_normalized',
+            trace_id,
+            parsed_data=parsed_data,
+            tipo=parsed_data.get('tipo'),
+            confidence=parsed_data.get('confidence'),
+            warnings=parsed_data.get('warnings', []),
+            degraded=True,
+        )
+        log_pipeline_event('confirmation_decision', trace_id, confirmation_required=False, reason=None, tipo='rinvio', fast_path=True)
+    return parsed_data
+
+
 def validate_and_normalize_parsed_data(parsed_data: dict[str, Any], original_message: str) -> dict[str, Any]:
     tipo = str(parsed_data.get('tipo', '')).strip().lower()
     if tipo not in {'rinvio', 'sentenza', 'riserva', 'trattenuta', 'nota', 'conferma', 'data_passata'}:
@@ -1309,7 +2726,7 @@ def validate_and_normalize_parsed_data(parsed_data: dict[str, Any], original_mes
         luogo = normalize_location_name(luogo_raw, original_message)
         data = normalize_event_date(str(evento.get('data', '')))
         ora = normalize_event_time(str(evento.get('ora', '')))
-        note = normalize_event_notes(str(evento.get('note', '') or original_message), original_message)
+        note = normalize_event_notes(str(evento.get('note', '') or ''), original_message)
 
         if matches_mentioned_lawyer(giudice, original_message):
             giudice = ''
@@ -1384,6 +2801,23 @@ def validate_and_normalize_parsed_data(parsed_data: dict[str, Any], original_mes
     return normalized
 
 
+def is_confirmation_fast_path(parsed_data: dict[str, Any]) -> bool:
+    # Fast-path: se parte+data+ora ci sono, confidence alta e nessun warning
+    # materiale -> crea direttamente senza chiedere conferma.
+    confidence = parsed_data.get('confidence')
+    warnings = parsed_data.get('warnings', [])
+    eventi = parsed_data.get('eventi', [])
+    return bool(
+        parsed_data.get('tipo') == 'rinvio'
+        and isinstance(confidence, (int, float))
+        and confidence >= 0.80
+        and isinstance(eventi, list)
+        and eventi
+        and all(event_has_core_fields(e) for e in eventi)
+        and not any(warning_requires_confirmation(w) for w in (warnings if isinstance(warnings, list) else []))
+    )
+
+
 def should_require_confirmation(parsed_data: dict[str, Any], analysis: dict[str, Any], original_message: str) -> Optional[str]:
     if parsed_data.get('tipo') != 'rinvio':
         return None
@@ -1394,16 +2828,7 @@ def should_require_confirmation(parsed_data: dict[str, Any], analysis: dict[str,
     normalized_message = normalize_message_text(original_message)
     lowered_message = normalized_message.lower()
 
-    # Fast-path: se parte+data+ora ci sono, confidence alta e nessun warning
-    # materiale -> crea direttamente senza chiedere conferma.
-    if (
-        isinstance(confidence, (int, float))
-        and confidence >= 0.80
-        and isinstance(eventi, list)
-        and eventi
-        and all(event_has_core_fields(e) for e in eventi)
-        and not any(warning_requires_confirmation(w) for w in (warnings if isinstance(warnings, list) else []))
-    ):
+    if is_confirmation_fast_path(parsed_data):
         return None
 
     if not has_judicial_context(original_message):
@@ -1445,83 +2870,731 @@ def should_require_confirmation(parsed_data: dict[str, Any], analysis: dict[str,
         if looks_like_lawyer(luogo):
             return "Il luogo sembra in realta' un avvocato o un domiciliatario."
 
-        if re.search(r'collegio\s+pres\.?\s+', lowered_message):
-            if luogo != 'Collegio':
-                return "Ho rilevato un contesto di collegio, ma il luogo non risulta coerente."
-            if not giudice:
-                return "Ho rilevato un collegio con presidente indicato, ma il giudice non e' stato estratto bene."
+        if re.search(r'collegio\s+pres\.?\s+', lowered_message):
+            if luogo != 'Collegio':
+                return "Ho rilevato un contesto di collegio, ma il luogo non risulta coerente."
+            if not giudice:
+                return "Ho rilevato un collegio con presidente indicato, ma il giudice non e' stato estratto bene."
+
+        if re.search(r'\btribunale(?:\s+di)?\s+[A-Za-zÀ-ÿ]+', normalized_message, flags=re.IGNORECASE):
+            if not luogo or not looks_like_location(luogo):
+                return "Nel messaggio compare un tribunale, ma il luogo non e' stato ricostruito in modo coerente."
+
+        if re.search(r"\bcorte\s+d[’']appello\b|\bcorte\s+di\s+appello\b", lowered_message):
+            if not luogo or 'corte' not in luogo.lower():
+                return "Nel messaggio compare una corte d'appello, ma il luogo non e' stato ricostruito correttamente."
+
+        first_candidate = extract_primary_party_candidate(original_message)
+        if first_candidate and giudice.lower() == first_candidate.lower() and (
+            re.search(r'\btribunale\b|\bsez\b|\brg\b|\bprocedimento\b', lowered_message)
+        ):
+            return "Il primo cognome sembra la parte, ma e' finito nel campo giudice."
+
+    return None
+
+
+def build_confirmation_from_events(parsed_data: dict[str, Any], reason: str) -> dict[str, Any]:
+    first_event = {}
+    eventi = parsed_data.get('eventi', [])
+    if isinstance(eventi, list) and eventi:
+        first = eventi[0]
+        if isinstance(first, dict):
+            first_event = first
+
+    return {
+        'tipo': 'conferma',
+        'dubbio': reason,
+        'interpretazione': {
+            'parte': first_event.get('parte', ''),
+            'giudice': first_event.get('giudice', ''),
+            'luogo': first_event.get('luogo', ''),
+            'data': first_event.get('data', ''),
+            'ora': first_event.get('ora', ''),
+        },
+        'eventi': eventi if isinstance(eventi, list) else [],
+        'domanda': 'Confermi questa lettura prima che crei l’evento?'
+    }
+
+_CALENDAR_SERVICE: Any = None
+_CALENDAR_SERVICE_LOCK = threading.Lock()
+# httplib2 non e' thread-safe: ogni richiesta prende in prestito una connessione del pool e la
+# restituisce. Il keep-alive passa da tutte, cosi' anche i thread degli handler trovano connessioni calde.
+_CALENDAR_HTTP_POOL: queue.Queue = queue.Queue()
+_GOOGLE_CREDENTIALS: Any = None
+
+
+@contextmanager
+def calendar_http() -> Iterator[Any]:
+    """Connessione Calendar in prestito; None se il servizio non usa le credenziali del Service Account."""
+    if _GOOGLE_CREDENTIALS is None:
+        yield None
+        return
+    authed_http = _CALENDAR_HTTP_POOL.get()
+    try:
+        yield authed_http
+    finally:
+        _CALENDAR_HTTP_POOL.put(authed_http)
+
+
+def get_google_calendar_service():
+    """Restituisce il servizio Google Calendar, costruito una sola volta per processo."""
+    global _CALENDAR_SERVICE
+    with _CALENDAR_SERVICE_LOCK:
+        if _CALENDAR_SERVICE is not None:
+            metric_inc('rinviabot_cache_requests_total', cache='calendar_service', result='hit')
+            return _CALENDAR_SERVICE
+        metric_inc('rinviabot_cache_requests_total', cache='calendar_service', result='miss')
+        _CALENDAR_SERVICE = build_google_calendar_service()
+        return _CALENDAR_SERVICE
+
+
+def build_google_calendar_service():
+    """Autentica con Service Account e restituisce il servizio Google Calendar"""
+    try:
+        if not GOOGLE_SERVICE_ACCOUNT_JSON:
+            logger.error("GOOGLE_SERVICE_ACCOUNT_JSON non configurato!")
+            return None
+        
+        import google_auth_httplib2
+        from google.oauth2 import service_account
+        from googleapiclient.discovery import build
+        from googleapiclient.http import build_http
+
+        global _GOOGLE_CREDENTIALS
+        service_account_info = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
+        credentials = service_account.Credentials.from_service_account_info(
+            service_account_info,
+            scopes=SCOPES
+        )
+        
+        pool = [google_auth_httplib2.AuthorizedHttp(credentials, http=build_http()) for _ in range(max(1, CALENDAR_HTTP_POOL_SIZE))]
+        service = build('calendar', 'v3', http=pool[0])
+        for authed_http in pool:
+            _CALENDAR_HTTP_POOL.put(authed_http)
+        _GOOGLE_CREDENTIALS = credentials
+        logger.info("✅ Servizio Google Calendar inizializzato")
+        return service
+        
+    except Exception as e:
+        logger.error(f"Errore inizializzazione Google Calendar: {e}")
+        return None
+
+# Risposta compatta di Claude: chiavi corte, warning a codici e niente note (normalize_event_notes
+# le ricostruisce dal messaggio originale). expand_compact_response la riporta alla forma di parsed_data.
+COMPACT_RESPONSE_FORMAT = """Rispondi chiamando lo strumento registra_lettura, con input compatto: chiavi corte, niente note.
+Se è rinvio (c = confidence, e = eventi con p parte, g giudice, l luogo, d data DD/MM/YYYY, o ora HH:MM; campi vuoti omessi):
+{"t":"r","c":0.0,"e":[{"p":"","g":"","l":"","d":"","o":""}],"k":["Refuso>Corretto"],"w":["codice"]}
+k = correzioni fatte (facoltativo), w = codici di warning (facoltativo), solo tra:
+amb_parte, amb_data, amb_ora, piu_parti, piu_date, incompleto, contraddizione, data_passata
+Se non è rinvio (s sentenza, v riserva, x trattenuta, n nota):
+{"t":"s"}
+Se serve conferma (u dubbio, i interpretazione, q domanda, brevi):
+{"t":"c","u":"","i":{"p":"","g":"","d":"","o":""},"q":""}
+Se la data è nel passato (dl data letta, op opzioni):
+{"t":"p","dl":"","op":[{"id":"a","d":""},{"id":"b","d":""}],"q":""}"""
+COMPACT_TIPI = {
+    'r': 'rinvio',
+    's': 'sentenza',
+    'v': 'riserva',
+    'x': 'trattenuta',
+    'n': 'nota',
+    'c': 'conferma',
+    'p': 'data_passata',
+}
+COMPACT_EVENT_KEYS = {'p': 'parte', 'g': 'giudice', 'l': 'luogo', 'd': 'data', 'o': 'ora'}
+# Testo dei codici: warning_requires_confirmation continua a decidere sulle stesse parole.
+COMPACT_WARNINGS = {
+    'amb_parte': 'Parte ambigua',
+    'amb_data': 'Data incerta',
+    'amb_ora': 'Ora incerta',
+    'piu_parti': 'Piu parti nello stesso messaggio',
+    'piu_date': 'Piu date non separabili con certezza',
+    'incompleto': 'Dati incompleti',
+    'contraddizione': 'Indicazioni contraddittorie',
+    'data_passata': 'Data nel passato',
+}
+_COMPACT_EVENT_SCHEMA = {
+    'type': 'object',
+    'properties': {key: {'type': 'string'} for key in COMPACT_EVENT_KEYS},
+}
+# Strumento forzato con tool_choice: la risposta arriva come oggetto gia' strutturato, non come testo.
+CLAUDE_READING_TOOL = {
+    'name': 'registra_lettura',
+    'description': 'Registra la lettura del messaggio nel formato compatto descritto nel prompt.',
+    'input_schema': {
+        'type': 'object',
+        'properties': {
+            't': {'type': 'string', 'enum': list(COMPACT_TIPI)},
+            'c': {'type': 'number', 'minimum': 0, 'maximum': 1},
+            'e': {'type': 'array', 'items': _COMPACT_EVENT_SCHEMA},
+            'k': {'type': 'array', 'items': {'type': 'string'}},
+            'w': {'type': 'array', 'items': {'type': 'string', 'enum': list(COMPACT_WARNINGS)}},
+            'u': {'type': 'string'},
+            'i': _COMPACT_EVENT_SCHEMA,
+            'q': {'type': 'string'},
+            'dl': {'type': 'string'},
+            'op': {
+                'type': 'array',
+                'items': {
+                    'type': 'object',
+                    'properties': {'id': {'type': 'string'}, 'd': {'type': 'string'}},
+                    'required': ['d'],
+                },
+            },
+        },
+        'required': ['t'],
+    },
+}
+# Token di output: base per tipo/confidence/warning e chiamata allo strumento, piu' una quota per evento atteso.
+CLAUDE_MAX_TOKENS_BASE = 200
+CLAUDE_MAX_TOKENS_PER_EVENT = 90
+CLAUDE_MAX_TOKENS_CAP = 1000
+
+
+def expand_compact_response(data: dict[str, Any]) -> dict[str, Any]:
+    """Risposta compatta -> forma di parsed_data; una risposta gia' nel formato esteso passa invariata."""
+    if 'tipo' in data or 't' not in data:
+        return data
+    tipo = COMPACT_TIPI.get(str(data.get('t')).strip().lower(), str(data.get('t')))
+    expanded: dict[str, Any] = {'tipo': tipo}
+    if tipo == 'rinvio':
+        expanded['confidence'] = data.get('c')
+        eventi = data.get('e') or []
+        expanded['eventi'] = [
+            {name: evento.get(key, '') for key, name in COMPACT_EVENT_KEYS.items()} | {'note': ''}
+            for evento in (eventi if isinstance(eventi, list) else [eventi])
+            if isinstance(evento, dict)
+        ]
+        expanded['correzioni'] = [str(item).replace('>', ' -> ') for item in data.get('k') or []]
+        expanded['warnings'] = [COMPACT_WARNINGS.get(str(code), str(code)) for code in data.get('w') or []]
+    elif tipo == 'conferma':
+        interpretazione = data.get('i') if isinstance(data.get('i'), dict) else {}
+        expanded['dubbio'] = data.get('u', '')
+        expanded['interpretazione'] = {name: interpretazione.get(key, '') for key, name in COMPACT_EVENT_KEYS.items() if key in interpretazione}
+        expanded['domanda'] = data.get('q') or 'Va bene così?'
+    elif tipo == 'data_passata':
+        expanded['data_letta'] = data.get('dl', '')
+        expanded['opzioni'] = [
+            {'id': option.get('id'), 'data': option.get('d', option.get('data', ''))}
+            for option in data.get('op') or []
+            if isinstance(option, dict)
+        ]
+        expanded['domanda'] = data.get('q') or 'La data è nel passato. Quale intendevi?'
+    return expanded
+
+
+def schema_errors(value: Any, schema: dict[str, Any], path: str = '$') -> list[str]:
+    """Validazione minima (type, enum, range, properties, required, items) per lo schema dello strumento."""
+    expected = schema.get('type')
+    checks = {
+        'object': lambda item: isinstance(item, dict),
+        'array': lambda item: isinstance(item, list),
+        'string': lambda item: isinstance(item, str),
+        'number': lambda item: isinstance(item, (int, float)) and not isinstance(item, bool),
+    }
+    if expected and not checks[expected](value):
+        return [f'{path}: atteso {expected}']
+    errors = []
+    if 'enum' in schema and value not in schema['enum']:
+        errors.append(f'{path}: valore {value!r} non ammesso')
+    if 'minimum' in schema and value < schema['minimum'] or 'maximum' in schema and value > schema['maximum']:
+        errors.append(f'{path}: {value} fuori intervallo')
+    if expected == 'object':
+        errors.extend(f'{path}.{key}: mancante' for key in schema.get('required', []) if key not in value)
+        for key, item in value.items():
+            if key in schema.get('properties', {}):
+                errors.extend(schema_errors(item, schema['properties'][key], f'{path}.{key}'))
+    if expected == 'array' and 'items' in schema:
+        for index, item in enumerate(value):
+            errors.extend(schema_errors(item, schema['items'], f'{path}[{index}]'))
+    return errors
+
+
+def coerce_tool_string(value: Any) -> Optional[str]:
+    if isinstance(value, str):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    return None
+
+
+def coerce_tool_number(value: Any) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(value.strip().replace(',', '.'))
+        except ValueError:
+            return None
+    return None
+
+
+def repair_tool_input(data: dict[str, Any]) -> dict[str, Any]:
+    """Rigida solo la struttura della lettura (t ed e come lista di oggetti): i campi facoltativi
+    malformati vengono convertiti o scartati, cosi' un warning fuori elenco non costa un'altra lettura."""
+    repaired = dict(data)
+
+    def note(campo: str, correzione: str) -> None:
+        metric_inc('rinviabot_claude_tool_input_repairs_total', campo=campo, correzione=correzione)
+
+    def repair_fields(fields: dict[str, Any], campo: str) -> dict[str, Any]:
+        cleaned = {}
+        for key, value in fields.items():
+            if key in COMPACT_EVENT_KEYS and not isinstance(value, str):
+                value = coerce_tool_string(value)
+                note(f'{campo}.{key}', 'scartato' if value is None else 'convertito')
+                if value is None:
+                    continue
+            cleaned[key] = value
+        return cleaned
+
+    if 'c' in repaired:
+        confidence = coerce_tool_number(repaired['c'])
+        if confidence is None:
+            del repaired['c']
+            note('c', 'scartato')
+        else:
+            confidence = min(1.0, max(0.0, confidence))
+            if confidence != repaired['c'] or not isinstance(repaired['c'], (int, float)):
+                note('c', 'convertito')
+            repaired['c'] = confidence
+    if isinstance(repaired.get('e'), list):
+        repaired['e'] = [repair_fields(evento, 'e') if isinstance(evento, dict) else evento for evento in repaired['e']]
+    for key in ('u', 'q', 'dl'):
+        if key in repaired and not isinstance(repaired[key], str):
+            value = coerce_tool_string(repaired.pop(key))
+            note(key, 'scartato' if value is None else 'convertito')
+            if value is not None:
+                repaired[key] = value
+    if 'i' in repaired:
+        if isinstance(repaired['i'], dict):
+            repaired['i'] = repair_fields(repaired['i'], 'i')
+        else:
+            del repaired['i']
+            note('i', 'scartato')
+    for key in ('k', 'w', 'op'):
+        if key in repaired and not isinstance(repaired[key], list):
+            del repaired[key]
+            note(key, 'scartato')
+    if 'k' in repaired:
+        corrections = [coerce_tool_string(item) for item in repaired['k']]
+        for _ in range(corrections.count(None)):
+            note('k', 'scartato')
+        repaired['k'] = [item for item in corrections if item is not None]
+    if 'w' in repaired:
+        codes = []
+        for code in repaired['w']:
+            normalized = code.strip().lower() if isinstance(code, str) else None
+            if normalized not in COMPACT_WARNINGS:
+                note('w', 'scartato')
+                continue
+            if normalized != code:
+                note('w', 'convertito')
+            codes.append(normalized)
+        repaired['w'] = codes
+    if 'op' in repaired:
+        options = []
+        for option in repaired['op']:
+            date = coerce_tool_string(option.get('d')) if isinstance(option, dict) else None
+            if date is None:
+                note('op', 'scartato')
+                continue
+            cleaned = {'d': date}
+            if coerce_tool_string(option.get('id')) is not None:
+                cleaned['id'] = coerce_tool_string(option['id'])
+            options.append(cleaned)
+        repaired['op'] = options
+    return repaired
+
+
+def read_claude_tool_answer(message: Any) -> tuple[Optional[dict[str, Any]], str]:
+    """Lettura di una risposta Claude e testo da loggare. Con lo strumento l'input e' gia' un oggetto:
+    si correggono i campi facoltativi e si valida contro lo schema; il testo libero (cassette e fixture registrate) passa da extract_json_object."""
+    for block in getattr(message, 'content', None) or []:
+        if getattr(block, 'type', None) == 'tool_use' and getattr(block, 'name', None) == CLAUDE_READING_TOOL['name']:
+            data = getattr(block, 'input', None)
+            raw_text = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+            if isinstance(data, dict):
+                data = repair_tool_input(data)
+            errors = schema_errors(data, CLAUDE_READING_TOOL['input_schema'])
+            if errors:
+                logger.warning(f"Input dello strumento non valido: {'; '.join(errors[:5])}")
+                metric_inc('rinviabot_claude_decode_total', formato='tool_use', esito='non_valido')
+                return None, raw_text
+            metric_inc('rinviabot_claude_decode_total', formato='tool_use', esito='ok')
+            return expand_compact_response(data), raw_text
+    raw_text = ''.join(getattr(block, 'text', '') or '' for block in getattr(message, 'content', None) or []).strip()
+    data = extract_json_object(raw_text)
+    metric_inc('rinviabot_claude_decode_total', formato='testo', esito='ok' if data else 'non_parseabile')
+    return (expand_compact_response(data) if data else None), raw_text
+
+
+def claude_max_tokens(analysis: dict[str, Any]) -> int:
+    """max_tokens in base agli eventi attesi: blocchi del messaggio o date distinte, se di piu'."""
+    expected_events = max(1, analysis.get('block_count') or 0, len(set(analysis.get('date_candidates') or [])))
+    return min(CLAUDE_MAX_TOKENS_CAP, CLAUDE_MAX_TOKENS_BASE + CLAUDE_MAX_TOKENS_PER_EVENT * expected_events)
+
+
+def anthropic_model_tiers() -> list[str]:
+    return [model.strip() for model in ANTHROPIC_MODEL_TIERS.split(',') if model.strip()] or [ANTHROPIC_MODEL]
+
+
+_CLAUDE_LIMITER_COND = threading.Condition()
+_CLAUDE_LIMITER: dict[str, Any] = {'limit': float(CLAUDE_CONCURRENCY_INITIAL), 'in_flight': 0, 'blocked_until': 0.0}
+_CLAUDE_LANE_IN_FLIGHT = {lane: 0 for lane in CLAUDE_LANES}
+# Per corsia, le chat in attesa con la loro fila: serve la prima chat del dict, che poi torna in fondo.
+_CLAUDE_WAITERS: dict[str, dict[str, deque[dict[str, Any]]]] = {lane: {} for lane in CLAUDE_LANES}
+_CLAUDE_LANE: ContextVar[Optional[str]] = ContextVar('rinviabot_claude_lane', default=None)
+
+
+@contextmanager
+def claude_lane(lane: str) -> Iterator[None]:
+    """Corsia delle chiamate Claude fatte qui dentro (anche nei thread di run_blocking e asyncio.to_thread)."""
+    token = _CLAUDE_LANE.set(lane)
+    try:
+        yield
+    finally:
+        _CLAUDE_LANE.reset(token)
+
+
+def current_claude_lane() -> str:
+    # Fuori da un handler Telegram (job, script) il lavoro e' in background.
+    return _CLAUDE_LANE.get() or 'batch'
+
+
+def claude_slot_free(lane: str) -> bool:
+    """Da chiamare con _CLAUDE_LIMITER_COND preso: le corsie basse usano solo la loro quota del limite."""
+    limit = int(_CLAUDE_LIMITER['limit'])
+    return (
+        _CLAUDE_LIMITER['in_flight'] < limit
+        and _CLAUDE_LANE_IN_FLIGHT[lane] < max(1, int(limit * CLAUDE_LANE_SHARE[lane]))
+        and time.monotonic() >= _CLAUDE_LIMITER['blocked_until']
+    )
+
+
+def next_claude_ticket() -> Optional[dict[str, Any]]:
+    """Da chiamare con il lock preso: la prima corsia con posto vince, salvo chi aspetta da troppo."""
+    heads = [
+        next(iter(chats.values()))[0]
+        for lane, chats in _CLAUDE_WAITERS.items()
+        if chats and claude_slot_free(lane)
+    ]
+    if not heads:
+        return None
+    now = time.monotonic()
+    starving = [ticket for ticket in heads if now - ticket['since'] >= CLAUDE_LANE_MAX_WAIT_S]
+    return min(starving, key=lambda ticket: ticket['since']) if starving else heads[0]
+
+
+def try_claude_slot(lane: str) -> bool:
+    """Posto nel limite solo se libero subito e senza nessuno in coda (per le copie dell'hedging)."""
+    with _CLAUDE_LIMITER_COND:
+        if any(_CLAUDE_WAITERS.values()) or not claude_slot_free(lane):
+            return False
+        _CLAUDE_LIMITER['in_flight'] += 1
+        _CLAUDE_LANE_IN_FLIGHT[lane] += 1
+        return True
+
+
+def release_claude_slot(lane: str) -> None:
+    with _CLAUDE_LIMITER_COND:
+        _CLAUDE_LIMITER['in_flight'] -= 1
+        _CLAUDE_LANE_IN_FLIGHT[lane] -= 1
+        _CLAUDE_LIMITER_COND.notify_all()
+
+
+@contextmanager
+def claude_slot(trace_id: Optional[str]) -> Iterator[None]:
+    """Attende un posto nel limite adattivo, per corsia e a turno tra le chat; l'attesa e' lo span 'llm_queue_wait'.
+
+    Nessuna chiamata gia' partita viene interrotta: la priorita' conta solo su chi prende il prossimo posto.
+    """
+    lane = current_claude_lane()
+    chat_key = trace_chat_id(trace_id or '') or '-'
+    ticket = {'since': time.monotonic()}
+    with pipeline_span(trace_id, 'llm_queue_wait', chat_id=chat_key, lane=lane):
+        with _CLAUDE_LIMITER_COND:
+            chats = _CLAUDE_WAITERS[lane]
+            chats.setdefault(chat_key, deque()).append(ticket)
+            while next_claude_ticket() is not ticket:
+                blocked_s = _CLAUDE_LIMITER['blocked_until'] - time.monotonic()
+                _CLAUDE_LIMITER_COND.wait(timeout=blocked_s if blocked_s > 0 else None)
+            waited_s = time.monotonic() - ticket['since']
+            waiters = chats.pop(chat_key)
+            waiters.popleft()
+            if waiters:
+                chats[chat_key] = waiters
+            _CLAUDE_LIMITER['in_flight'] += 1
+            _CLAUDE_LANE_IN_FLIGHT[lane] += 1
+            _CLAUDE_LIMITER_COND.notify_all()
+    metric_observe('rinviabot_claude_queue_wait_seconds', waited_s, lane=lane)
+    if waited_s >= CLAUDE_LANE_MAX_WAIT_S:
+        metric_inc('rinviabot_claude_lane_starvation_total', lane=lane)
+    try:
+        yield
+    finally:
+        release_claude_slot(lane)
+
+
+def record_claude_limiter_success() -> None:
+    with _CLAUDE_LIMITER_COND:
+        limit = _CLAUDE_LIMITER['limit']
+        _CLAUDE_LIMITER['limit'] = min(float(CLAUDE_CONCURRENCY_MAX), limit + 1 / limit)
+        _CLAUDE_LIMITER_COND.notify_all()
+
+
+def record_claude_rate_limit(retry_after_s: float) -> None:
+    now = time.monotonic()
+    with _CLAUDE_LIMITER_COND:
+        # I 429 che arrivano mentre si aspetta gia' il retry-after sono la stessa raffica: un solo dimezzamento.
+        if now >= _CLAUDE_LIMITER['blocked_until']:
+            _CLAUDE_LIMITER['limit'] = max(1.0, _CLAUDE_LIMITER['limit'] / 2)
+            logger.warning(f"Claude rate limit: limite a {int(_CLAUDE_LIMITER['limit'])} chiamate, pausa {retry_after_s:g}s")
+        _CLAUDE_LIMITER['blocked_until'] = max(_CLAUDE_LIMITER['blocked_until'], now + retry_after_s)
+        _CLAUDE_LIMITER_COND.notify_all()
+
+
+def claude_retry_after_s(exc: Exception) -> Optional[float]:
+    """Attesa chiesta da Anthropic con un 429/529 (retry-after-ms o retry-after); None se non e' un limite."""
+    if getattr(exc, 'status_code', None) not in {429, 529}:
+        return None
+    headers = getattr(getattr(exc, 'response', None), 'headers', None) or {}
+    for header, scale in (('retry-after-ms', 0.001), ('retry-after', 1.0)):
+        try:
+            return min(max(float(headers.get(header)) * scale, 0.0), CLAUDE_RETRY_AFTER_MAX_S)
+        except (TypeError, ValueError):
+            continue
+    return CLAUDE_RATE_LIMIT_BACKOFF_S
+
 
-        if re.search(r'\btribunale(?:\s+di)?\s+[A-Za-zÀ-ÿ]+', normalized_message, flags=re.IGNORECASE):
-            if not luogo or not looks_like_location(luogo):
-                return "Nel messaggio compare un tribunale, ma il luogo non e' stato ricostruito in modo coerente."
+CLAUDE_BREAKER_STATES = {'closed': 0, 'half_open': 1, 'open': 2}
+_CLAUDE_BREAKER_LOCK = threading.Lock()
+_CLAUDE_BREAKER: dict[str, Any] = {'state': 'closed', 'failures': 0, 'opened_at': 0.0, 'probe_at': None}
+_CLAUDE_LATENCIES: deque[float] = deque(maxlen=CLAUDE_LATENCY_WINDOW)
+_CLAUDE_HEDGE_EXECUTOR: Optional[ThreadPoolExecutor] = None
 
-        if re.search(r"\bcorte\s+d[’']appello\b|\bcorte\s+di\s+appello\b", lowered_message):
-            if not luogo or 'corte' not in luogo.lower():
-                return "Nel messaggio compare una corte d'appello, ma il luogo non e' stato ricostruito correttamente."
 
-        first_candidate = extract_primary_party_candidate(original_message)
-        if first_candidate and giudice.lower() == first_candidate.lower() and (
-            re.search(r'\btribunale\b|\bsez\b|\brg\b|\bprocedimento\b', lowered_message)
-        ):
-            return "Il primo cognome sembra la parte, ma e' finito nel campo giudice."
+def set_claude_breaker_state(state: str, reason: str) -> None:
+    """Da chiamare con _CLAUDE_BREAKER_LOCK preso: ogni cambio di stato riparte da contatori vuoti."""
+    if _CLAUDE_BREAKER['state'] == state:
+        return
+    logger.warning(f"Circuit breaker Claude: {_CLAUDE_BREAKER['state']} -> {state} ({reason})")
+    _CLAUDE_BREAKER.update(state=state, failures=0, probe_at=None)
+    if state == 'open':
+        _CLAUDE_BREAKER['opened_at'] = time.monotonic()
+    _CLAUDE_LATENCIES.clear()
+    metric_inc('rinviabot_claude_breaker_transitions_total', stato=state, motivo=reason)
 
-    return None
 
+def refresh_claude_breaker() -> str:
+    """Da chiamare con il lock preso: finito il cooldown un breaker aperto diventa semiaperto."""
+    if _CLAUDE_BREAKER['state'] == 'open' and time.monotonic() - _CLAUDE_BREAKER['opened_at'] >= CLAUDE_BREAKER_COOLDOWN_S:
+        set_claude_breaker_state('half_open', 'cooldown')
+    return _CLAUDE_BREAKER['state']
 
-def build_confirmation_from_events(parsed_data: dict[str, Any], reason: str) -> dict[str, Any]:
-    first_event = {}
-    eventi = parsed_data.get('eventi', [])
-    if isinstance(eventi, list) and eventi:
-        first = eventi[0]
-        if isinstance(first, dict):
-            first_event = first
 
-    return {
-        'tipo': 'conferma',
-        'dubbio': reason,
-        'interpretazione': {
-            'parte': first_event.get('parte', ''),
-            'giudice': first_event.get('giudice', ''),
-            'luogo': first_event.get('luogo', ''),
-            'data': first_event.get('data', ''),
-            'ora': first_event.get('ora', ''),
-        },
-        'eventi': eventi if isinstance(eventi, list) else [],
-        'domanda': 'Confermi questa lettura prima che crei l’evento?'
-    }
+def claude_breaker_state() -> str:
+    with _CLAUDE_BREAKER_LOCK:
+        return refresh_claude_breaker()
 
-def get_google_calendar_service():
-    """Autentica con Service Account e restituisce il servizio Google Calendar"""
-    try:
-        if not GOOGLE_SERVICE_ACCOUNT_JSON:
-            logger.error("GOOGLE_SERVICE_ACCOUNT_JSON non configurato!")
-            return None
-        
-        service_account_info = json.loads(GOOGLE_SERVICE_ACCOUNT_JSON)
-        credentials = service_account.Credentials.from_service_account_info(
-            service_account_info,
-            scopes=SCOPES
-        )
-        
-        service = build('calendar', 'v3', credentials=credentials)
-        logger.info("✅ Servizio Google Calendar inizializzato")
-        return service
-        
-    except Exception as e:
-        logger.error(f"Errore inizializzazione Google Calendar: {e}")
+
+def claude_breaker_allows() -> bool:
+    """True se una nuova lettura puo' chiamare Claude; da semiaperto passa una sola prova alla volta."""
+    if CLAUDE_BREAKER_FAILURES <= 0:
+        return True
+    with _CLAUDE_BREAKER_LOCK:
+        state = refresh_claude_breaker()
+        if state != 'half_open':
+            return state == 'closed'
+        now = time.monotonic()
+        # Una prova rimasta appesa (eccezione prima della chiamata) scade con il cooldown.
+        if _CLAUDE_BREAKER['probe_at'] is not None and now - _CLAUDE_BREAKER['probe_at'] < CLAUDE_BREAKER_COOLDOWN_S:
+            return False
+        _CLAUDE_BREAKER['probe_at'] = now
+        return True
+
+
+def recent_claude_p95() -> Optional[float]:
+    """p95 (secondi) delle ultime chiamate riuscite, None se sono poche; da chiamare con il lock preso."""
+    if len(_CLAUDE_LATENCIES) < CLAUDE_LATENCY_MIN_SAMPLES:
+        return None
+    ordered = sorted(_CLAUDE_LATENCIES)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+def record_claude_outcome(latency_s: Optional[float]) -> None:
+    """Esito di un tentativo verso Claude (latency_s None = errore) per breaker e hedging."""
+    with _CLAUDE_BREAKER_LOCK:
+        state = refresh_claude_breaker()
+        if latency_s is None:
+            _CLAUDE_BREAKER['failures'] += 1
+            if CLAUDE_BREAKER_FAILURES > 0 and (state == 'half_open' or _CLAUDE_BREAKER['failures'] >= CLAUDE_BREAKER_FAILURES):
+                set_claude_breaker_state('open', 'errori')
+            return
+        _CLAUDE_BREAKER['failures'] = 0
+        _CLAUDE_LATENCIES.append(latency_s)
+        if CLAUDE_BREAKER_FAILURES <= 0 or state == 'open':
+            return
+        slo_s = CLAUDE_LATENCY_SLO_MS / 1000
+        if state == 'half_open':
+            if slo_s > 0 and latency_s > slo_s:
+                set_claude_breaker_state('open', 'slo')
+            else:
+                set_claude_breaker_state('closed', 'prova_riuscita')
+            return
+        p95 = recent_claude_p95()
+        if slo_s > 0 and p95 is not None and p95 > slo_s:
+            set_claude_breaker_state('open', 'slo')
+
+
+def claude_hedge_delay_s() -> Optional[float]:
+    if not CLAUDE_HEDGE_ENABLED or CASSETTE_MODE:
         return None
+    with _CLAUDE_BREAKER_LOCK:
+        p95 = recent_claude_p95()
+    return None if p95 is None else max(p95, CLAUDE_HEDGE_MIN_DELAY_S)
+
+
+def get_claude_hedge_executor() -> ThreadPoolExecutor:
+    # Primarie e copie contano gia' nel limite, e una risposta scartata puo' finire dopo che il suo
+    # posto e' tornato libero: con 2x il massimo nessuna chiamata aspetta un thread senza essere partita.
+    global _CLAUDE_HEDGE_EXECUTOR
+    if _CLAUDE_HEDGE_EXECUTOR is None:
+        with _CLIENT_INIT_LOCK:
+            if _CLAUDE_HEDGE_EXECUTOR is None:
+                _CLAUDE_HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=2 * CLAUDE_CONCURRENCY_MAX, thread_name_prefix='claude-hedge')
+    return _CLAUDE_HEDGE_EXECUTOR
+
+
+def charge_discarded_claude_message(future: Any, trace_id: Optional[str], model: str) -> None:
+    # La risposta scartata si paga lo stesso: budget del giorno, metriche e log pipeline come le altre,
+    # cosi' dopo un riavvio claude_spend_today e /costi la contano ancora.
+    if not future.cancelled() and future.exception() is None:
+        usage = claude_usage(future.result(), model)
+        record_claude_usage(usage, 'hedge')
+        log_pipeline_event('claude_hedge_discarded', trace_id or 'no-trace', usage=usage, prompt_version='hedge')
+
+
+def create_claude_message_hedged(trace_id: Optional[str], **request: Any) -> Any:
+    """create_claude_message con hedging: oltre il p95 recente parte una copia e vince la prima risposta."""
+    delay = claude_hedge_delay_s()
+    if delay is None:
+        return create_claude_message(trace_id, **request)
+    executor = get_claude_hedge_executor()
+    primary = executor.submit(create_claude_message, trace_id, **request)
+    if wait([primary], timeout=delay).done:
+        return primary.result()
+    lane = current_claude_lane()
+    if not try_claude_slot(lane):
+        # Niente copie se il limite e' pieno: toglierebbero il posto a una chat in coda.
+        metric_inc('rinviabot_claude_hedges_total', esito='saltata')
+        return primary.result()
+    metric_inc('rinviabot_claude_hedges_total', esito='lanciata')
+    if trace_id:
+        log_pipeline_event('claude_hedge_sent', trace_id, model=request.get('model'), delay_ms=round(delay * 1000))
+    hedge = executor.submit(create_claude_message, trace_id, **request)
+    hedge.add_done_callback(lambda future: release_claude_slot(lane))
+    pending = {primary, hedge}
+    error: Optional[BaseException] = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        winners = [future for future in done if future.exception() is None]
+        if not winners:
+            error = next(iter(done)).exception()
+            continue
+        winner = winners[0]
+        if winner is hedge:
+            metric_inc('rinviabot_claude_hedges_total', esito='vinta')
+        for other in [*winners[1:], *pending]:
+            other.add_done_callback(lambda future: charge_discarded_claude_message(future, trace_id, request.get('model') or ''))
+        return winner.result()
+    raise error or RuntimeError("Anthropic API unreachable")
+
+
+def request_claude_message(trace_id: Optional[str], model: str, prompt: str, max_tokens: int = 1000, **span_data: Any) -> Any:
+    """Una chiamata Claude con fino a 3 tentativi, tutti nello span 'llm_call' del modello.
+
+    Ogni tentativo prende un posto nel limite adattivo e alimenta il circuit breaker: se si apre
+    a meta', i tentativi restanti non partono. Dopo un 429/529 l'attesa la impone il limite a tutti.
+    """
+    last_exc: Exception = RuntimeError("Anthropic API unreachable")
+    with pipeline_span(trace_id, 'llm_call', model=model, max_tokens=max_tokens, **span_data):
+        for _attempt in range(3):
+            retry_after = None
+            try:
+                with claude_slot(trace_id):
+                    started = time.perf_counter()
+                    with pipeline_span(trace_id, 'llm_attempt', attempt=_attempt + 1):
+                        message = create_claude_message_hedged(
+                            trace_id,
+                            model=model,
+                            max_tokens=max_tokens,
+                            tools=[CLAUDE_READING_TOOL],
+                            tool_choice={'type': 'tool', 'name': CLAUDE_READING_TOOL['name']},
+                            messages=[
+                                {"role": "user", "content": prompt}
+                            ]
+                        )
+                    record_claude_outcome(time.perf_counter() - started)
+                record_claude_limiter_success()
+                return message
+            except Exception as _exc:
+                last_exc = _exc
+                retry_after = claude_retry_after_s(_exc)
+                if retry_after is None:
+                    record_claude_outcome(None)
+                else:
+                    # Un rate limit non e' un guasto: lo gestisce il limite, non il breaker.
+                    metric_inc('rinviabot_claude_rate_limited_total', status=getattr(_exc, 'status_code', ''))
+                    record_claude_rate_limit(retry_after)
+                logger.warning(f"Anthropic API attempt {_attempt + 1}/3 failed ({model}): {_exc}")
+                if claude_breaker_state() != 'closed':
+                    break
+                if _attempt < 2:
+                    metric_inc('rinviabot_claude_retries_total')
+                    if retry_after is None:
+                        time.sleep(2 ** _attempt)
+    raise last_exc
+
+
+def model_escalation_reason(
+    parsed_data: Optional[dict[str, Any]],
+    confirmation_reason: Optional[str],
+    normalized_message: str,
+) -> Optional[str]:
+    """Perche' la lettura del modello corrente va rifatta con quello successivo; None se e' buona."""
+    if not parsed_data:
+        return 'non_parseabile'
+    tipo = parsed_data.get('tipo')
+    if tipo == 'conferma':
+        return 'conferma_dal_modello'
+    if confirmation_reason:
+        return 'conferma_richiesta'
+    if tipo == 'rinvio' and not all(event_has_core_fields(evento) for evento in parsed_data.get('eventi') or [{}]):
+        return 'campi_mancanti'
+    if tipo != 'rinvio' and infer_tipo_from_text(normalized_message) == 'rinvio' and extract_dates_from_text(normalized_message):
+        return 'tipo_in_dubbio'
+    return None
+
 
 def parse_message_with_ai(message_text: str, trace_id: Optional[str] = None):
     """Usa Claude per interpretare il messaggio mantenendo lettura completa e validazione finale."""
-    if not client:
+    if not get_anthropic_client() and not cassette_replay_enabled():
         logger.error("Client Anthropic non configurato")
         return None
 
     try:
-        analysis = build_message_analysis(message_text)
+        with pipeline_span(trace_id, 'analysis'):
+            analysis = build_message_analysis(message_text)
         normalized_message = analysis['normalized_message']
+        if claude_budget_exceeded():
+            return parse_message_degraded(message_text, analysis, trace_id)
+        if not claude_breaker_allows():
+            return parse_message_degraded(message_text, analysis, trace_id, reason='circuito_aperto')
         today = datetime.now(ROME_TZ)
-        prompt_version = 'v1-intelligent-reader'
+        prompt_version = 'v3-tool-reader'
         prompt = f"""Sei il lettore intelligente dei messaggi di Fabio, avvocato penalista italiano.
 
 Leggi il messaggio in modo completo e naturale: non applicare regole meccaniche se il senso complessivo suggerisce una lettura migliore.
@@ -1546,15 +3619,15 @@ Linee guida:
 - "Tribunale di Civitavecchia" o qualunque "Tribunale di <citta'>" deve sempre diventare luogo, mai giudice.
 - "Corte d'Appello" e varianti devono sempre diventare luogo, mai giudice.
 - "Collegio Pres. Tizio" significa luogo = "Collegio" e giudice = "Tizio".
-- "RG", "R.G.", "RGNR", "RG DIB", "procedimento n." e riferimenti simili non sono mai luogo e vanno nelle note insieme al messaggio originale.
+- "RG", "R.G.", "RGNR", "RG DIB", "procedimento n." e riferimenti simili non sono mai luogo (nelle note li aggiunge il bot).
 - "avv", "avv." e difensori nominati non sono il giudice.
 - Il giudice puo' essere noto oppure dedotto dal contesto; se manca davvero lascialo vuoto invece di inventarlo.
 - Se manca il giudice ma c'e' il tribunale, il tribunale va in luogo.
 - Se mancano giudice o luogo, ma parte, data e ora sono chiari, NON usare "conferma": crea il rinvio lasciando il campo vuoto o usando il luogo di default.
-- Non mettere warning per giudice mancante, luogo mancante/default, refusi corretti o note procedurali conservate.
+- Non mettere warning per giudice mancante, luogo mancante/default o refusi corretti.
 - Usa "conferma" solo se l'incertezza puo' creare un evento nel giorno/ora/parte sbagliati.
 - Se parte, data e ora sono chiari, usa confidence almeno 0.80 anche se mancano giudice, luogo o dettagli accessori.
-- "assenza giudice", "giudice assente" o "assente" indicano un rinvio per assenza del giudice: il nome del giudice resta quello indicato nel testo e l'assenza va nelle note.
+- "assenza giudice", "giudice assente" o "assente" indicano un rinvio per assenza del giudice: il nome del giudice resta quello indicato nel testo.
 - Se ci sono separatori come "----" oppure più date chiaramente distinte, estrai più eventi.
 - Se una data manca dell'anno, inferiscilo in modo sensato.
 - Se un anno esplicito porta nel passato e sembra sospetto, usa "data_passata".
@@ -1562,8 +3635,8 @@ Linee guida:
 - Se hai dubbi reali, usa "conferma" invece di forzare un evento.
 - Usa anche l'analisi tecnica qui sotto come indizio, ma se il significato complessivo del messaggio suggerisce qualcosa di meglio, segui il significato.
 - I "segnali affidabili" sono un pavimento, non una gabbia: usali per non confondere date, ore, avvocati, giudici noti, luoghi e riferimenti di procedimento.
-- Se un nome compare dopo "avv." o nella lista avvocati/difensori, non usarlo come giudice o luogo; mettilo nelle note se utile.
-- Se un giudice noto compare vicino a "assenza giudice", "giudice assente" o "assente", tieni quel giudice nel campo giudice e metti l'assenza nelle note.
+- Se un nome compare dopo "avv." o nella lista avvocati/difensori, non usarlo come giudice o luogo.
+- Se un giudice noto compare vicino a "assenza giudice", "giudice assente" o "assente", tieni quel giudice nel campo giudice.
 - Se il primo candidato parte e' seguito da avvocato, giudice noto, data e ora, in genere il primo candidato resta la parte.
 
 Giudici noti utili:
@@ -1579,43 +3652,7 @@ Casi importanti:
   - il giudice puo' anche mancare del tutto
   - non invertire parte e tribunale
 
-Formato JSON obbligatorio.
-Se è rinvio:
-{{
-  "tipo": "rinvio",
-  "confidence": 0.0,
-  "eventi": [
-    {{
-      "parte": "",
-      "giudice": "",
-      "luogo": "",
-      "data": "DD/MM/YYYY",
-      "ora": "HH:MM",
-      "note": ""
-    }}
-  ],
-  "correzioni": [],
-  "warnings": []
-}}
-
-Se non è rinvio:
-{{"tipo":"sentenza|riserva|trattenuta|nota","messaggio":"..."}}
-
-Se serve conferma:
-{{
-  "tipo":"conferma",
-  "dubbio":"",
-      "interpretazione":{{"parte":"","giudice":"","data":"","ora":""}},
-      "domanda":""
-}}
-
-Se la data è nel passato:
-{{
-  "tipo":"data_passata",
-  "data_letta":"",
-  "opzioni":[{{"id":"a","data":""}},{{"id":"b","data":""}}],
-  "domanda":""
-}}
+{COMPACT_RESPONSE_FORMAT}
 
 Messaggio originale:
 {message_text}
@@ -1629,7 +3666,7 @@ Analisi tecnica preliminare:
 Segnali affidabili estratti localmente:
 {json.dumps(analysis.get('reliable_hints', {}), ensure_ascii=False)}
 
-Rispondi solo con JSON valido."""
+Rispondi solo chiamando lo strumento registra_lettura."""
 
         if trace_id:
             log_pipeline_event(
@@ -1651,36 +3688,80 @@ Rispondi solo con JSON valido."""
                 normalized_message=normalized_message,
             )
 
-        last_exc: Exception = RuntimeError("Anthropic API unreachable")
-        message = None
-        for _attempt in range(3):
+        tiers = anthropic_model_tiers()
+        # Ultima lettura valida (candidate, confirmation_reason, model, tier): se il modello successivo
+        # fallisce o risponde male, resta questa invece di perdere un messaggio gia' letto.
+        last_good: Optional[tuple[dict[str, Any], Optional[str], str, int]] = None
+        escalation_error = None
+        for tier, model in enumerate(tiers):
             try:
-                message = client.messages.create(
-                    model=ANTHROPIC_MODEL,
-                    max_tokens=1000,
-                    messages=[
-                        {"role": "user", "content": prompt}
-                    ]
+                message = request_claude_message(trace_id, model, prompt, max_tokens=claude_max_tokens(analysis), tier=tier)
+            except Exception as exc:
+                if last_good:
+                    escalation_error = str(exc)
+                    break
+                # Il messaggio che fa aprire il breaker non si perde: segue anche lui la modalita' degradata.
+                if claude_breaker_state() == 'closed':
+                    raise
+                return parse_message_degraded(message_text, analysis, trace_id, reason='circuito_aperto')
+            candidate, response_text = read_claude_tool_answer(message)
+            usage = claude_usage(message, model)
+            record_claude_usage(usage, prompt_version)
+            if trace_id:
+                log_pipeline_event(
+                    'claude_response_received',
+                    trace_id,
+                    raw_response=response_text,
+                    raw_response_hash=hash_text(response_text),
+                    prompt_version=prompt_version,
+                    usage=usage,
+                    tier=tier,
                 )
+            confirmation_reason = None
+            if candidate:
+                with pipeline_span(trace_id, 'validation'):
+                    candidate = validate_and_normalize_parsed_data(candidate, normalized_message)
+                    confirmation_reason = should_require_confirmation(candidate, analysis, normalized_message)
+                last_good = (candidate, confirmation_reason, model, tier)
+            elif last_good:
+                escalation_error = 'Risposta AI non parseabile'
                 break
-            except Exception as _exc:
-                last_exc = _exc
-                logger.warning(f"Anthropic API attempt {_attempt + 1}/3 failed: {_exc}")
-                if _attempt < 2:
-                    time.sleep(2 ** _attempt)
-        if message is None:
-            raise last_exc
+            reason = model_escalation_reason(candidate, confirmation_reason, normalized_message)
+            is_last = tier == len(tiers) - 1
+            metric_inc('rinviabot_model_tier_total', model=model, esito='accettato' if reason is None or is_last else 'scalato')
+            if reason is None or is_last or claude_budget_exceeded() or claude_breaker_state() != 'closed':
+                break
+            if trace_id:
+                log_pipeline_event(
+                    'model_escalated',
+                    trace_id,
+                    from_model=model,
+                    to_model=tiers[tier + 1],
+                    tier=tier,
+                    reason=reason,
+                    confirmation_reason=confirmation_reason,
+                )
 
-        response_text = message.content[0].text.strip()
-        if trace_id:
-            log_pipeline_event(
-                'claude_response_received',
-                trace_id,
-                raw_response=response_text,
-                raw_response_hash=hash_text(response_text),
-            )
-        parsed_data = extract_json_object(response_text)
+        if escalation_error and last_good:
+            failed_model, failed_tier = model, tier
+            candidate, confirmation_reason, model, tier = last_good
+            # Era stata scalata perche' dubbia: senza un secondo parere la lettura va confermata.
+            if not confirmation_reason and candidate.get('tipo') != 'conferma':
+                confirmation_reason = "Ho alcuni punti di incertezza che è meglio confermare prima della creazione."
+            logger.warning(f"Modello {failed_model} non disponibile ({escalation_error}): uso la lettura di {model}")
+            if trace_id:
+                log_pipeline_event(
+                    'model_escalation_failed',
+                    trace_id,
+                    failed_model=failed_model,
+                    failed_tier=failed_tier,
+                    error=escalation_error,
+                    fallback_model=model,
+                    fallback_tier=tier,
+                )
+        parsed_data = candidate
         if not parsed_data:
+            metric_inc('rinviabot_parse_outcome_total', tipo='non_parseabile')
             logger.error(f"Risposta AI non parseabile: {response_text}")
             if trace_id:
                 log_pipeline_event(
@@ -1692,8 +3773,6 @@ Rispondi solo con JSON valido."""
                 )
             return None
 
-        parsed_data = validate_and_normalize_parsed_data(parsed_data, normalized_message)
-        confirmation_reason = should_require_confirmation(parsed_data, analysis, normalized_message)
         if trace_id:
             log_pipeline_event(
                 'parsed_data_normalized',
@@ -1702,6 +3781,8 @@ Rispondi solo con JSON valido."""
                 tipo=parsed_data.get('tipo'),
                 confidence=parsed_data.get('confidence'),
                 warnings=parsed_data.get('warnings', []),
+                model=model,
+                tier=tier,
             )
             log_pipeline_event(
                 'confirmation_decision',
@@ -1709,13 +3790,16 @@ Rispondi solo con JSON valido."""
                 confirmation_required=bool(confirmation_reason),
                 reason=confirmation_reason,
                 tipo=parsed_data.get('tipo'),
+                fast_path=is_confirmation_fast_path(parsed_data),
             )
         if confirmation_reason:
             parsed_data = build_confirmation_from_events(parsed_data, confirmation_reason)
+        metric_inc('rinviabot_parse_outcome_total', tipo=parsed_data.get('tipo') or 'sconosciuto')
         logger.info(f"AI parsed data: {parsed_data}")
         return parsed_data
 
     except Exception as e:
+        metric_inc('rinviabot_parse_outcome_total', tipo='errore')
         logger.error(f"Errore parsing AI: {e}")
         if trace_id:
             log_pipeline_event(
@@ -1740,6 +3824,7 @@ def format_calendar_event(evento):
         ora_str = re.sub(r'\s*\(.*?\)\s*', '', ora_str).strip()
         
         datetime_str = f"{data_str} {ora_str}"
+        from dateutil import parser
         dt = parser.parse(datetime_str, dayfirst=True)
         
         tz = pytz.timezone('Europe/Rome')
@@ -1763,8 +3848,8 @@ def format_calendar_event(evento):
 def create_google_calendar_event(event_data, trace_id: Optional[str] = None):
     """Crea evento su Google Calendar"""
     try:
-        service = get_google_calendar_service()
-        if not service:
+        service = None if cassette_replay_enabled() else get_google_calendar_service()
+        if not service and not cassette_replay_enabled():
             logger.error("Servizio Google Calendar non disponibile")
             return None
         
@@ -1799,10 +3884,12 @@ def create_google_calendar_event(event_data, trace_id: Optional[str] = None):
                 description_length=len(event.get('description', '')),
             )
         
-        created_event = service.events().insert(
-            calendarId=GOOGLE_CALENDAR_ID,
-            body=event
-        ).execute()
+        created_event = execute_calendar_request(
+            'calendar.events.insert',
+            trace_id,
+            service,
+            {'calendarId': GOOGLE_CALENDAR_ID, 'body': event},
+        )
         
         logger.info(f"Evento creato: {created_event.get('htmlLink')}")
         if trace_id:
@@ -1832,18 +3919,18 @@ def create_google_calendar_event(event_data, trace_id: Optional[str] = None):
 def create_all_day_calendar_event(title: str, event_date: datetime, trace_id: Optional[str] = None):
     """Crea un evento di tutto il giorno, evitando duplicati con stesso titolo e data."""
     try:
-        service = get_google_calendar_service()
-        if not service:
+        service = None if cassette_replay_enabled() else get_google_calendar_service()
+        if not service and not cassette_replay_enabled():
             return None, 'error'
 
         date_value = event_date.date()
         next_date_value = date_value + timedelta(days=1)
-        existing = service.events().list(
-            calendarId=GOOGLE_CALENDAR_ID,
-            timeMin=f"{date_value.isoformat()}T00:00:00+02:00",
-            timeMax=f"{next_date_value.isoformat()}T00:00:00+02:00",
-            singleEvents=True,
-        ).execute()
+        existing = execute_calendar_request('calendar.events.list', trace_id, service, {
+            'calendarId': GOOGLE_CALENDAR_ID,
+            'timeMin': f"{date_value.isoformat()}T00:00:00+02:00",
+            'timeMax': f"{next_date_value.isoformat()}T00:00:00+02:00",
+            'singleEvents': True,
+        })
         for item in existing.get('items', []):
             if item.get('summary') == title and item.get('start', {}).get('date') == date_value.isoformat():
                 return item, 'existing'
@@ -1854,10 +3941,12 @@ def create_all_day_calendar_event(title: str, event_date: datetime, trace_id: Op
             'end': {'date': next_date_value.isoformat()},
             'reminders': {'useDefault': False, 'overrides': []},
         }
-        created = service.events().insert(
-            calendarId=GOOGLE_CALENDAR_ID,
-            body=event,
-        ).execute()
+        created = execute_calendar_request(
+            'calendar.events.insert',
+            trace_id,
+            service,
+            {'calendarId': GOOGLE_CALENDAR_ID, 'body': event},
+        )
         if trace_id:
             log_pipeline_event(
                 'calendar_all_day_event_created',
@@ -1888,28 +3977,30 @@ def create_all_day_calendar_event(title: str, event_date: datetime, trace_id: Op
 def delete_all_day_calendar_event(title: str, event_date: datetime, trace_id: Optional[str] = None):
     """Elimina gli eventi all-day con titolo e data esatti."""
     try:
-        service = get_google_calendar_service()
-        if not service:
+        service = None if cassette_replay_enabled() else get_google_calendar_service()
+        if not service and not cassette_replay_enabled():
             return 0, 'error'
 
         date_value = event_date.date()
         next_date_value = date_value + timedelta(days=1)
-        existing = service.events().list(
-            calendarId=GOOGLE_CALENDAR_ID,
-            timeMin=f"{date_value.isoformat()}T00:00:00+02:00",
-            timeMax=f"{next_date_value.isoformat()}T00:00:00+02:00",
-            singleEvents=True,
-        ).execute()
+        existing = execute_calendar_request('calendar.events.list', trace_id, service, {
+            'calendarId': GOOGLE_CALENDAR_ID,
+            'timeMin': f"{date_value.isoformat()}T00:00:00+02:00",
+            'timeMax': f"{next_date_value.isoformat()}T00:00:00+02:00",
+            'singleEvents': True,
+        })
         matches = [
             item for item in existing.get('items', [])
             if item.get('summary') == title
             and item.get('start', {}).get('date') == date_value.isoformat()
         ]
         for item in matches:
-            service.events().delete(
-                calendarId=GOOGLE_CALENDAR_ID,
-                eventId=item['id'],
-            ).execute()
+            execute_calendar_request(
+                'calendar.events.delete',
+                trace_id,
+                service,
+                {'calendarId': GOOGLE_CALENDAR_ID, 'eventId': item['id']},
+            )
         if trace_id:
             log_pipeline_event(
                 'calendar_all_day_event_deleted',
@@ -1980,7 +4071,7 @@ async def handle_turni(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             except ValueError:
                 errors.append(f"{title} — {date_text}")
                 continue
-            _, status = create_all_day_calendar_event(title, event_date, trace_id=trace_id)
+            _, status = await run_blocking(create_all_day_calendar_event, title, event_date, trace_id=trace_id)
             if status == 'created':
                 created_count += 1
             elif status == 'existing':
@@ -2045,7 +4136,7 @@ async def handle_turni_rimuovi(update: Update, context: ContextTypes.DEFAULT_TYP
             except ValueError:
                 errors.append(f"{title} — {date_text}")
                 continue
-            count, status = delete_all_day_calendar_event(title, event_date, trace_id=trace_id)
+            count, status = await run_blocking(delete_all_day_calendar_event, title, event_date, trace_id=trace_id)
             if status == 'error':
                 errors.append(f"{title} — {date_text}")
             elif count:
@@ -2070,7 +4161,8 @@ async def handle_turni_rimuovi(update: Update, context: ContextTypes.DEFAULT_TYP
 
 
 async def reply_and_log(update: Update, trace_id: str, reply_text: str, reply_category: str, **extra: Any) -> None:
-    await update.message.reply_text(reply_text, reply_markup=build_persistent_keyboard())
+    with pipeline_span(trace_id, 'reply_send', reply_category=reply_category):
+        await update.message.reply_text(reply_text, reply_markup=build_persistent_keyboard())
     log_pipeline_event(
         'telegram_reply_sent',
         trace_id,
@@ -2092,7 +4184,8 @@ async def reply_with_keyboard_and_log(
     reply_markup: InlineKeyboardMarkup,
     **extra: Any,
 ) -> None:
-    await update.message.reply_text(reply_text, reply_markup=reply_markup)
+    with pipeline_span(trace_id, 'reply_send', reply_category=reply_category):
+        await update.message.reply_text(reply_text, reply_markup=reply_markup)
     log_pipeline_event(
         'telegram_reply_sent',
         trace_id,
@@ -2121,14 +4214,8 @@ Interpretazione precedente:
 Nuova riscrittura di Fabio:
 {followup_text}
 
-Produci solo JSON valido nello stesso formato del parser principale.
-Se il caso e' un rinvio, includi anche:
-- parte
-- giudice
-- luogo
-- data
-- ora
-- note
+Produci la lettura nello stesso formato del parser principale.
+{COMPACT_RESPONSE_FORMAT}
 
 Non inventare dati mancanti."""
 
@@ -2139,11 +4226,18 @@ def parse_message_with_ai_rewrite(
     previous_parsed_data: dict[str, Any],
     trace_id: Optional[str] = None,
 ) -> Optional[dict[str, Any]]:
-    if not client:
+    if not get_anthropic_client() and not cassette_replay_enabled():
         logger.error("Client Anthropic non configurato")
         return None
 
     try:
+        # Le riletture di un dubbio gia' aperto passano anche a budget esaurito: sono poche e interattive.
+        # Con il circuit breaker aperto invece Claude non risponde comunque.
+        if not claude_breaker_allows():
+            if trace_id:
+                log_pipeline_event('pipeline_failed', trace_id, failed_stage='claude_breaker', error='Circuit breaker Claude aperto')
+            return None
+        prompt_version = 'v3-tool-reanalysis'
         prompt = build_reanalysis_prompt(original_message, followup_text, previous_parsed_data)
         if trace_id:
             log_pipeline_event(
@@ -2153,28 +4247,32 @@ def parse_message_with_ai_rewrite(
                 followup_text=followup_text,
                 previous_parsed_data=previous_parsed_data,
             )
-        last_exc2: Exception = RuntimeError("Anthropic API unreachable")
-        message = None
-        for _attempt in range(3):
-            try:
-                message = client.messages.create(
-                    model=ANTHROPIC_MODEL,
-                    max_tokens=1000,
-                    messages=[{"role": "user", "content": prompt}],
-                )
-                break
-            except Exception as _exc:
-                last_exc2 = _exc
-                logger.warning(f"Anthropic API rewrite attempt {_attempt + 1}/3 failed: {_exc}")
-                if _attempt < 2:
-                    time.sleep(2 ** _attempt)
-        if message is None:
-            raise last_exc2
-        response_text = message.content[0].text.strip()
-        parsed_data = extract_json_object(response_text)
+        # Una riscrittura arriva gia' da un dubbio: si va diretti al modello piu' forte.
+        model = anthropic_model_tiers()[-1]
+        message = request_claude_message(
+            trace_id,
+            model,
+            prompt,
+            max_tokens=claude_max_tokens(build_message_analysis(followup_text)),
+            rewrite=True,
+        )
+        parsed_data, response_text = read_claude_tool_answer(message)
+        usage = claude_usage(message, model)
+        record_claude_usage(usage, prompt_version)
+        if trace_id:
+            log_pipeline_event(
+                'claude_response_received',
+                trace_id,
+                raw_response=response_text,
+                raw_response_hash=hash_text(response_text),
+                prompt_version=prompt_version,
+                usage=usage,
+                rewrite=True,
+            )
         if not parsed_data:
             return None
-        parsed_data = validate_and_normalize_parsed_data(parsed_data, normalize_message_text(followup_text))
+        with pipeline_span(trace_id, 'validation'):
+            parsed_data = validate_and_normalize_parsed_data(parsed_data, normalize_message_text(followup_text))
         return parsed_data
     except Exception as exc:
         logger.error(f"Errore rilettura dubbio: {exc}")
@@ -2218,7 +4316,10 @@ async def handle_export_chat(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
         return
 
-    export_data = build_chat_export(update.effective_chat.id)
+    since = None
+    if context.args and context.args[0].isdigit():
+        since = (datetime.utcnow() - timedelta(days=max(1, int(context.args[0])))).replace(microsecond=0).isoformat() + 'Z'
+    export_data = build_chat_export(update.effective_chat.id, since=since)
     if not export_data.get('conversations'):
         await update.message.reply_text("ℹ️ Non ho trovato messaggi esportabili nei log locali per questa chat.")
         log_pipeline_event(
@@ -2262,6 +4363,75 @@ async def handle_export_chat(update: Update, context: ContextTypes.DEFAULT_TYPE)
     )
 
 
+async def handle_trace(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.effective_chat or not update.message:
+        return
+
+    trace_id = build_trace_id(update)
+    if not await user_can_export_chat(update, context):
+        await update.message.reply_text("⚠️ Solo la chat privata o un admin del gruppo puo' vedere le trace.")
+        return
+
+    if context.args:
+        target_trace_id = context.args[0].strip()
+    elif update.message.reply_to_message:
+        target_trace_id = f"tg-{update.effective_chat.id}-{update.message.reply_to_message.message_id}"
+    else:
+        await update.message.reply_text("Uso: /trace <trace_id>, oppure rispondi al messaggio da analizzare.")
+        return
+
+    if not target_trace_id.startswith(f"tg-{update.effective_chat.id}-"):
+        await update.message.reply_text("⚠️ Puoi vedere solo le trace di questa chat.")
+        return
+
+    spans = load_trace_spans(target_trace_id)
+    waterfall = render_trace_waterfall(target_trace_id, spans)
+    await update.message.reply_text(f"<pre>{html.escape(waterfall)}</pre>", parse_mode='HTML')
+    log_pipeline_event(
+        'trace_rendered',
+        trace_id,
+        chat_id=update.effective_chat.id,
+        message_id=update.effective_message.message_id if update.effective_message else None,
+        user_id=update.effective_user.id if update.effective_user else None,
+        username=update.effective_user.username if update.effective_user else None,
+        text=update.message.text,
+        target_trace_id=target_trace_id,
+        span_count=len(spans),
+    )
+
+
+async def handle_profile_top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.effective_chat or not update.message:
+        return
+
+    if not await user_can_export_chat(update, context):
+        await update.message.reply_text("⚠️ Solo la chat privata o un admin del gruppo puo' vedere i profili.")
+        return
+
+    limit = 15
+    if context.args and context.args[0].isdigit():
+        limit = max(1, min(50, int(context.args[0])))
+    report = render_profile_top(aggregate_recent_profiles(), limit=limit)
+    await update.message.reply_text(f"<pre>{html.escape(report)}</pre>", parse_mode='HTML')
+
+
+async def handle_costi(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if not update.effective_chat or not update.message:
+        return
+
+    if not await user_can_export_chat(update, context):
+        await update.message.reply_text("⚠️ Solo la chat privata o un admin del gruppo puo' vedere i costi.")
+        return
+
+    days = 7
+    if context.args and context.args[0].isdigit():
+        days = max(1, min(90, int(context.args[0])))
+    # Solo la chat da cui arriva il comando: in privato chiunque puo' chiederlo, e non deve vedere le altre.
+    chat_id = str(update.effective_chat.id)
+    report = await run_blocking(lambda: render_claude_costs(aggregate_claude_costs(days, chat_id)))
+    await update.message.reply_text(f"<pre>{html.escape(report)}</pre>", parse_mode='HTML')
+
+
 async def handle_mask_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not update.effective_chat or not update.effective_user or not update.message:
         return
@@ -2296,7 +4466,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     trace_id = build_trace_id(update)
     logger.info(f"Nuovo messaggio ricevuto trace_id={trace_id}")
-    log_telegram_raw_message(update, trace_id, message_text)
+    # Il flock su messages.jsonl puo' essere tenuto da un export o dal sync: fuori dall'event loop.
+    await run_blocking(log_telegram_raw_message, update, trace_id, message_text)
     log_pipeline_event(
         'telegram_received',
         trace_id,
@@ -2364,7 +4535,8 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pending_trace_id=pending.get('trace_id'),
         )
         await update.message.chat.send_action(action="typing")
-        reparsed = parse_message_with_ai_rewrite(
+        reparsed = await run_blocking(
+            parse_message_with_ai_rewrite,
             pending.get('original_message', ''),
             message_text,
             pending.get('parsed_data', {}),
@@ -2381,13 +4553,19 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parsed_data = reparsed
     else:
         await update.message.chat.send_action(action="typing")
-        parsed_data = parse_message_with_ai(message_text, trace_id=trace_id)
+        parsed_data = await run_blocking(parse_message_with_ai, message_text, trace_id=trace_id)
     
     if not parsed_data:
         await reply_and_log(update, trace_id, "⚠️ Non sono riuscito a interpretare il messaggio.", 'parse_failed')
         return
     
     tipo = parsed_data.get('tipo', '')
+
+    if tipo == 'in_coda':
+        defer_update(update, trace_id)
+        cause = "Claude non risponde" if parsed_data.get('motivo') == 'circuito_aperto' else "Budget giornaliero di Claude esaurito"
+        await reply_and_log(update, trace_id, f"⏳ {cause}: il messaggio e' in coda e lo leggo appena possibile.", 'in_coda')
+        return
     
     # ═══════════════════════════════════════════════════════════
     # GESTIONE TIPI NON-RINVIO
@@ -2517,7 +4695,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 risposte.append(f"⚠️ Evento {i}: errore formattazione")
                 continue
             
-            created = create_google_calendar_event(event_data, trace_id=trace_id)
+            created = await run_blocking(create_google_calendar_event, event_data, trace_id=trace_id)
             
             if created:
                 eventi_creati += 1
@@ -2630,7 +4808,7 @@ async def handle_clarification_callback(update: Update, context: ContextTypes.DE
             if not event_data:
                 risposte.append("⚠️ Errore formattazione evento.")
                 continue
-            created = create_google_calendar_event(event_data, trace_id=trace_id)
+            created = await run_blocking(create_google_calendar_event, event_data, trace_id=trace_id)
             if created:
                 eventi_creati += 1
                 resp = f"✅ Evento creato\n"
@@ -2738,7 +4916,7 @@ async def handle_mask_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             mask_text=mask_text,
             fields=fields,
         )
-        parsed_data = parse_message_with_ai(mask_text, trace_id=trace_id)
+        parsed_data = await run_blocking(parse_message_with_ai, mask_text, trace_id=trace_id)
         if not parsed_data:
             await query.edit_message_text(
                 f"⚠️ Non riesco a interpretare la maschera in modo affidabile.\n\n{render_mask_summary(fields)}",
@@ -2746,6 +4924,14 @@ async def handle_mask_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             )
             return
 
+        if parsed_data.get('tipo') == 'in_coda':
+            cause = "Claude non risponde" if parsed_data.get('motivo') == 'circuito_aperto' else "Budget giornaliero di Claude esaurito"
+            await query.edit_message_text(
+                f"⏳ {cause} e la maschera non basta per la lettura locale. Riprova piu' tardi.\n\n{render_mask_summary(fields)}",
+                reply_markup=build_mask_keyboard(),
+            )
+            return
+
         if parsed_data.get('tipo') == 'conferma':
             await query.edit_message_text(
                 "⚠️ La maschera e' ancora ambigua.\n\n"
@@ -2779,7 +4965,7 @@ async def handle_mask_callback(update: Update, context: ContextTypes.DEFAULT_TYP
             )
             return
 
-        created = create_google_calendar_event(event_data, trace_id=trace_id)
+        created = await run_blocking(create_google_calendar_event, event_data, trace_id=trace_id)
         if not created:
             await query.edit_message_text(
                 f"⚠️ Errore nella creazione dell'evento da maschera.\n\n{render_mask_summary(fields)}",
@@ -2810,6 +4996,300 @@ async def handle_mask_callback(update: Update, context: ContextTypes.DEFAULT_TYP
 
     await query.edit_message_text("ℹ️ Azione maschera non riconosciuta.")
 
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Update in parallelo, ma quelli dello stesso utente nella stessa chat uno alla volta e in ordine."""
+
+    def __init__(self, max_concurrent_updates: int) -> None:
+        super().__init__(max_concurrent_updates)
+        self.chat_locks: dict[str, asyncio.Lock] = {}
+        self.chat_pending: dict[str, int] = {}
+
+    async def do_process_update(self, update: object, coroutine: Any) -> None:
+        chat = getattr(update, 'effective_chat', None)
+        user = getattr(update, 'effective_user', None)
+        key = build_pending_key(chat.id if chat else None, user.id if user else None)
+        lock = self.chat_locks.setdefault(key, asyncio.Lock())
+        self.chat_pending[key] = self.chat_pending.get(key, 0) + 1
+        try:
+            async with lock:
+                await coroutine
+        finally:
+            # Nessun altro update in attesa: il Lock si butta, altrimenti resterebbe uno per chat vista.
+            self.chat_pending[key] -= 1
+            if not self.chat_pending[key]:
+                del self.chat_pending[key]
+                del self.chat_locks[key]
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+def build_application() -> Application:
+    builder = Application.builder().token(TELEGRAM_TOKEN)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    if TELEGRAM_CONCURRENT_UPDATES > 1:
+        # Il pool di default verso l'API Telegram ha una sola connessione: con update in parallelo
+        # le risposte andrebbero in timeout aspettandola.
+        builder = (
+            builder.concurrent_updates(ChatOrderedUpdateProcessor(TELEGRAM_CONCURRENT_UPDATES))
+            .connection_pool_size(min(TELEGRAM_CONCURRENT_UPDATES, 32))
+            .pool_timeout(10.0)
+        )
+    application = builder.build()
+
+    application.add_handler(CommandHandler('1', instrument_handler('handle_mask_start', handle_mask_start)))
+    application.add_handler(CommandHandler('turni', instrument_handler('handle_turni', handle_turni)))
+    application.add_handler(CommandHandler('turni_rimuovi', instrument_handler('handle_turni_rimuovi', handle_turni_rimuovi)))
+    application.add_handler(CommandHandler('export_chat', instrument_handler('handle_export_chat', handle_export_chat)))
+    application.add_handler(CommandHandler('trace', instrument_handler('handle_trace', handle_trace)))
+    application.add_handler(CommandHandler('profile_top', instrument_handler('handle_profile_top', handle_profile_top)))
+    application.add_handler(CommandHandler('costi', instrument_handler('handle_costi', handle_costi)))
+    application.add_handler(CallbackQueryHandler(instrument_handler('handle_mask_callback', handle_mask_callback), pattern=r'^mask:'))
+    application.add_handler(CallbackQueryHandler(instrument_handler('handle_clarification_callback', handle_clarification_callback), pattern=r'^clarify:'))
+    application.add_handler(
+        MessageHandler(filters.TEXT & ~filters.COMMAND, instrument_handler('handle_message', handle_message))
+    )
+    
+    application.add_error_handler(error_handler)
+    if PIPELINE_COMPACT_AFTER_DAYS > 0 and application.job_queue is not None:
+        application.job_queue.run_repeating(
+            compact_pipeline_job,
+            interval=PIPELINE_COMPACT_INTERVAL_S,
+            first=600,
+            name='compact_pipeline_log',
+        )
+    if (CLAUDE_DAILY_BUDGET_USD > 0 or CLAUDE_BREAKER_FAILURES > 0) and application.job_queue is not None:
+        application.job_queue.run_repeating(
+            drain_deferred_updates_job,
+            interval=DEFERRED_DRAIN_INTERVAL_S,
+            first=60,
+            name='drain_deferred_updates',
+        )
+    return application
+
+
+class TelegramWebhookHandler(tornado_web.RequestHandler):
+    def initialize(self, telegram_app: Application) -> None:
+        self.telegram_app = telegram_app
+
+    async def post(self) -> None:
+        try:
+            payload = json.loads(self.request.body)
+        except (TypeError, ValueError):
+            self.set_status(400)
+            return
+        update = Update.de_json(payload, self.telegram_app.bot)
+        if update:
+            await self.telegram_app.update_queue.put(update)
+
+
+class MetricsHandler(tornado_web.RequestHandler):
+    def get(self) -> None:
+        self.set_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.write(render_metrics())
+
+
+class HealthHandler(tornado_web.RequestHandler):
+    def get(self) -> None:
+        self.write({'status': 'ok'})
+
+
+class ReadinessHandler(tornado_web.RequestHandler):
+    def initialize(self, telegram_app: Application) -> None:
+        self.telegram_app = telegram_app
+
+    def get(self) -> None:
+        checks = {
+            'telegram': bool(self.telegram_app.running),
+            'anthropic': client is not None or cassette_replay_enabled(),
+            'calendar': cassette_replay_enabled() or _CALENDAR_SERVICE is not None,
+        }
+        ready = all(checks.values())
+        self.set_status(200 if ready else 503)
+        self.write({'status': 'ready' if ready else 'not_ready', 'checks': checks})
+
+
+def register_application_gauges(application: Application) -> None:
+    register_metric_gauge(
+        'rinviabot_pending_clarifications',
+        lambda: len(application.bot_data.get('pending_clarifications', {})),
+    )
+    register_metric_gauge(
+        'rinviabot_input_masks',
+        lambda: len(application.bot_data.get('input_masks', {})),
+    )
+    register_metric_gauge('rinviabot_log_writer_queue_depth', _REMOTE_LOG_QUEUE.qsize)
+    register_metric_gauge('rinviabot_event_db_queue_depth', _EVENT_DB_QUEUE.qsize)
+    # Valori gia' in memoria: lo scrape non deve rileggere i log a cambio giorno.
+    register_metric_gauge(
+        'rinviabot_claude_spend_today_usd',
+        lambda: _CLAUDE_SPEND['cost_usd'] if _CLAUDE_SPEND['day'] == utc_today() else 0.0,
+    )
+    register_metric_gauge(
+        'rinviabot_degraded_mode',
+        lambda: int(CLAUDE_DAILY_BUDGET_USD > 0 and _CLAUDE_SPEND['day'] == utc_today() and _CLAUDE_SPEND['cost_usd'] >= CLAUDE_DAILY_BUDGET_USD),
+    )
+    register_metric_gauge('rinviabot_claude_breaker_state', lambda: CLAUDE_BREAKER_STATES[claude_breaker_state()])
+    register_metric_gauge('rinviabot_claude_concurrency_limit', lambda: int(_CLAUDE_LIMITER['limit']))
+    register_metric_gauge('rinviabot_claude_in_flight', lambda: _CLAUDE_LIMITER['in_flight'])
+    register_metric_gauge(
+        'rinviabot_claude_queue_depth',
+        lambda: sum(len(waiters) for chats in _CLAUDE_WAITERS.values() for waiters in list(chats.values())),
+    )
+
+
+def refresh_google_token_if_expiring(margin_s: float = GOOGLE_TOKEN_REFRESH_MARGIN_S) -> bool:
+    """Rinnova il token prima della scadenza, cosi' nessun update paga il giro su OAuth."""
+    credentials = _GOOGLE_CREDENTIALS
+    if credentials is None:
+        return False
+    expiry = getattr(credentials, 'expiry', None)
+    now_utc = datetime.now(pytz.utc).replace(tzinfo=None)
+    if credentials.token and expiry and (expiry - now_utc).total_seconds() > margin_s:
+        return False
+
+    import google_auth_httplib2
+    # Le credenziali sono condivise: un rinnovo vale per tutte le connessioni del pool.
+    with calendar_http() as authed_http:
+        credentials.refresh(google_auth_httplib2.Request(authed_http.http))
+    metric_inc('rinviabot_google_token_refresh_total')
+    return True
+
+
+def within_keepalive_hours(now: Optional[datetime] = None) -> bool:
+    start, _, end = OUTBOUND_KEEPALIVE_HOURS.partition('-')
+    try:
+        start_hour, end_hour = int(start), int(end or 24)
+    except ValueError:
+        return True
+    return start_hour <= (now or datetime.now(ROME_TZ)).hour < end_hour
+
+
+def ping_outbound_upstreams() -> None:
+    """Richieste leggere che tengono aperte le connessioni gia' nel pool."""
+    targets = []
+    if client is not None and ANTHROPIC_API_KEY:
+        targets.append(('anthropic', 'HEAD', ANTHROPIC_BASE_URL))
+    if REMOTE_LOG_ENDPOINT:
+        targets.append(('remote_log', 'GET', re.sub(r'/ingest/?$', '/health', REMOTE_LOG_ENDPOINT)))
+    for upstream, method, url in targets:
+        try:
+            get_outbound_http().request(method, url, timeout=5.0)
+            metric_inc('rinviabot_keepalive_total', upstream=upstream, outcome='ok')
+        except httpx.HTTPError as exc:
+            metric_inc('rinviabot_keepalive_total', upstream=upstream, outcome='error')
+            logger.debug(f"Keep-alive {upstream} fallito: {exc}")
+
+    service = _CALENDAR_SERVICE
+    if service is None:
+        return
+    if _GOOGLE_CREDENTIALS is None:
+        ping_calendar_connection(service, None)
+        return
+    # Una connessione libera alla volta: la coda e' FIFO, quindi in un giro si passa da tutte.
+    # Quelle in prestito a un handler sono gia' calde.
+    for _ in range(max(1, CALENDAR_HTTP_POOL_SIZE)):
+        try:
+            authed_http = _CALENDAR_HTTP_POOL.get_nowait()
+        except queue.Empty:
+            break
+        try:
+            ping_calendar_connection(service, authed_http)
+        finally:
+            _CALENDAR_HTTP_POOL.put(authed_http)
+
+
+def ping_calendar_connection(service: Any, authed_http: Any) -> None:
+    try:
+        service.calendars().get(calendarId=GOOGLE_CALENDAR_ID, fields='id').execute(http=authed_http)
+        metric_inc('rinviabot_keepalive_total', upstream='calendar', outcome='ok')
+    except Exception as exc:
+        metric_inc('rinviabot_keepalive_total', upstream='calendar', outcome='error')
+        logger.debug(f"Keep-alive calendar fallito: {exc}")
+
+
+def outbound_maintenance_loop() -> None:
+    while True:
+        time.sleep(OUTBOUND_KEEPALIVE_INTERVAL_S)
+        try:
+            refresh_google_token_if_expiring()
+        except Exception as exc:
+            logger.warning(f"Rinnovo token Google non riuscito: {exc}")
+        if within_keepalive_hours():
+            ping_outbound_upstreams()
+
+
+def warm_up_clients() -> None:
+    """Importa gli SDK, costruisce i client e apre le connessioni prima del primo update, fuori dall'event loop."""
+    started = time.perf_counter()
+    try:
+        get_anthropic_client()
+        if not cassette_replay_enabled():
+            get_google_calendar_service()
+        from dateutil import parser  # noqa: F401
+    except Exception as exc:
+        logger.warning(f"Warm-up client non riuscito: {exc}")
+        return
+    if OUTBOUND_KEEPALIVE_INTERVAL_S > 0 and not cassette_replay_enabled():
+        try:
+            refresh_google_token_if_expiring()
+        except Exception as exc:
+            logger.warning(f"Token Google non disponibile al warm-up: {exc}")
+        ping_outbound_upstreams()
+        threading.Thread(target=outbound_maintenance_loop, name='rinviabot-keepalive', daemon=True).start()
+    logger.info(f"Warm-up client completato in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+async def serve_webhook(application: Application, port: int) -> None:
+    """Come run_webhook, ma sullo stesso server espone anche /metrics, /healthz e /readyz."""
+    register_application_gauges(application)
+    web_app = tornado_web.Application([
+        (rf'/{re.escape(TELEGRAM_TOKEN)}/?', TelegramWebhookHandler, {'telegram_app': application}),
+        (r'/metrics', MetricsHandler),
+        (r'/healthz', HealthHandler),
+        (r'/readyz', ReadinessHandler, {'telegram_app': application}),
+    ])
+    server = tornado_httpserver.HTTPServer(web_app)
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        server.listen(port, address='0.0.0.0')
+        await application.bot.set_webhook(url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}")
+        logger.info(f"Webhook in ascolto sulla porta {port} (/metrics, /healthz, /readyz)")
+        warm_up = asyncio.create_task(asyncio.to_thread(warm_up_clients))
+        await stop_event.wait()
+        await warm_up
+        server.stop()
+        await application.stop()
+        await asyncio.to_thread(flush_remote_log_writer)
+        await asyncio.to_thread(flush_event_db_writer)
+        if application.post_stop:
+            await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+def run_application(application: Application) -> None:
+    if WEBHOOK_URL:
+        port = int(os.getenv('PORT', 8443))
+        logger.info(f"Starting webhook on port {port}")
+        asyncio.run(serve_webhook(application, port))
+    else:
+        logger.info("Starting polling mode...")
+        threading.Thread(target=warm_up_clients, name='rinviabot-warm-up', daemon=True).start()
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
 def main():
     """Funzione principale"""
     ensure_runtime_directories()
@@ -2821,32 +5301,7 @@ def main():
         logger.error("ANTHROPIC_API_KEY non configurato!")
         return
     
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
-    
-    application.add_handler(CommandHandler('1', handle_mask_start))
-    application.add_handler(CommandHandler('turni', handle_turni))
-    application.add_handler(CommandHandler('turni_rimuovi', handle_turni_rimuovi))
-    application.add_handler(CommandHandler('export_chat', handle_export_chat))
-    application.add_handler(CallbackQueryHandler(handle_mask_callback, pattern=r'^mask:'))
-    application.add_handler(CallbackQueryHandler(handle_clarification_callback, pattern=r'^clarify:'))
-    application.add_handler(
-        MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
-    )
-    
-    application.add_error_handler(error_handler)
-    
-    if WEBHOOK_URL:
-        port = int(os.getenv('PORT', 8443))
-        logger.info(f"Starting webhook on port {port}")
-        application.run_webhook(
-            listen="0.0.0.0",
-            port=port,
-            url_path=TELEGRAM_TOKEN,
-            webhook_url=f"{WEBHOOK_URL}/{TELEGRAM_TOKEN}"
-        )
-    else:
-        logger.info("Starting polling mode...")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    run_application(build_application())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,129 @@
+"""Copia locale in SQLite degli eventi pipeline, con lo stesso schema D1 del logger worker.
+
+Opzionale: il bot la scrive solo con ``RINVIABOT_EVENT_DB`` impostata. ``pipeline.jsonl`` resta
+la fonte principale; il database serve per export, trace e analisi con query indicizzate
+(trace_id, stage, ts e chat_id/message_id) invece di scansioni lineari dei JSONL.
+Le righe sono costruite come fa ``cloudflare/logger-worker/src/index.js``.
+"""
+
+import json
+import sqlite3
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+
+SCHEMA_PATH = Path(__file__).resolve().parent / "cloudflare" / "logger-worker" / "schema.sql"
+INSERT_EVENT_SQL = """
+    INSERT INTO pipeline_events (
+      ts,
+      trace_id,
+      stage,
+      chat_id,
+      message_id,
+      user_id,
+      username,
+      text_preview,
+      source,
+      payload_json
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def connect(path: Path) -> sqlite3.Connection:
+    """Connessione in WAL: un solo scrittore (il thread del bot o il backfill) e letture concorrenti."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(str(path), timeout=30.0, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(SCHEMA_PATH.read_text(encoding="utf-8"))
+    return conn
+
+
+def normalize_string(value: Any) -> str:
+    if value is None:
+        return ""
+    return str(value)
+
+
+def event_row(payload: dict[str, Any]) -> Optional[tuple[str, ...]]:
+    ts = normalize_string(payload.get("ts"))
+    trace_id = normalize_string(payload.get("trace_id"))
+    stage = normalize_string(payload.get("stage"))
+    if not ts or not trace_id or not stage:
+        return None
+    return (
+        ts,
+        trace_id,
+        stage,
+        normalize_string(payload.get("chat_id")),
+        normalize_string(payload.get("message_id")),
+        normalize_string(payload.get("user_id")),
+        normalize_string(payload.get("username")),
+        normalize_string(payload.get("text"))[:500],
+        normalize_string(payload.get("source") or "rinviabot-render"),
+        json.dumps(payload, ensure_ascii=False),
+    )
+
+
+def insert_events(conn: sqlite3.Connection, payloads: Iterable[dict[str, Any]]) -> int:
+    """Inserisce un blocco di eventi in una sola transazione; ritorna quanti ne ha scritti."""
+    rows = [row for row in (event_row(payload) for payload in payloads) if row is not None]
+    if rows:
+        with conn:
+            conn.executemany(INSERT_EVENT_SQL, rows)
+    return len(rows)
+
+
+def load_payloads(conn: sqlite3.Connection, sql: str, params: Iterable[Any] = ()) -> list[dict[str, Any]]:
+    records = []
+    for (payload_json,) in conn.execute(sql, tuple(params)):
+        try:
+            payload = json.loads(payload_json)
+        except json.JSONDecodeError:
+            continue
+        if isinstance(payload, dict):
+            records.append(payload)
+    return records
+
+
+def chat_events(
+    conn: sqlite3.Connection,
+    chat_id: str,
+    trace_ids: Iterable[str] = (),
+    since: Optional[str] = None,
+) -> list[dict[str, Any]]:
+    """Tutti gli eventi delle trace della chat, comprese quelle note solo dal log raw."""
+    sql = """
+        SELECT payload_json FROM pipeline_events
+        WHERE trace_id IN (
+          SELECT trace_id FROM pipeline_events WHERE chat_id = ?
+          UNION SELECT value FROM json_each(?)
+        )
+    """
+    params: list[Any] = [chat_id, json.dumps(sorted(set(trace_ids)))]
+    if since:
+        sql += " AND ts >= ?"
+        params.append(since)
+    return load_payloads(conn, sql + " ORDER BY id", params)
+
+
+def trace_events(conn: sqlite3.Connection, trace_id: str, stage: Optional[str] = None) -> list[dict[str, Any]]:
+    sql = "SELECT payload_json FROM pipeline_events WHERE trace_id = ?"
+    params: list[Any] = [trace_id]
+    if stage:
+        sql += " AND stage = ?"
+        params.append(stage)
+    return load_payloads(conn, sql + " ORDER BY id", params)
+
+
+def oldest_event_ts(conn: sqlite3.Connection) -> Optional[str]:
+    row = conn.execute("SELECT MIN(ts) FROM pipeline_events").fetchone()
+    return row[0] if row else None
+
+
+def event_exists(conn: sqlite3.Connection, payload: dict[str, Any]) -> bool:
+    row = conn.execute(
+        "SELECT 1 FROM pipeline_events WHERE trace_id = ? AND stage = ? AND ts = ? LIMIT 1",
+        (normalize_string(payload.get("trace_id")), normalize_string(payload.get("stage")), normalize_string(payload.get("ts"))),
+    ).fetchone()
+    return row is not None
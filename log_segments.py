@@ -0,0 +1,325 @@
+"""Log JSONL a segmenti per pipeline.jsonl e messages.jsonl.
+
+Il file attivo resta sempre allo stesso path, cosi' chi scrive non cambia. Quando il file
+attivo e' di un giorno precedente o supera ``LOG_SEGMENT_MAX_BYTES`` viene spostato in
+``segments/`` e compresso in background. ``<nome>.manifest.json`` elenca i segmenti chiusi
+con l'intervallo di ts dei record, cosi' i lettori saltano quelli fuori dal periodo richiesto.
+"""
+
+import gzip
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+from typing import IO, Any, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows: resta solo il lock tra thread dello stesso processo.
+    fcntl = None
+
+
+LOG_SEGMENT_MAX_BYTES = int(float(os.getenv("RINVIABOT_LOG_SEGMENT_MAX_MB", "32") or "32") * 1024 * 1024)
+
+# Per path: inode del file attivo e giorno (UTC) in cui e' stato aperto, visti da questo processo.
+_ACTIVE: dict[Path, tuple[int, str]] = {}
+_ACTIVE_LOCK = threading.Lock()
+_COMPRESSING: set[Path] = set()
+
+
+def utc_now_iso() -> str:
+    return datetime.utcnow().replace(microsecond=0).isoformat() + "Z"
+
+
+def lock_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.lock")
+
+
+@contextmanager
+def file_lock(path: Path) -> Iterator[None]:
+    """Lock esclusivo tra processi sul file .lock accanto al log (non rientrante)."""
+    target = lock_path(path)
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(target, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if fcntl is not None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # Chiudere il descrittore rilascia anche il flock.
+        os.close(fd)
+
+
+def segments_dir(path: Path) -> Path:
+    return path.parent / "segments"
+
+
+def manifest_path(path: Path) -> Path:
+    return path.with_name(f"{path.stem}.manifest.json")
+
+
+def load_manifest(path: Path) -> dict[str, Any]:
+    target = manifest_path(path)
+    if target.exists():
+        try:
+            manifest = json.loads(target.read_text(encoding="utf-8"))
+            if isinstance(manifest, dict):
+                manifest.setdefault("active", {})
+                manifest.setdefault("segments", [])
+                return manifest
+        except (OSError, ValueError):
+            pass
+    return {"active": {}, "segments": []}
+
+
+def manifest_version(path: Path) -> tuple[int, int, int]:
+    """Cambia a ogni save_manifest: il replace atomico crea sempre un inode nuovo."""
+    try:
+        stat = manifest_path(path).stat()
+    except FileNotFoundError:
+        return (0, 0, 0)
+    return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+
+def save_manifest(path: Path, manifest: dict[str, Any]) -> None:
+    target = manifest_path(path)
+    tmp_path = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+    tmp_path.write_text(json.dumps(manifest, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp_path.replace(target)
+
+
+def segment_path(path: Path, entry: dict[str, Any]) -> Path:
+    """Path del segmento; se nel frattempo e' stato compresso, quello .gz."""
+    target = segments_dir(path) / entry["file"]
+    if not target.exists() and target.suffix != ".gz":
+        compressed = target.with_name(f"{target.name}.gz")
+        if compressed.exists():
+            return compressed
+    return target
+
+
+def open_segment(path: Path) -> IO[str]:
+    if not path.exists() and path.suffix != ".gz" and path.with_name(f"{path.name}.gz").exists():
+        # Compresso e rimosso tra la lettura del manifest e l'apertura.
+        path = path.with_name(f"{path.name}.gz")
+    if path.suffix == ".gz":
+        return gzip.open(path, "rt", encoding="utf-8")
+    return path.open("r", encoding="utf-8")
+
+
+def read_segment_tail(path: Path, offset: int) -> bytes:
+    """Byte del segmento (anche compresso) dall'offset del file originale in poi."""
+    opener = gzip.open if path.suffix == ".gz" else open
+    with opener(path, "rb") as fh:
+        fh.seek(offset)
+        return fh.read()
+
+
+def segment_files(path: Path, since: Optional[str] = None, until: Optional[str] = None) -> list[Path]:
+    """Segmenti chiusi che possono contenere record tra since e until (ts ISO UTC), piu' il file attivo."""
+    files = []
+    for entry in load_manifest(path)["segments"]:
+        # Un segmento non ancora compresso non ha l'intervallo: si legge sempre.
+        if since and entry.get("last_ts") and entry["last_ts"] < since:
+            continue
+        if until and entry.get("first_ts") and entry["first_ts"] > until:
+            continue
+        target = segment_path(path, entry)
+        if target.exists():
+            files.append(target)
+    if path.exists():
+        files.append(path)
+    return files
+
+
+def find_segment_by_generation(path: Path, generation: int) -> Optional[Path]:
+    """Segmento chiuso che era il file attivo alla generazione data (una per rotazione)."""
+    for entry in reversed(load_manifest(path)["segments"]):
+        if entry.get("generation") == generation:
+            target = segment_path(path, entry)
+            return target if target.exists() else None
+    return None
+
+
+def maybe_rotate(path: Path) -> None:
+    """Chiude il segmento attivo se e' di ieri o troppo grande. Non chiamarla tenendo file_lock(path)."""
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return
+    today = utc_now_iso()[:10]
+    with _ACTIVE_LOCK:
+        active = _ACTIVE.get(path)
+    if active is None or active[0] != stat.st_ino:
+        active = observe_active(path, stat.st_ino)
+    if active[1] >= today and stat.st_size < LOG_SEGMENT_MAX_BYTES:
+        return
+
+    with file_lock(path):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return
+        manifest = load_manifest(path)
+        opened_on = str(manifest["active"].get("opened_at") or today)[:10] if manifest["active"].get("inode") == stat.st_ino else today
+        if opened_on >= today and stat.st_size < LOG_SEGMENT_MAX_BYTES:
+            # Gia' ruotato da un altro processo.
+            return
+        segments_dir(path).mkdir(parents=True, exist_ok=True)
+        stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+        target = segments_dir(path) / f"{path.stem}-{stamp}.jsonl"
+        suffix = 1
+        while target.exists() or target.with_name(f"{target.name}.gz").exists():
+            suffix += 1
+            target = segments_dir(path) / f"{path.stem}-{stamp}-{suffix}.jsonl"
+        os.replace(path, target)
+        generation = int(manifest.get("generation") or 0)
+        manifest["generation"] = generation + 1
+        manifest["segments"].append({
+            "file": target.name,
+            "generation": generation,
+            "bytes": stat.st_size,
+            "opened_at": manifest["active"].get("opened_at"),
+            "rotated_at": utc_now_iso(),
+            "first_ts": None,
+            "last_ts": None,
+            "records": None,
+            "compressed": False,
+        })
+        manifest["active"] = {}
+        save_manifest(path, manifest)
+    with _ACTIVE_LOCK:
+        _ACTIVE.pop(path, None)
+    start_compression(path)
+
+
+def observe_active(path: Path, inode: int) -> tuple[int, str]:
+    """Registra nel manifest quando e' stato visto per la prima volta il file attivo corrente."""
+    with file_lock(path):
+        manifest = load_manifest(path)
+        if manifest["active"].get("inode") != inode:
+            manifest["active"] = {"inode": inode, "opened_at": utc_now_iso()}
+            save_manifest(path, manifest)
+        pending = any(not entry.get("compressed") for entry in manifest["segments"])
+    active = (inode, str(manifest["active"]["opened_at"])[:10])
+    with _ACTIVE_LOCK:
+        _ACTIVE[path] = active
+    if pending:
+        # Compressione rimasta a meta' in un processo precedente.
+        start_compression(path)
+    return active
+
+
+def start_compression(path: Path) -> None:
+    with _ACTIVE_LOCK:
+        if path in _COMPRESSING:
+            return
+        _COMPRESSING.add(path)
+    threading.Thread(target=compress_pending_segments, args=(path,), name="rinviabot-log-gzip", daemon=True).start()
+
+
+def compress_pending_segments(path: Path) -> None:
+    """Comprime i segmenti chiusi e ne calcola l'intervallo di ts; il file originale si cancella alla fine."""
+    try:
+        for entry in list(load_manifest(path)["segments"]):
+            if entry.get("compressed"):
+                continue
+            source = segments_dir(path) / entry["file"]
+            if not source.exists():
+                continue
+            compressed = source.with_name(f"{source.name}.gz")
+            tmp_path = compressed.with_name(f"{compressed.name}.{os.getpid()}.tmp")
+            first_ts: Optional[str] = None
+            last_ts: Optional[str] = None
+            records = 0
+            with source.open("rb") as src, gzip.open(tmp_path, "wb", compresslevel=6) as dst:
+                for line in src:
+                    dst.write(line)
+                    try:
+                        ts = json.loads(line).get("ts")
+                    except (ValueError, AttributeError):
+                        continue
+                    records += 1
+                    if isinstance(ts, str) and ts:
+                        first_ts = ts if first_ts is None else min(first_ts, ts)
+                        last_ts = ts if last_ts is None else max(last_ts, ts)
+            tmp_path.replace(compressed)
+            with file_lock(path):
+                manifest = load_manifest(path)
+                for current in manifest["segments"]:
+                    if current["file"] == entry["file"]:
+                        current.update({
+                            "file": compressed.name,
+                            "first_ts": first_ts,
+                            "last_ts": last_ts,
+                            "records": records,
+                            "compressed": True,
+                        })
+                save_manifest(path, manifest)
+            source.unlink(missing_ok=True)
+    finally:
+        with _ACTIVE_LOCK:
+            _COMPRESSING.discard(path)
+
+
+def cold_dir(path: Path) -> Path:
+    return segments_dir(path) / "cold"
+
+
+def detailed_segment_files(path: Path) -> list[Path]:
+    """Tutti i record originali: segmenti cold al posto dei riepiloghi compattati, piu' il file attivo."""
+    manifest = load_manifest(path)
+    files = [cold_dir(path) / entry["file"] for entry in manifest.get("cold", [])]
+    files.extend(segment_path(path, entry) for entry in manifest["segments"] if not entry.get("compacted"))
+    if path.exists():
+        files.append(path)
+    return [target for target in files if target.exists()]
+
+
+def replace_with_compacted(path: Path, entries: list[dict[str, Any]], records: list[dict[str, Any]]) -> Optional[dict[str, Any]]:
+    """Sostituisce i segmenti dati con un unico segmento compattato; gli originali vanno in segments/cold/."""
+    target_dir = segments_dir(path)
+    stamp = datetime.utcnow().strftime("%Y%m%dT%H%M%S")
+    target = target_dir / f"{path.stem}-compact-{stamp}.jsonl.gz"
+    suffix = 1
+    while target.exists():
+        suffix += 1
+        target = target_dir / f"{path.stem}-compact-{stamp}-{suffix}.jsonl.gz"
+    tmp_path = target.with_name(f"{target.name}.{os.getpid()}.tmp")
+    timestamps = [str(record["ts"]) for record in records if record.get("ts")]
+    with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=6) as fh:
+        for record in records:
+            fh.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    names = {entry["file"] for entry in entries}
+    with file_lock(path):
+        manifest = load_manifest(path)
+        current = [entry for entry in manifest["segments"] if entry["file"] in names]
+        if len(current) != len(names):
+            # Il manifest e' cambiato nel frattempo (altra compattazione): si lascia tutto com'era.
+            tmp_path.unlink(missing_ok=True)
+            return None
+        tmp_path.replace(target)
+        cold_dir(path).mkdir(parents=True, exist_ok=True)
+        for entry in current:
+            source = segment_path(path, entry)
+            os.replace(source, cold_dir(path) / source.name)
+            manifest.setdefault("cold", []).append(dict(entry, file=source.name, compacted_into=target.name))
+        compacted = {
+            "file": target.name,
+            "compacted": True,
+            "compressed": True,
+            "rotated_at": utc_now_iso(),
+            "first_ts": min(timestamps) if timestamps else None,
+            "last_ts": max(timestamps) if timestamps else None,
+            "records": len(records),
+            "source_records": sum(int(entry.get("records") or 0) for entry in current),
+            "sources": sorted(names),
+        }
+        position = manifest["segments"].index(current[0])
+        manifest["segments"] = [entry for entry in manifest["segments"] if entry["file"] not in names]
+        manifest["segments"].insert(position, compacted)
+        save_manifest(path, manifest)
+    return compacted
@@ -0,0 +1,34 @@
+"""Blob store dei payload voluminosi del log pipeline.
+
+I campi grandi di un evento vengono scritti una sola volta in ``blobs/<aa>/<hash>.json`` e
+nell'evento resta ``{"$blob": "<hash>"}``. Il bot e ``scripts/backfill_event_db.py`` leggono
+i riferimenti con le stesse funzioni; ciascuno passa il proprio loader (cache, log, fallback).
+"""
+
+import json
+from pathlib import Path
+from typing import Any, Callable
+
+
+def blob_path(blob_dir: Path, digest: str) -> Path:
+    return blob_dir / digest[:2] / f"{digest}.json"
+
+
+def read_blob(blob_dir: Path, digest: str) -> Any:
+    """Contenuto del blob; OSError o JSONDecodeError se manca o e' illeggibile."""
+    return json.loads(blob_path(blob_dir, digest).read_text(encoding="utf-8"))
+
+
+def is_blob_ref(value: Any) -> bool:
+    return isinstance(value, dict) and len(value) == 1 and isinstance(value.get("$blob"), str)
+
+
+def resolve_blob_refs(value: Any, load: Callable[[str], Any]) -> Any:
+    """Sostituisce i riferimenti {'$blob': hash} con load(hash), anche dentro dict e liste annidati."""
+    if is_blob_ref(value):
+        return load(value["$blob"])
+    if isinstance(value, dict):
+        return {key: resolve_blob_refs(item, load) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve_blob_refs(item, load) for item in value]
+    return value
@@ -0,0 +1,196 @@
+"""Append condiviso per logs/telegram/raw/messages.jsonl.
+
+Il bot, telegram_live_log.py, export_telegram_history.py e sync_known_telegram_chats.py
+scrivono lo stesso file, anche in contemporanea. Ogni append:
+
+- prende un lock esclusivo (flock) su ``messages.jsonl.lock``, condiviso tra processi;
+- legge solo le righe appese dopo l'ultimo offset noto a questo processo, anche da altri;
+- scarta i record con una coppia (chat_id, message_id) gia' presente nel log;
+- scrive tutte le righe rimaste con un'unica write in O_APPEND, sempre righe intere.
+
+L'indice delle chiavi viene salvato ogni tanto in ``messages.keys.json`` (generazione del
+file attivo, offset e chiavi), cosi' un processo nuovo non deve rileggere tutto il log all'avvio. Il file viene
+ruotato da log_segments: le chiavi restano valide anche per i record nei segmenti chiusi.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+import log_segments
+
+
+# Salvare l'indice costa O(n): si fa di rado, tanto all'avvio le righe successive vengono rilette.
+KEY_INDEX_SAVE_INTERVAL_S = 300.0
+
+_INDEXES: dict[Path, dict[str, Any]] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def message_key(chat_id: Any, message_id: Any) -> Optional[tuple[str, str]]:
+    if chat_id is None or message_id is None:
+        return None
+    return (str(chat_id), str(message_id))
+
+
+def key_index_path(path: Path) -> Path:
+    return path.with_name(f"{path.stem}.keys.json")
+
+
+def load_index(path: Path) -> dict[str, Any]:
+    index: dict[str, Any] = {
+        "generation": 0,
+        "manifest_version": None,
+        "offset": 0,
+        "keys": set(),
+        "saved_at": time.monotonic(),
+        "lock": threading.Lock(),
+    }
+    saved_path = key_index_path(path)
+    if saved_path.exists():
+        try:
+            saved = json.loads(saved_path.read_text(encoding="utf-8"))
+            index["generation"] = int(saved.get("generation") or 0)
+            index["offset"] = int(saved.get("offset") or 0)
+            index["keys"] = {(str(chat_id), str(message_id)) for chat_id, message_id in saved.get("keys", [])}
+        except (OSError, ValueError, TypeError):
+            index["offset"] = 0
+            index["keys"] = set()
+    with log_segments.file_lock(path):
+        refresh_index(path, index)
+    return index
+
+
+def get_index(path: Path) -> dict[str, Any]:
+    path = Path(path)
+    with _INDEXES_LOCK:
+        index = _INDEXES.get(path)
+        if index is None:
+            index = _INDEXES[path] = load_index(path)
+            atexit.register(save_index, path, True)
+        return index
+
+
+def refresh_index(path: Path, index: dict[str, Any]) -> None:
+    """Aggiunge all'indice le righe complete appese dopo l'ultimo offset letto. Va chiamata con file_lock(path)."""
+    version = log_segments.manifest_version(path)
+    if version != index["manifest_version"]:
+        index["manifest_version"] = version
+        generation = int(log_segments.load_manifest(path).get("generation") or 0)
+        if generation != index["generation"]:
+            # Il file letto finora e' stato ruotato: si finisce di leggerlo dal segmento chiuso.
+            rotated = log_segments.find_segment_by_generation(path, index["generation"])
+            if rotated is not None:
+                index_lines(index, log_segments.read_segment_tail(rotated, index["offset"]))
+            index["generation"] = generation
+            index["offset"] = 0
+    size = path.stat().st_size if path.exists() else 0
+    if size < index["offset"]:
+        # Il log e' stato riscritto o troncato: si riparte da zero.
+        index["offset"] = 0
+        index["keys"] = set()
+    if size <= index["offset"]:
+        return
+    with path.open("rb") as fh:
+        fh.seek(index["offset"])
+        chunk = fh.read(size - index["offset"])
+    index["offset"] += index_lines(index, chunk)
+
+
+def index_lines(index: dict[str, Any], chunk: bytes) -> int:
+    """Indicizza le righe complete del blocco; ritorna i byte consumati."""
+    end = chunk.rfind(b"\n")
+    if end < 0:
+        return 0
+    for line in chunk[:end].splitlines():
+        try:
+            payload = json.loads(line)
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            continue
+        if not isinstance(payload, dict):
+            continue
+        key = message_key(payload.get("chat_id"), payload.get("message_id"))
+        if key:
+            index["keys"].add(key)
+    return end + 1
+
+
+def save_index(path: Path, force: bool = False) -> None:
+    path = Path(path)
+    index = _INDEXES.get(path)
+    if index is None:
+        return
+    with index["lock"]:
+        if not force and time.monotonic() - index["saved_at"] < KEY_INDEX_SAVE_INTERVAL_S:
+            return
+        saved_path = key_index_path(path)
+        tmp_path = saved_path.with_name(f"{saved_path.name}.{os.getpid()}.tmp")
+        tmp_path.write_text(
+            json.dumps({"generation": index["generation"], "offset": index["offset"], "keys": list(index["keys"])}),
+            encoding="utf-8",
+        )
+        tmp_path.replace(saved_path)
+        index["saved_at"] = time.monotonic()
+
+
+def is_logged(path: Path, chat_id: Any, message_id: Any) -> bool:
+    key = message_key(chat_id, message_id)
+    if key is None:
+        return False
+    index = get_index(path)
+    with index["lock"]:
+        if key in index["keys"]:
+            return True
+        with log_segments.file_lock(path):
+            refresh_index(Path(path), index)
+        return key in index["keys"]
+
+
+def logged_keys(path: Path) -> set[tuple[str, str]]:
+    index = get_index(path)
+    with index["lock"], log_segments.file_lock(path):
+        refresh_index(Path(path), index)
+        return set(index["keys"])
+
+
+def append_messages(path: Path, records: Iterable[dict[str, Any]]) -> int:
+    """Appende i record non ancora presenti nel log; ritorna quanti ne ha scritti."""
+    path = Path(path)
+    log_segments.maybe_rotate(path)
+    index = get_index(path)
+    with index["lock"], log_segments.file_lock(path):
+        refresh_index(path, index)
+        lines: list[str] = []
+        batch_keys: set[tuple[str, str]] = set()
+        for record in records:
+            key = message_key(record.get("chat_id"), record.get("message_id"))
+            if key is not None:
+                if key in index["keys"] or key in batch_keys:
+                    continue
+                batch_keys.add(key)
+            lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+        if not lines:
+            return 0
+
+        data = "".join(lines).encode("utf-8")
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            # Dopo refresh_index l'offset e' alla fine dell'ultima riga completa: se il file e'
+            # piu' lungo, una scrittura precedente si e' interrotta a meta' riga. Si va a capo
+            # prima, cosi' la riga monca resta isolata e i lettori la scartano.
+            if os.fstat(fd).st_size > index["offset"]:
+                data = b"\n" + data
+            view = memoryview(data)
+            while view:
+                written = os.write(fd, view)
+                view = view[written:]
+        finally:
+            os.close(fd)
+        # Le righe appena scritte sono in coda al file: l'offset si aggiorna alla prossima lettura.
+        index["keys"].update(batch_keys)
+    save_index(path)
+    return len(lines)
@@ -0,0 +1,105 @@
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+import event_store  # noqa: E402
+import log_segments  # noqa: E402
+import pipeline_blobs  # noqa: E402
+
+
+BATCH_SIZE = 1000
+
+
+def iter_pipeline_records(log_path: Path) -> Iterator[dict[str, Any]]:
+    # Anche i segmenti cold: nel database vanno i record originali, non i riepiloghi compattati.
+    for segment in log_segments.detailed_segment_files(log_path):
+        with log_segments.open_segment(segment) as fh:
+            for line in fh:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    payload = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if isinstance(payload, dict):
+                    yield payload
+
+
+def blob_loader(blob_dir: Path, cache: dict[str, Any]) -> Callable[[str], Any]:
+    """Loader per pipeline_blobs.resolve_blob_refs: nel database i payload stanno inline, come in D1."""
+    def load(digest: str) -> Any:
+        if digest not in cache:
+            try:
+                cache[digest] = pipeline_blobs.read_blob(blob_dir, digest)
+            except (OSError, json.JSONDecodeError):
+                cache[digest] = {"$blob": digest}
+        return cache[digest]
+    return load
+
+
+def parse_args() -> argparse.Namespace:
+    log_dir = Path(os.getenv("RINVIABOT_LOG_DIR", str(ROOT_DIR / "logs")))
+    parser = argparse.ArgumentParser(
+        description="Importa i log pipeline JSONL (anche i segmenti ruotati) nel database SQLite locale degli eventi."
+    )
+    parser.add_argument(
+        "--db",
+        default=os.getenv("RINVIABOT_EVENT_DB", "") or str(log_dir / "pipeline" / "events.sqlite3"),
+    )
+    parser.add_argument("--pipeline-log", default=str(log_dir / "pipeline" / "jsonl" / "pipeline.jsonl"))
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="Importa tutto anche se il database ha gia' eventi (di default solo quelli piu' vecchi del primo gia' presente).",
+    )
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    log_path = Path(args.pipeline_log)
+    blob_dir = log_path.parent.parent / "blobs"
+    conn = event_store.connect(Path(args.db))
+    # Il bot scrive gia' nel database da quando RINVIABOT_EVENT_DB e' attiva: si importa solo
+    # lo storico precedente, cosi' il backfill si puo' rilanciare senza duplicati.
+    cutoff = None if args.all else event_store.oldest_event_ts(conn)
+    started = time.perf_counter()
+    imported = 0
+    skipped = 0
+    blob_cache: dict[str, Any] = {}
+    load_blob = blob_loader(blob_dir, blob_cache)
+    batch: list[dict[str, Any]] = []
+    for record in iter_pipeline_records(log_path):
+        ts = str(record.get("ts") or "")
+        if cutoff and (ts > cutoff or (ts == cutoff and event_store.event_exists(conn, record))):
+            skipped += 1
+            continue
+        batch.append(pipeline_blobs.resolve_blob_refs(record, load_blob))
+        if len(batch) >= BATCH_SIZE:
+            imported += event_store.insert_events(conn, batch)
+            batch.clear()
+            if len(blob_cache) > 10_000:
+                blob_cache.clear()
+    imported += event_store.insert_events(conn, batch)
+    conn.close()
+    print(json.dumps({
+        "db": args.db,
+        "imported": imported,
+        "skipped": skipped,
+        "cutoff": cutoff,
+        "seconds": round(time.perf_counter() - started, 2),
+    }, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import argparse
+import json
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+
+from load_webhook import (
+    BENCH_TOKEN,
+    MESSAGE_SHAPES,
+    ROOT_DIR,
+    FakeTelegramApi,
+    build_update,
+    free_port,
+    start_bot_process,
+)
+
+
+BASELINE_PATH = ROOT_DIR / "benchmarks" / "startup_baseline.json"
+
+
+def measure_cold_start(args: argparse.Namespace) -> dict[str, float]:
+    """Dal lancio del processo al setWebhook e alla prima risposta a un update inviato appena possibile."""
+    with tempfile.TemporaryDirectory(prefix="rinviabot-startup-") as workdir:
+        api = FakeTelegramApi()
+        api.start()
+        port = free_port()
+        chat_id = 20_000_001
+        launched = time.perf_counter()
+        process = start_bot_process(args, api, port, Path(workdir) / "loop-lag.json")
+        try:
+            if not api.webhook_set.wait(args.timeout):
+                raise SystemExit("Il bot non ha chiamato setWebhook in tempo (usa --verbose).")
+            webhook_ready = time.perf_counter()
+            update = build_update(1, chat_id, MESSAGE_SHAPES[0])
+            deadline = launched + args.timeout
+            with httpx.Client(timeout=5.0) as http:
+                while True:
+                    try:
+                        http.post(f"http://127.0.0.1:{port}/{BENCH_TOKEN}", json=update).raise_for_status()
+                        break
+                    except httpx.HTTPError:
+                        if time.perf_counter() > deadline:
+                            raise SystemExit("Il webhook non accetta update (usa --verbose).")
+                        time.sleep(0.01)
+            while chat_id not in api.replies:
+                if time.perf_counter() > deadline:
+                    raise SystemExit("Nessuna risposta al primo update entro il timeout.")
+                time.sleep(0.005)
+        finally:
+            process.terminate()
+            process.wait(timeout=10)
+            api.stop()
+    return {
+        "webhook_ready_ms": (webhook_ready - launched) * 1000,
+        "first_update_ms": (api.replies[chat_id] - launched) * 1000,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmark del cold start: tempo dal lancio di bot.py alla risposta al primo update."
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--baseline", default=str(BASELINE_PATH))
+    parser.add_argument("--max-ratio", type=float, default=1.5, help="Fallisce se la mediana supera la baseline di questo fattore.")
+    parser.add_argument("--min-delta-ms", type=float, default=150.0, help="Ignora regressioni sotto questa differenza assoluta.")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--update-baseline", action="store_true", help="Sovrascrive la baseline con i risultati correnti.")
+    parser.add_argument("--verbose", action="store_true", help="Mostra l'output del processo bot.")
+    args = parser.parse_args()
+    # Il primo update non deve misurare la latenza simulata dei backend.
+    args.llm_latency_ms = 0.0
+    args.calendar_latency_ms = 0.0
+    return args
+
+
+def main() -> None:
+    args = parse_args()
+    runs = [measure_cold_start(args) for _ in range(max(1, args.runs))]
+    results = {
+        metric: statistics.median(run[metric] for run in runs)
+        for metric in ("webhook_ready_ms", "first_update_ms")
+    }
+    baseline_path = Path(args.baseline)
+    baseline = json.loads(baseline_path.read_text(encoding="utf-8")) if baseline_path.exists() else {}
+
+    print(f"{'metrica':<20} {'mediana ms':>11} {'min ms':>9} {'max ms':>9} {'baseline':>9}")
+    print("-" * 62)
+    for metric, value in results.items():
+        values = [run[metric] for run in runs]
+        before = float(baseline.get(metric) or 0)
+        print(f"{metric:<20} {value:>11.0f} {min(values):>9.0f} {max(values):>9.0f} {before:>9.0f}")
+
+    if args.update_baseline:
+        baseline_path.write_text(json.dumps({
+            "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "runs": len(runs),
+            **{metric: round(value, 1) for metric, value in results.items()},
+        }, indent=2) + "\n", encoding="utf-8")
+        print(f"\nBaseline aggiornata: {baseline_path}")
+        return
+
+    if not baseline:
+        print("\nNessuna baseline: esegui con --update-baseline per crearla.")
+        return
+    regressions = [
+        f"{metric}: {float(baseline[metric]):.0f} -> {value:.0f} ms"
+        for metric, value in results.items()
+        if baseline.get(metric)
+        and value > float(baseline[metric]) * args.max_ratio
+        and value - float(baseline[metric]) > args.min_delta_ms
+    ]
+    if regressions:
+        print("\nCold start peggiorato oltre la soglia:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    print(f"\nNessuna regressione oltre x{args.max_ratio:g}.")
+
+
+if __name__ == "__main__":
+    main()
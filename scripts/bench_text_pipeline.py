@@ -0,0 +1,195 @@
+import argparse
+import gc
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from itertools import cycle, islice
+from pathlib import Path
+from typing import Any, Callable
+
+from local_backends import ROOT_DIR, bot, build_standin_parsed_data
+
+
+BENCH_DIR = ROOT_DIR / "benchmarks"
+CORPUS_PATH = BENCH_DIR / "text_corpus.json"
+BASELINE_PATH = BENCH_DIR / "text_pipeline_baseline.json"
+
+
+def load_corpus(path: Path) -> list[tuple[str, str]]:
+    spec = json.loads(path.read_text(encoding="utf-8"))
+    messages = spec.get("messages", [])
+    corpus = [(f"msg-{index:02d}", text) for index, text in enumerate(messages, start=1)]
+    for paste in spec.get("long_pastes", []):
+        if "repeat" in paste:
+            blocks = islice(cycle(messages[:6]), int(paste["repeat"]))
+            corpus.append((paste["name"], paste.get("separator", "\n----\n").join(blocks)))
+        else:
+            corpus.append((paste["name"], paste["text"].format(digits="1 " * int(paste["digits"]))))
+    return corpus
+
+
+def build_cases(corpus: list[tuple[str, str]]) -> dict[str, list[Callable[[], Any]]]:
+    """Una lista di chiamate a zero argomenti per funzione, con gli input gia' preparati."""
+    cases: dict[str, list[Callable[[], Any]]] = {
+        "normalize_message_text": [],
+        "extract_times_from_text": [],
+        "extract_known_judge_mentions": [],
+        "validate_and_normalize_parsed_data": [],
+        "should_require_confirmation": [],
+    }
+    for _, text in corpus:
+        normalized = bot.normalize_message_text(text)
+        analysis = bot.build_message_analysis(text)
+        raw_parsed = build_standin_parsed_data(text)
+        parsed = bot.validate_and_normalize_parsed_data(raw_parsed, normalized)
+        cases["normalize_message_text"].append(lambda text=text: bot.normalize_message_text(text))
+        cases["extract_times_from_text"].append(lambda normalized=normalized: bot.extract_times_from_text(normalized))
+        cases["extract_known_judge_mentions"].append(lambda text=text: bot.extract_known_judge_mentions(text))
+        cases["validate_and_normalize_parsed_data"].append(
+            lambda raw=raw_parsed, normalized=normalized: bot.validate_and_normalize_parsed_data(dict(raw), normalized)
+        )
+        cases["should_require_confirmation"].append(
+            lambda parsed=parsed, analysis=analysis, normalized=normalized: bot.should_require_confirmation(parsed, analysis, normalized)
+        )
+    return cases
+
+
+def measure(calls: list[Callable[[], Any]], min_time: float, repeats: int) -> dict[str, float]:
+    """ns/op: minimo su piu' ripetizioni di un giro completo del corpus; peak KiB/op con tracemalloc."""
+    loops = 1
+    while True:
+        started = time.perf_counter_ns()
+        for _ in range(loops):
+            for call in calls:
+                call()
+        elapsed = time.perf_counter_ns() - started
+        if elapsed >= min_time * 1e9 or loops >= 1 << 20:
+            break
+        loops *= 2
+
+    best = elapsed
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeats):
+            started = time.perf_counter_ns()
+            for _ in range(loops):
+                for call in calls:
+                    call()
+            best = min(best, time.perf_counter_ns() - started)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    worst_single = 0
+    peaks = []
+    for call in calls:
+        started = time.perf_counter_ns()
+        call()
+        worst_single = max(worst_single, time.perf_counter_ns() - started)
+        tracemalloc.start()
+        tracemalloc.reset_peak()
+        call()
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+
+    ops = loops * len(calls)
+    return {
+        "ns_per_op": best / ops,
+        "worst_ns": float(worst_single),
+        "peak_kib_per_op": sum(peaks) / len(peaks) / 1024,
+    }
+
+
+def compare(results: dict[str, dict[str, float]], baseline: dict[str, Any], max_ratio: float, min_delta_ns: float) -> list[str]:
+    regressions = []
+    for name, current in results.items():
+        reference = baseline.get("functions", {}).get(name)
+        if not reference:
+            continue
+        for metric, floor in (("ns_per_op", min_delta_ns), ("worst_ns", min_delta_ns), ("peak_kib_per_op", 1.0)):
+            before = float(reference.get(metric) or 0)
+            after = current[metric]
+            if before and after > before * max_ratio and after - before > floor:
+                regressions.append(f"{name}.{metric}: {before:,.0f} -> {after:,.0f} (x{after / before:.1f})")
+    return regressions
+
+
+def render_table(results: dict[str, dict[str, float]], baseline: dict[str, Any]) -> str:
+    reference = baseline.get("functions", {})
+    lines = [
+        f"{'funzione':<36} {'ns/op':>12} {'baseline':>12} {'ratio':>7} {'worst µs':>10} {'peak KiB/op':>12}",
+        "-" * 94,
+    ]
+    for name, current in results.items():
+        before = float(reference.get(name, {}).get("ns_per_op") or 0)
+        ratio = f"{current['ns_per_op'] / before:.2f}" if before else "-"
+        lines.append(
+            f"{name:<36} {current['ns_per_op']:>12,.0f} {before:>12,.0f} {ratio:>7} "
+            f"{current['worst_ns'] / 1000:>10,.1f} {current['peak_kib_per_op']:>12,.1f}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmark degli stadi deterministici di bot.py con confronto sulla baseline salvata."
+    )
+    parser.add_argument("--corpus", default=str(CORPUS_PATH))
+    parser.add_argument("--baseline", default=str(BASELINE_PATH))
+    parser.add_argument("--min-time", type=float, default=0.2, help="Durata minima di ogni misura in secondi.")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument(
+        "--max-ratio",
+        type=float,
+        default=3.0,
+        help="Fallisce se una metrica supera la baseline di questo fattore.",
+    )
+    parser.add_argument(
+        "--min-delta-us",
+        type=float,
+        default=50.0,
+        help="Ignora le regressioni sotto questa differenza assoluta, per non inseguire il rumore.",
+    )
+    parser.add_argument("--update-baseline", action="store_true", help="Sovrascrive la baseline con i risultati correnti.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    corpus = load_corpus(Path(args.corpus))
+    cases = build_cases(corpus)
+    baseline_path = Path(args.baseline)
+    baseline = json.loads(baseline_path.read_text(encoding="utf-8")) if baseline_path.exists() else {}
+
+    results = {name: measure(calls, args.min_time, args.repeats) for name, calls in cases.items()}
+    print(f"Corpus: {len(corpus)} messaggi ({sum(len(text) for _, text in corpus):,} caratteri)")
+    print(render_table(results, baseline))
+
+    if args.update_baseline:
+        baseline_path.write_text(json.dumps({
+            "generated_at": bot.utc_now_iso(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "corpus_size": len(corpus),
+            "functions": {name: {key: round(value, 1) for key, value in metrics.items()} for name, metrics in results.items()},
+        }, indent=2) + "\n", encoding="utf-8")
+        print(f"\nBaseline aggiornata: {baseline_path}")
+        return
+
+    if not baseline:
+        print("\nNessuna baseline: esegui con --update-baseline per crearla.")
+        return
+    regressions = compare(results, baseline, args.max_ratio, args.min_delta_us * 1000)
+    if regressions:
+        print("\nRegressioni oltre la soglia:")
+        for line in regressions:
+            print(f"  {line}")
+        sys.exit(1)
+    print(f"\nNessuna regressione oltre x{args.max_ratio:g}.")
+
+
+if __name__ == "__main__":
+    main()
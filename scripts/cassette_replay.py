@@ -0,0 +1,102 @@
+import argparse
+import json
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+import log_segments  # noqa: E402
+
+
+PRODUCTION_LOG_DIR = Path(os.getenv("RINVIABOT_LOG_DIR", str(ROOT_DIR / "logs")))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Riesegue offline una trace di produzione usando le cassette Claude/Calendar registrate."
+    )
+    parser.add_argument("trace_id", help="trace_id da riprodurre, es. tg-<chat>-<message>")
+    parser.add_argument(
+        "--zero-latency",
+        action="store_true",
+        help="Riproduce le risposte senza attendere la latenza originale.",
+    )
+    parser.add_argument(
+        "--pipeline-log",
+        default=str(PRODUCTION_LOG_DIR / "pipeline" / "jsonl" / "pipeline.jsonl"),
+        help="Log pipeline da cui recuperare il messaggio originale della trace.",
+    )
+    parser.add_argument(
+        "--cassette-dir",
+        default=str(PRODUCTION_LOG_DIR / "cassettes"),
+        help="Cartella con le cassette .jsonl.gz registrate in produzione.",
+    )
+    parser.add_argument(
+        "--message",
+        default="",
+        help="Testo del messaggio, se la trace non e' presente nel log pipeline locale.",
+    )
+    return parser.parse_args()
+
+
+def find_trace_message(pipeline_log: Path, trace_id: str) -> str:
+    # Anche i segmenti ruotati e quelli compattati, dove della trace resta il trace_summary col testo.
+    for segment in log_segments.segment_files(pipeline_log):
+        try:
+            fh = log_segments.open_segment(segment)
+        except FileNotFoundError:
+            continue
+        with fh:
+            for line in fh:
+                if trace_id not in line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("trace_id") == trace_id and record.get("stage") in {"telegram_received", "trace_summary"}:
+                    return str(record.get("text") or "")
+    return ""
+
+
+def main() -> None:
+    args = parse_args()
+    message_text = args.message or find_trace_message(Path(args.pipeline_log), args.trace_id)
+    if not message_text:
+        raise SystemExit(f"Messaggio originale non trovato per {args.trace_id}: usa --message.")
+
+    # I log della riproduzione restano separati da quelli di produzione.
+    os.environ["RINVIABOT_CASSETTE_MODE"] = "replay_zero" if args.zero_latency else "replay"
+    os.environ["RINVIABOT_CASSETTE_DIR"] = str(Path(args.cassette_dir).resolve())
+    os.environ["RINVIABOT_LOG_DIR"] = str(ROOT_DIR / "replays" / "outputs" / "cassette-logs")
+    os.environ["REMOTE_LOG_ENDPOINT"] = ""
+    import bot
+
+    started = time.perf_counter()
+    parsed_data = bot.parse_message_with_ai(message_text, trace_id=args.trace_id)
+    created: list[Any] = []
+    if parsed_data and parsed_data.get("tipo") == "rinvio":
+        for evento in parsed_data.get("eventi", []):
+            event_data = bot.format_calendar_event(evento)
+            if event_data:
+                created.append(bot.create_google_calendar_event(event_data, trace_id=args.trace_id))
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    print(json.dumps(bot.safe_json_value({
+        "trace_id": args.trace_id,
+        "cassette_mode": bot.CASSETTE_MODE,
+        "elapsed_ms": round(elapsed_ms, 2),
+        "parsed_data": parsed_data,
+        "calendar_events": created,
+        "pipeline_log": str(bot.PIPELINE_LOG_PATH),
+    }), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
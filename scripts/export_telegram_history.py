@@ -3,22 +3,31 @@ import asyncio
 import json
 import os
 import re
+import sys
 from datetime import datetime
 from hashlib import sha256
 from pathlib import Path
 from typing import Any
 
 import pytz
-from telethon import TelegramClient
+from telethon import TelegramClient, utils as telethon_utils
 from telethon.tl.types import Channel, Chat, User
 
 
-ROME_TZ = pytz.timezone("Europe/Rome")
 ROOT_DIR = Path(__file__).resolve().parent.parent
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+import raw_message_log  # noqa: E402
+
+
+ROME_TZ = pytz.timezone("Europe/Rome")
 LOG_DIR = ROOT_DIR / "logs"
 RAW_LOG_PATH = LOG_DIR / "telegram" / "raw" / "messages.jsonl"
 EXPORT_DIR = ROOT_DIR / "exports" / "telegram-history"
 SESSION_DIR = ROOT_DIR / ".telegram-userbot"
+# Messaggi scritti negli export (e nel checkpoint) a ogni blocco.
+EXPORT_BATCH_SIZE = 200
 
 
 def utc_now_iso() -> str:
@@ -38,11 +47,6 @@ def json_dumps(payload: Any) -> str:
     return json.dumps(payload, ensure_ascii=False, sort_keys=False)
 
 
-def append_jsonl(path: Path, payload: dict[str, Any]) -> None:
-    with path.open("a", encoding="utf-8") as fh:
-        fh.write(json_dumps(payload) + "\n")
-
-
 def sanitize_component(value: str) -> str:
     cleaned = re.sub(r"[^A-Za-z0-9_.-]+", "-", value)
     return cleaned.strip("-") or "telegram-chat"
@@ -54,17 +58,22 @@ def stable_trace_id(chat_id: Any, message_id: Any, message_date: str, text: str)
     return f"hist-{chat_id}-{message_id}-{digest}"
 
 
-def render_markdown(chat_meta: dict[str, Any], messages: list[dict[str, Any]]) -> str:
+def render_markdown_header(chat_meta: dict[str, Any]) -> list[str]:
     lines = [
         "# Telegram History Export",
         "",
         f"- Chat title: `{chat_meta.get('title') or 'N/A'}`",
         f"- Chat id: `{chat_meta.get('chat_id')}`",
         f"- Exported at: `{chat_meta.get('exported_at')}`",
-        f"- Messages: `{len(messages)}`",
-        "",
     ]
+    if "message_count" in chat_meta:
+        lines.append(f"- Messages: `{chat_meta['message_count']}`")
+    lines.append("")
+    return lines
+
 
+def render_markdown_items(messages: list[dict[str, Any]]) -> list[str]:
+    lines: list[str] = []
     for item in messages:
         lines.extend([
             f"## {item['message_id']}",
@@ -76,10 +85,88 @@ def render_markdown(chat_meta: dict[str, Any], messages: list[dict[str, Any]]) -
             item.get("text") or "_Messaggio vuoto o non testuale_",
             "",
         ])
+    return lines
 
+
+def render_markdown(chat_meta: dict[str, Any], messages: list[dict[str, Any]]) -> str:
+    lines = render_markdown_header(dict(chat_meta, message_count=len(messages))) + render_markdown_items(messages)
     return "\n".join(lines).strip() + "\n"
 
 
+def export_paths(base_name: str) -> dict[str, Path]:
+    return {
+        "json": EXPORT_DIR / f"{base_name}.json",
+        "jsonl": EXPORT_DIR / f"{base_name}.jsonl",
+        "markdown": EXPORT_DIR / f"{base_name}.md",
+    }
+
+
+def open_at_offset(path: Path, offset: int) -> Any:
+    """Apre il file in scrittura troncandolo all'offset: quello che segue non era ancora nel checkpoint."""
+    fh = path.open("r+b" if path.exists() else "w+b")
+    fh.seek(offset)
+    fh.truncate()
+    return fh
+
+
+def append_export_batch(
+    paths: dict[str, Path],
+    chat_meta: dict[str, Any],
+    items: list[dict[str, Any]],
+    state: dict[str, Any],
+) -> None:
+    """Appende un blocco di messaggi ai tre export partendo dagli offset salvati in state.
+
+    Il JSON resta valido dopo ogni blocco: l'array "messages" viene prima, e dopo l'ultimo
+    elemento si riscrive solo la coda con i metadati della chat. Se il processo si ferma prima
+    del checkpoint, al giro successivo i file tornano agli offset salvati e il blocco viene
+    riscritto, senza duplicati.
+    """
+    offsets = state.setdefault("offsets", {"json": 0, "jsonl": 0, "markdown": 0})
+    count = int(state.get("message_count") or 0)
+
+    with open_at_offset(paths["jsonl"], offsets["jsonl"]) as fh:
+        for item in items:
+            fh.write((json_dumps(item) + "\n").encode("utf-8"))
+        offsets["jsonl"] = fh.tell()
+
+    with open_at_offset(paths["markdown"], offsets["markdown"]) as fh:
+        lines = render_markdown_items(items)
+        if offsets["markdown"] == 0:
+            lines = render_markdown_header({key: value for key, value in chat_meta.items() if key != "message_count"}) + lines
+        if lines:
+            fh.write(("\n".join(lines) + "\n").encode("utf-8"))
+        offsets["markdown"] = fh.tell()
+
+    with open_at_offset(paths["json"], offsets["json"]) as fh:
+        if offsets["json"] == 0:
+            fh.write(b'{\n  "messages": [')
+        for index, item in enumerate(items):
+            separator = "," if count + index else ""
+            fh.write(f"{separator}\n    {json_dumps(item)}".encode("utf-8"))
+        offsets["json"] = fh.tell()
+        meta = json.dumps(dict(chat_meta, message_count=count + len(items)), ensure_ascii=False, indent=2)
+        meta = meta.replace("\n", "\n  ")
+        fh.write(f'\n  ],\n  "chat": {meta}\n}}\n'.encode("utf-8"))
+
+    state["message_count"] = count + len(items)
+
+
+def load_checkpoint(path: Path) -> dict[str, Any]:
+    if not path.exists():
+        return {}
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def save_checkpoint(path: Path, payload: dict[str, Any]) -> None:
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(payload, ensure_ascii=False, indent=2), encoding="utf-8")
+    tmp_path.replace(path)
+
+
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Esporta la history di una chat Telegram via MTProto e la salva nel formato del repo."
@@ -107,6 +194,16 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Aggiunge i messaggi esportati a logs/telegram/raw/messages.jsonl",
     )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Scrive gli export a blocchi mentre arrivano i messaggi, con checkpoint per riprendere un export interrotto.",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Con --stream: ignora un checkpoint esistente e ricomincia un export nuovo.",
+    )
     return parser.parse_args()
 
 
@@ -126,10 +223,66 @@ def entity_title(entity: Any) -> str:
     return str(getattr(entity, "id", "unknown"))
 
 
+def entity_chat_id(entity: Any, fallback: Any) -> str:
+    """Id "marcato" (-100... per canali e supergruppi) come update.effective_chat.id nel bot ed event.chat_id
+    nel live log: raw_message_log deduplica su (chat_id, message_id) tra tutti gli scrittori."""
+    try:
+        return str(telethon_utils.get_peer_id(entity))
+    except (TypeError, ValueError):
+        return str(getattr(entity, "id", fallback))
+
+
 def entity_username(entity: Any) -> str:
     return str(getattr(entity, "username", "") or "")
 
 
+async def get_cached_sender(message: Any, cache: dict[Any, Any]) -> Any:
+    """get_sender una sola volta per mittente: nei gruppi scrivono sempre le stesse persone."""
+    sender_id = getattr(message, "sender_id", None)
+    if sender_id is not None and sender_id in cache:
+        return cache[sender_id]
+    sender = await message.get_sender()
+    if sender_id is not None:
+        cache[sender_id] = sender
+    return sender
+
+
+def build_message_item(message: Any, chat_id: Any, sender: Any) -> dict[str, Any]:
+    text = extract_text(message)
+    date_utc = message.date
+    if date_utc.tzinfo is None:
+        date_utc = pytz.utc.localize(date_utc)
+    date_local = date_utc.astimezone(ROME_TZ)
+    ts = date_utc.replace(microsecond=0).isoformat().replace("+00:00", "Z")
+    return {
+        "trace_id": stable_trace_id(chat_id, message.id, ts, text),
+        "chat_id": str(chat_id),
+        "message_id": message.id,
+        "date_utc": ts,
+        "date_local": date_local.strftime("%d/%m/%Y %H:%M:%S %Z"),
+        "sender_id": getattr(sender, "id", None) if sender else None,
+        "sender_name": entity_title(sender) if sender else "",
+        "sender_username": entity_username(sender) if sender else "",
+        "text": text,
+        "reply_to_msg_id": getattr(message, "reply_to_msg_id", None),
+        "views": getattr(message, "views", None),
+        "forwards": getattr(message, "forwards", None),
+    }
+
+
+def build_raw_log_record(item: dict[str, Any]) -> dict[str, Any]:
+    return {
+        "ts": item["date_utc"],
+        "trace_id": item["trace_id"],
+        "chat_id": item["chat_id"],
+        "message_id": item["message_id"],
+        "user_id": item["sender_id"],
+        "username": item["sender_username"] or item["sender_name"],
+        "text": item["text"],
+        "source": "telegram_history_import",
+    }
+
+
 async def resolve_entity(client: TelegramClient, chat_ref: str) -> Any:
     try:
         return await client.get_entity(chat_ref)
@@ -150,6 +303,72 @@ async def resolve_entity(client: TelegramClient, chat_ref: str) -> Any:
     raise ValueError(f"Cannot find any entity corresponding to {chat_ref!r}")
 
 
+def stream_checkpoint_path(chat_id: Any) -> Path:
+    return EXPORT_DIR / f"{sanitize_component(str(chat_id))}.stream-checkpoint.json"
+
+
+async def stream_history(client: TelegramClient, entity: Any, args: argparse.Namespace) -> dict[str, Path]:
+    """Export a blocchi: in memoria resta un solo blocco, e dopo ogni blocco si salva il checkpoint."""
+    chat_title = entity_title(entity)
+    chat_id = entity_chat_id(entity, args.chat)
+    checkpoint_path = stream_checkpoint_path(chat_id)
+    legacy_checkpoint_path = stream_checkpoint_path(getattr(entity, "id", chat_id))
+    if not checkpoint_path.exists() and legacy_checkpoint_path.exists():
+        # Export interrotto prima degli id marcati: si riprende dallo stesso checkpoint.
+        legacy_checkpoint_path.replace(checkpoint_path)
+    state = {} if args.restart else load_checkpoint(checkpoint_path)
+    resumed = bool(state)
+    if not state:
+        state = {
+            "base_name": f"{sanitize_component(chat_id)}-{sanitize_component(chat_title)}-{datetime.now(ROME_TZ).strftime('%Y%m%d-%H%M%S')}",
+            "min_id": 0,
+            "message_count": 0,
+            "limit": args.limit,
+            "started_at": utc_now_iso(),
+        }
+    paths = export_paths(state["base_name"])
+    chat_meta = {
+        "chat_id": chat_id,
+        "title": chat_title,
+        "username": entity_username(entity),
+        "exported_at": state["started_at"],
+        "source": "telegram-mtproto-userbot",
+    }
+    limit = int(state.get("limit") or 0)
+    remaining = max(0, limit - state["message_count"]) if limit else None
+    if resumed:
+        print(f"Ripresa dell'export {state['base_name']} dal messaggio {state['min_id']} ({state['message_count']} gia' scritti)")
+
+    batch: list[dict[str, Any]] = []
+    sender_cache: dict[Any, Any] = {}
+
+    def flush() -> None:
+        append_export_batch(paths, chat_meta, batch, state)
+        if args.append_raw_log:
+            # Dedup in raw_message_log: anche i messaggi scritti prima di un'interruzione non si ripetono.
+            raw_message_log.append_messages(RAW_LOG_PATH, [build_raw_log_record(item) for item in batch])
+        if batch:
+            state["min_id"] = batch[-1]["message_id"]
+        save_checkpoint(checkpoint_path, state)
+        batch.clear()
+
+    if remaining != 0:
+        async for message in client.iter_messages(entity, limit=remaining, min_id=int(state["min_id"]), reverse=True):
+            if not getattr(message, "id", None):
+                continue
+            sender = await get_cached_sender(message, sender_cache)
+            batch.append(build_message_item(message, chat_id, sender))
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                flush()
+    flush()
+    checkpoint_path.unlink(missing_ok=True)
+
+    return {
+        **paths,
+        "raw_log": RAW_LOG_PATH,
+    }
+
+
 async def export_history(args: argparse.Namespace) -> dict[str, Path]:
     ensure_directories()
 
@@ -162,55 +381,25 @@ async def export_history(args: argparse.Namespace) -> dict[str, Path]:
 
     try:
         entity = await resolve_entity(client, args.chat)
+        if args.stream:
+            return await stream_history(client, entity, args)
+
         chat_title = entity_title(entity)
-        chat_id = getattr(entity, "id", args.chat)
+        chat_id = entity_chat_id(entity, args.chat)
         exported_at = utc_now_iso()
 
         messages: list[dict[str, Any]] = []
         raw_log_records: list[dict[str, Any]] = []
+        sender_cache: dict[Any, Any] = {}
 
         async for message in client.iter_messages(entity, limit=args.limit or None, reverse=True):
             if not getattr(message, "id", None):
                 continue
 
-            sender = await message.get_sender()
-            sender_name = entity_title(sender) if sender else ""
-            sender_username = entity_username(sender) if sender else ""
-            sender_id = getattr(sender, "id", None) if sender else None
-            text = extract_text(message)
-            date_utc = message.date
-            if date_utc.tzinfo is None:
-                date_utc = pytz.utc.localize(date_utc)
-            date_local = date_utc.astimezone(ROME_TZ)
-            ts = date_utc.replace(microsecond=0).isoformat().replace("+00:00", "Z")
-            trace_id = stable_trace_id(chat_id, message.id, ts, text)
-
-            item = {
-                "trace_id": trace_id,
-                "chat_id": str(chat_id),
-                "message_id": message.id,
-                "date_utc": ts,
-                "date_local": date_local.strftime("%d/%m/%Y %H:%M:%S %Z"),
-                "sender_id": sender_id,
-                "sender_name": sender_name,
-                "sender_username": sender_username,
-                "text": text,
-                "reply_to_msg_id": getattr(message, "reply_to_msg_id", None),
-                "views": getattr(message, "views", None),
-                "forwards": getattr(message, "forwards", None),
-            }
+            sender = await get_cached_sender(message, sender_cache)
+            item = build_message_item(message, chat_id, sender)
             messages.append(item)
-
-            raw_log_records.append({
-                "ts": ts,
-                "trace_id": trace_id,
-                "chat_id": str(chat_id),
-                "message_id": message.id,
-                "user_id": sender_id,
-                "username": sender_username or sender_name,
-                "text": text,
-                "source": "telegram_history_import",
-            })
+            raw_log_records.append(build_raw_log_record(item))
 
         chat_meta = {
             "chat_id": str(chat_id),
@@ -236,8 +425,7 @@ async def export_history(args: argparse.Namespace) -> dict[str, Path]:
         md_path.write_text(render_markdown(chat_meta, messages), encoding="utf-8")
 
         if args.append_raw_log:
-            for record in raw_log_records:
-                append_jsonl(RAW_LOG_PATH, record)
+            raw_message_log.append_messages(RAW_LOG_PATH, raw_log_records)
 
         return {
             "json": json_path,
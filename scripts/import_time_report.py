@@ -0,0 +1,99 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from pathlib import Path
+from typing import Any
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def measure_imports(module: str) -> list[dict[str, Any]]:
+    """Una riga per modulo importato: tempo proprio, cumulativo (ms) e profondita' nell'albero."""
+    env = dict(os.environ)
+    # Con la chiave presente un eventuale client costruito all'import comparirebbe nel report.
+    env.setdefault("ANTHROPIC_API_KEY", "import-time-report")
+    env["REMOTE_LOG_ENDPOINT"] = ""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=str(ROOT_DIR),
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    rows = []
+    for line in completed.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        rows.append({
+            "module": name,
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+            "depth": len(indent) // 2,
+        })
+    return rows
+
+
+def merge_runs(runs: list[list[dict[str, Any]]]) -> dict[str, dict[str, Any]]:
+    """Minimo per modulo su piu' esecuzioni, per togliere il rumore del filesystem."""
+    merged: dict[str, dict[str, Any]] = {}
+    for rows in runs:
+        for row in rows:
+            current = merged.get(row["module"])
+            if current is None or row["cumulative_ms"] < current["cumulative_ms"]:
+                merged[row["module"]] = dict(row)
+    return merged
+
+
+def render_report(merged: dict[str, dict[str, Any]], module: str, top: int) -> str:
+    root = merged.get(module)
+    direct = sorted(
+        (row for row in merged.values() if row["depth"] == 1),
+        key=lambda row: -row["cumulative_ms"],
+    )
+    by_self = sorted(merged.values(), key=lambda row: -row["self_ms"])
+    lines = [
+        f"import {module}: {root['cumulative_ms']:.1f} ms totali, {root['self_ms']:.1f} ms nel modulo stesso" if root else f"import {module}",
+        "",
+        f"{'import diretti':<44} {'cumul. ms':>10}",
+        "-" * 55,
+    ]
+    lines.extend(f"{row['module']:<44} {row['cumulative_ms']:>10.1f}" for row in direct[:top])
+    lines.extend([
+        "",
+        f"{'moduli piu lenti (tempo proprio)':<44} {'self ms':>10}",
+        "-" * 55,
+    ])
+    lines.extend(f"{row['module']:<44} {row['self_ms']:>10.1f}" for row in by_self[:top])
+    return "\n".join(lines)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Report del tempo di import per modulo (python -X importtime), per tenere d'occhio il cold start."
+    )
+    parser.add_argument("--module", default="bot")
+    parser.add_argument("--runs", type=int, default=3, help="Esecuzioni da cui prendere il minimo per modulo.")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--json", action="store_true", help="Stampa i tempi per modulo in JSON.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    merged = merge_runs([measure_imports(args.module) for _ in range(max(1, args.runs))])
+    if args.json:
+        print(json.dumps(sorted(merged.values(), key=lambda row: -row["cumulative_ms"]), indent=2))
+        return
+    print(render_report(merged, args.module, args.top))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Optional
+from urllib.parse import parse_qs
+
+import httpx
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+SCRIPT_PATH = Path(__file__).resolve()
+BENCH_TOKEN = "123456:bench-token"
+
+# Forme di messaggio reali (README, prompt e fixture di replay).
+MESSAGE_SHAPES = [
+    "Serafini: 4264/2020 rgnr - 20/09/2026 h 10.30 \ntesti Folcarelli diffidati",
+    "GUBIOTTI TRIBUNALE ROMA 26.03.2026 h 11.15 sez V 001966/23 RG",
+    "Rossi Sodani rinvio al 15/3/27 h 10 esame imputato",
+    "Bianchi Farinella 12/10/2026 h 9.30 esame testi\n----\nVerdi Sodani 14/10/2026 h 12 discussione",
+    "Neri collegio pres. Cirillo 03/02/2027 ore 9 discussione avv. Candeloro",
+    "Rossi Sodani condanna 8 mesi pena sospesa",
+    "Gialli riserva",
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def load_corpus() -> list[str]:
+    corpus = list(MESSAGE_SHAPES)
+    for path in sorted((ROOT_DIR / "replays" / "inputs").glob("*.json")):
+        try:
+            message = json.loads(path.read_text(encoding="utf-8")).get("message")
+        except (OSError, json.JSONDecodeError):
+            continue
+        if message and message not in corpus:
+            corpus.append(message)
+    return corpus
+
+
+class FakeTelegramApi:
+    """Bot API minima: risponde ai metodi usati dal bot e registra quando arriva ogni risposta."""
+
+    def __init__(self) -> None:
+        self.port = free_port()
+        self.replies: dict[int, float] = {}
+        self.webhook_set = threading.Event()
+        self._message_ids = 0
+        self._lock = threading.Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format: str, *args: Any) -> None:
+                return
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length).decode("utf-8") if length else ""
+                params = {key: values[0] for key, values in parse_qs(body).items()}
+                method = self.path.rsplit("/", 1)[-1]
+                payload = json.dumps({"ok": True, "result": api.handle(method, params)}).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        self.server.daemon_threads = True
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    def handle(self, method: str, params: dict[str, str]) -> Any:
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "RinviaBench", "username": "rinviabench_bot"}
+        if method == "setWebhook":
+            self.webhook_set.set()
+            return True
+        if method in {"sendMessage", "editMessageText"}:
+            chat_id = int(json.loads(params.get("chat_id", "0")))
+            with self._lock:
+                self.replies.setdefault(chat_id, time.perf_counter())
+                self._message_ids += 1
+                message_id = self._message_ids
+            return {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": params.get("text", ""),
+            }
+        return True
+
+    def start(self) -> None:
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self) -> None:
+        self.server.shutdown()
+
+
+def build_update(update_id: int, chat_id: int, text: str) -> dict[str, Any]:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": "Bench"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "Bench"},
+            "text": text,
+        },
+    }
+
+
+async def run_load(args: argparse.Namespace, api: FakeTelegramApi, webhook_url: str) -> dict[str, Any]:
+    corpus = load_corpus()
+    rng = random.Random(args.seed)
+    sent: dict[int, float] = {}
+    post_latencies: list[float] = []
+    post_errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+    total = int(args.rate * args.duration)
+    interval = 1.0 / args.rate if args.rate > 0 else 0.0
+
+    async with httpx.AsyncClient(timeout=args.timeout) as http:
+        async def post(update_id: int) -> None:
+            nonlocal post_errors
+            chat_id = 10_000_000 + update_id
+            update = build_update(update_id, chat_id, rng.choice(corpus))
+            async with semaphore:
+                started = time.perf_counter()
+                sent[chat_id] = started
+                try:
+                    response = await http.post(webhook_url, json=update)
+                    response.raise_for_status()
+                except httpx.HTTPError:
+                    post_errors += 1
+                    return
+                post_latencies.append((time.perf_counter() - started) * 1000)
+
+        load_started = time.perf_counter()
+        tasks = []
+        for update_id in range(1, total + 1):
+            target = load_started + (update_id - 1) * interval
+            delay = target - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(post(update_id)))
+        await asyncio.gather(*tasks)
+
+    deadline = time.perf_counter() + args.drain_timeout
+    while time.perf_counter() < deadline and len(api.replies) < len(sent) - post_errors:
+        await asyncio.sleep(0.05)
+
+    latencies = [
+        (api.replies[chat_id] - started) * 1000
+        for chat_id, started in sent.items()
+        if chat_id in api.replies
+    ]
+    finished_at = max(api.replies.values()) if api.replies else time.perf_counter()
+    wall_s = max(1e-9, finished_at - load_started)
+    return {
+        "updates_sent": len(sent),
+        "post_errors": post_errors,
+        "replies": len(latencies),
+        "wall_s": wall_s,
+        "throughput_msg_s": len(latencies) / wall_s,
+        "e2e_ms": latencies,
+        "post_ms": post_latencies,
+    }
+
+
+def wait_for_port(port: int, timeout: float) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(("127.0.0.1", port)) == 0:
+                return True
+        time.sleep(0.05)
+    return False
+
+
+def start_bot_process(args: argparse.Namespace, api: FakeTelegramApi, port: int, lag_file: Path) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_BOT_TOKEN": BENCH_TOKEN,
+        "ANTHROPIC_API_KEY": "bench",
+        "WEBHOOK_URL": f"http://127.0.0.1:{port}",
+        "PORT": str(port),
+        "TELEGRAM_API_BASE_URL": api.base_url,
+        "RINVIABOT_LOG_DIR": str(lag_file.parent / "logs"),
+        "RINVIABOT_BENCH_LAG_FILE": str(lag_file),
+        "REMOTE_LOG_ENDPOINT": "",
+        "RINVIABOT_CASSETTE_MODE": "",
+        "RINVIABOT_KEEPALIVE_INTERVAL_S": "0",
+    })
+    command = [
+        sys.executable,
+        str(SCRIPT_PATH),
+        "--serve",
+        "--llm-latency-ms", str(args.llm_latency_ms),
+        "--calendar-latency-ms", str(args.calendar_latency_ms),
+    ]
+    stdout = None if args.verbose else subprocess.DEVNULL
+    return subprocess.Popen(command, env=env, cwd=str(lag_file.parent), stdout=stdout, stderr=stdout)
+
+
+def serve(args: argparse.Namespace) -> None:
+    """Avvia bot.py in modalita' webhook con Claude e Calendar locali e misura il lag dell'event loop."""
+    sys.path.insert(0, str(SCRIPT_PATH.parent))
+    from local_backends import LocalAnthropicStandIn, LocalCalendarStandIn, bot, install_local_backends
+
+    install_local_backends(
+        LocalAnthropicStandIn(latency_s=args.llm_latency_ms / 1000),
+        LocalCalendarStandIn(latency_s=args.calendar_latency_ms / 1000),
+    )
+    lag_file = Path(os.environ["RINVIABOT_BENCH_LAG_FILE"])
+    lag_samples: list[float] = []
+
+    async def monitor_loop_lag() -> None:
+        period = 0.05
+        last_flush = time.perf_counter()
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(period)
+            lag_samples.append(max(0.0, (time.perf_counter() - started - period) * 1000))
+            if time.perf_counter() - last_flush >= 0.5:
+                lag_file.write_text(json.dumps(lag_samples), encoding="utf-8")
+                last_flush = time.perf_counter()
+
+    async def post_init(application: Any) -> None:
+        application.create_task(monitor_loop_lag())
+
+    application = bot.build_application()
+    application.post_init = post_init
+    bot.ensure_runtime_directories()
+    bot.run_application(application)
+
+
+def render_report(result: dict[str, Any], lag_ms: list[float], args: argparse.Namespace) -> str:
+    def row(label: str, values: list[float]) -> str:
+        if not values:
+            return f"{label:<22} {'-':>9} {'-':>9} {'-':>9} {'-':>9}"
+        return (
+            f"{label:<22} {percentile(values, 50):>9.1f} {percentile(values, 95):>9.1f} "
+            f"{percentile(values, 99):>9.1f} {max(values):>9.1f}"
+        )
+
+    return "\n".join([
+        f"Target: {args.rate:.1f} msg/s x {args.duration:.0f}s, concorrenza {args.concurrency}, "
+        f"Claude {args.llm_latency_ms:.0f} ms, Calendar {args.calendar_latency_ms:.0f} ms",
+        f"Inviati: {result['updates_sent']} | errori POST: {result['post_errors']} | risposte: {result['replies']}",
+        f"Throughput: {result['throughput_msg_s']:.2f} msg/s in {result['wall_s']:.1f}s",
+        "",
+        f"{'ms':<22} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}",
+        row("end-to-end", result["e2e_ms"]),
+        row("webhook POST", result["post_ms"]),
+        row("event-loop lag", lag_ms),
+    ])
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Genera traffico Telegram sintetico contro il webhook del bot avviato in locale."
+    )
+    parser.add_argument("--rate", type=float, default=5.0, help="Update al secondo.")
+    parser.add_argument("--duration", type=float, default=10.0, help="Durata del carico in secondi.")
+    parser.add_argument("--concurrency", type=int, default=8, help="POST webhook contemporanei massimi.")
+    parser.add_argument("--llm-latency-ms", type=float, default=800.0, help="Latenza dello stand-in Claude.")
+    parser.add_argument("--calendar-latency-ms", type=float, default=250.0, help="Latenza dello stand-in Calendar.")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Timeout di ogni POST al webhook.")
+    parser.add_argument("--drain-timeout", type=float, default=60.0, help="Attesa massima delle risposte finali.")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", action="store_true", help="Stampa anche il risultato grezzo in JSON.")
+    parser.add_argument("--verbose", action="store_true", help="Mostra l'output del processo bot.")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if args.serve:
+        serve(args)
+        return
+
+    with tempfile.TemporaryDirectory(prefix="rinviabot-load-") as workdir:
+        lag_file = Path(workdir) / "loop-lag.json"
+        api = FakeTelegramApi()
+        api.start()
+        port = free_port()
+        process: Optional[subprocess.Popen] = start_bot_process(args, api, port, lag_file)
+        try:
+            if not api.webhook_set.wait(30) or not wait_for_port(port, 10):
+                raise SystemExit("Il bot non ha aperto il webhook entro 30s (usa --verbose).")
+            result = asyncio.run(run_load(args, api, f"http://127.0.0.1:{port}/{BENCH_TOKEN}"))
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            api.stop()
+        lag_ms = json.loads(lag_file.read_text(encoding="utf-8")) if lag_file.exists() else []
+
+    print(render_report(result, lag_ms, args))
+    if args.json:
+        print(json.dumps(dict(result, loop_lag_ms=lag_ms)))
+
+
+if __name__ == "__main__":
+    main()
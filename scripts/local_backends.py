@@ -0,0 +1,156 @@
+import json
+import re
+import sys
+import threading
+import time
+from itertools import count
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+import bot  # noqa: E402
+
+
+MESSAGE_SECTION_PATTERNS = [
+    r"Nuova riscrittura di Fabio:\n(.*?)\n\nProduci la lettura",
+    r"Messaggio originale:\n(.*?)\n\nMessaggio normalizzato:",
+]
+
+
+def extract_message_from_prompt(prompt: str) -> str:
+    for pattern in MESSAGE_SECTION_PATTERNS:
+        match = re.search(pattern, prompt or "", flags=re.DOTALL)
+        if match:
+            return match.group(1)
+    return prompt or ""
+
+
+def build_standin_parsed_data(message_text: str) -> dict[str, Any]:
+    """Lettura deterministica costruita solo con gli estrattori locali di bot.py."""
+    return bot.build_local_parsed_data(message_text)
+
+
+def compact_standin_response(parsed_data: dict[str, Any]) -> dict[str, Any]:
+    """La lettura locale nel formato compatto che il prompt chiede a Claude."""
+    codes = {tipo: code for code, tipo in bot.COMPACT_TIPI.items()}
+    compact: dict[str, Any] = {"t": codes.get(parsed_data.get("tipo"), parsed_data.get("tipo"))}
+    if parsed_data.get("tipo") == "rinvio":
+        compact["c"] = parsed_data.get("confidence")
+        compact["e"] = [
+            {key: evento[name] for key, name in bot.COMPACT_EVENT_KEYS.items() if evento.get(name)}
+            for evento in parsed_data.get("eventi", [])
+        ]
+        if parsed_data.get("warnings"):
+            compact["w"] = ["incompleto"]
+    return compact
+
+
+class LocalAnthropicStandIn:
+    """Sostituto locale di anthropic.Anthropic: stessa forma di messages.create, nessuna rete."""
+
+    def __init__(
+        self,
+        responder: Optional[Callable[[str], Any]] = None,
+        latency_s: float = 0.0,
+    ) -> None:
+        self.responder = responder
+        self.latency_s = latency_s
+        self.calls = 0
+        self.messages = SimpleNamespace(create=self._create)
+
+    def _create(self, *, model: str, max_tokens: int, messages: list[dict[str, Any]], **kwargs: Any) -> Any:
+        self.calls += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        prompt = str(messages[-1].get("content", "")) if messages else ""
+        tools = kwargs.get("tools") or []
+        response = self.responder(prompt) if self.responder else None
+        if isinstance(response, dict):
+            # {"tool_input": {...}}: risposta registrata gia' nella forma dello strumento.
+            text = json.dumps(response["tool_input"], ensure_ascii=False, separators=(",", ":"))
+            content = [SimpleNamespace(type="tool_use", id=f"toolu_local_{self.calls}", name=tools[0]["name"], input=response["tool_input"])]
+        elif response is not None:
+            # Le risposte registrate sono testo libero: passano dal decoder testuale di bot.py.
+            text = response
+            content = [SimpleNamespace(type="text", text=text)]
+        else:
+            reading = compact_standin_response(build_standin_parsed_data(extract_message_from_prompt(prompt)))
+            text = json.dumps(reading, ensure_ascii=False, separators=(",", ":"))
+            if tools:
+                content = [SimpleNamespace(type="tool_use", id=f"toolu_local_{self.calls}", name=tools[0]["name"], input=reading)]
+            else:
+                content = [SimpleNamespace(type="text", text=text)]
+        return SimpleNamespace(
+            id=f"msg_local_{self.calls}",
+            model=model,
+            role="assistant",
+            stop_reason="tool_use" if content[0].type == "tool_use" else "end_turn",
+            content=content,
+            usage=SimpleNamespace(input_tokens=len(prompt) // 4, output_tokens=len(text) // 4),
+        )
+
+
+class _Request:
+    def __init__(self, handler: Callable[[], Any], latency_s: float) -> None:
+        self.handler = handler
+        self.latency_s = latency_s
+
+    def execute(self, http: Any = None) -> Any:
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        return self.handler()
+
+
+class LocalCalendarStandIn:
+    """Sostituto in memoria del servizio Google Calendar v3 (solo events insert/list/delete)."""
+
+    def __init__(self, latency_s: float = 0.0) -> None:
+        self.latency_s = latency_s
+        self.created: list[dict[str, Any]] = []
+        self._ids = count(1)
+        self._lock = threading.Lock()
+
+    def events(self) -> "LocalCalendarStandIn":
+        return self
+
+    def insert(self, calendarId: str, body: dict[str, Any]) -> _Request:
+        def handler() -> dict[str, Any]:
+            with self._lock:
+                event_id = f"local-{next(self._ids)}"
+                created = dict(body, id=event_id, htmlLink=f"https://calendar.local/{calendarId}/{event_id}")
+                self.created.append(created)
+            return created
+        return _Request(handler, self.latency_s)
+
+    def list(self, calendarId: str, timeMin: str, timeMax: str, **kwargs: Any) -> _Request:
+        def handler() -> dict[str, Any]:
+            with self._lock:
+                items = [
+                    item for item in self.created
+                    if timeMin[:10] <= str(item.get("start", {}).get("date") or item.get("start", {}).get("dateTime", ""))[:10] < timeMax[:10]
+                ]
+            return {"items": items}
+        return _Request(handler, self.latency_s)
+
+    def delete(self, calendarId: str, eventId: str) -> _Request:
+        def handler() -> dict[str, Any]:
+            with self._lock:
+                self.created = [item for item in self.created if item.get("id") != eventId]
+            return {}
+        return _Request(handler, self.latency_s)
+
+
+def install_local_backends(
+    llm: Optional[LocalAnthropicStandIn] = None,
+    calendar: Optional[LocalCalendarStandIn] = None,
+) -> tuple[LocalAnthropicStandIn, LocalCalendarStandIn]:
+    llm = llm or LocalAnthropicStandIn()
+    calendar = calendar or LocalCalendarStandIn()
+    bot.client = llm
+    bot.get_google_calendar_service = lambda: calendar
+    return llm, calendar
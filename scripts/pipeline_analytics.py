@@ -0,0 +1,460 @@
+import argparse
+import json
+import math
+import os
+import re
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Iterable, Optional
+
+import numpy as np
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+import log_segments  # noqa: E402
+
+
+# Da incrementare se cambia il modo in cui i record diventano colonne: invalida la cache .npz.
+CACHE_VERSION = 1
+TRACE_CHAT_RE = re.compile(r"^tg-(-?\d+)-\d+$")
+VOCABS = ("stages", "traces", "spans", "tipi")
+# Per ogni colonna con codici: il vocabolario (salvato accanto nel .npz) a cui si riferiscono.
+CODED_COLUMNS = {"stage": "stages", "trace": "traces", "span": "spans", "tipo": "tipi"}
+COLUMN_DTYPES = {
+    "ts": np.int64,
+    "stage": np.int16,
+    "trace": np.int32,
+    "chat": np.int64,
+    "span": np.int16,
+    "duration_ms": np.float32,
+    "tipo": np.int16,
+    "confidence": np.float32,
+    "confirmation": np.int8,
+    "fast_path": np.int8,
+}
+# Stage di una trace compattata che diventano di nuovo righe, per contarli come quelli originali.
+SUMMARY_STAGES = ("telegram_received", "pipeline_failed")
+DEFAULT_SPANS = ("llm_call", "handle_message")
+BUCKET_LABELS = {"day": "giorno", "week": "settimana", "month": "mese"}
+
+
+class ColumnBuilder:
+    """Accumula una riga per evento e la converte in array tipizzati con vocabolari per le stringhe."""
+
+    def __init__(self) -> None:
+        self.rows: dict[str, list[Any]] = {name: [] for name in COLUMN_DTYPES}
+        self.ts_text: list[str] = []
+        self.vocabs: dict[str, dict[str, int]] = {name: {} for name in VOCABS}
+
+    def code(self, vocab: str, value: Any) -> int:
+        if value is None or value == "":
+            return -1
+        words = self.vocabs[vocab]
+        return words.setdefault(str(value), len(words))
+
+    def add(
+        self,
+        ts: str,
+        stage: str,
+        trace_id: str,
+        chat_id: int,
+        *,
+        span: Optional[str] = None,
+        duration_ms: Any = None,
+        tipo: Optional[str] = None,
+        confidence: Any = None,
+        confirmation: Optional[bool] = None,
+        fast_path: Optional[bool] = None,
+    ) -> None:
+        self.ts_text.append(ts[:19])
+        self.rows["stage"].append(self.code("stages", stage))
+        self.rows["trace"].append(self.code("traces", trace_id))
+        self.rows["chat"].append(chat_id)
+        self.rows["span"].append(self.code("spans", span))
+        self.rows["duration_ms"].append(as_float(duration_ms))
+        self.rows["tipo"].append(self.code("tipi", tipo))
+        self.rows["confidence"].append(as_float(confidence))
+        self.rows["confirmation"].append(-1 if confirmation is None else int(bool(confirmation)))
+        self.rows["fast_path"].append(-1 if fast_path is None else int(bool(fast_path)))
+
+    def add_record(self, record: dict[str, Any]) -> None:
+        ts = str(record.get("ts") or "")
+        trace_id = str(record.get("trace_id") or "")
+        stage = str(record.get("stage") or "")
+        if len(ts) < 19 or not trace_id or not stage:
+            return
+        data = record.get("data") if isinstance(record.get("data"), dict) else {}
+        chat_id = record_chat_id(record)
+        if stage == "span_finished":
+            self.add(ts, stage, trace_id, chat_id, span=data.get("span"), duration_ms=data.get("duration_ms"))
+        elif stage == "parsed_data_normalized":
+            self.add(ts, stage, trace_id, chat_id, tipo=data.get("tipo"), confidence=data.get("confidence"))
+        elif stage == "confirmation_decision":
+            self.add(
+                ts, stage, trace_id, chat_id,
+                tipo=data.get("tipo"),
+                confirmation=data.get("confirmation_required"),
+                fast_path=data.get("fast_path"),
+            )
+        elif stage == "trace_summary":
+            self.add_summary(ts, trace_id, chat_id, data)
+        else:
+            self.add(ts, stage, trace_id, chat_id)
+
+    def add_summary(self, ts: str, trace_id: str, chat_id: int, summary: dict[str, Any]) -> None:
+        """Una trace compattata torna alle righe che servono alle dashboard."""
+        stages = summary.get("stages") or {}
+        for stage in SUMMARY_STAGES:
+            if stages.get(stage):
+                self.add(ts, stage, trace_id, chat_id)
+        if stages.get("parsed_data_normalized"):
+            self.add(ts, "parsed_data_normalized", trace_id, chat_id, tipo=summary.get("tipo"), confidence=summary.get("confidence"))
+        if stages.get("confirmation_decision"):
+            self.add(
+                ts, "confirmation_decision", trace_id, chat_id,
+                tipo=summary.get("tipo"),
+                confirmation=summary.get("confirmation_required"),
+                fast_path=summary.get("fast_path"),
+            )
+        # Dei tempi restano solo totale e conteggio per fase: ogni span vale la media.
+        for span, timing in (summary.get("durations_ms") or {}).items():
+            count = int(timing.get("count") or 0)
+            for _ in range(count):
+                self.add(ts, "span_finished", trace_id, chat_id, span=span, duration_ms=float(timing.get("total_ms") or 0) / count)
+
+    def build(self) -> dict[str, np.ndarray]:
+        columns = {name: np.asarray(values, dtype=COLUMN_DTYPES[name]) for name, values in self.rows.items() if name != "ts"}
+        columns["ts"] = parse_timestamps(self.ts_text)
+        valid = columns["ts"] != np.iinfo(np.int64).min
+        columns = {name: values[valid] for name, values in columns.items()}
+        for name, words in self.vocabs.items():
+            columns[name] = np.asarray(list(words), dtype=str)
+        return columns
+
+
+def as_float(value: Any) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return math.nan
+    return float(value)
+
+
+def record_chat_id(record: dict[str, Any]) -> int:
+    """chat_id del record, o quello codificato nel trace_id (tg-<chat_id>-<message_id>); 0 se ignoto."""
+    try:
+        return int(record.get("chat_id"))
+    except (TypeError, ValueError):
+        pass
+    match = TRACE_CHAT_RE.match(str(record.get("trace_id") or ""))
+    return int(match.group(1)) if match else 0
+
+
+def parse_timestamps(values: list[str]) -> np.ndarray:
+    """ts ISO UTC -> secondi epoch; NaT (int64 minimo) per i valori non validi."""
+    try:
+        return np.asarray(values, dtype="datetime64[s]").astype(np.int64)
+    except ValueError:
+        parsed = []
+        for value in values:
+            try:
+                parsed.append(np.datetime64(value, "s"))
+            except ValueError:
+                parsed.append(np.datetime64("NaT"))
+        return np.asarray(parsed, dtype="datetime64[s]").astype(np.int64)
+
+
+def iter_segment_records(segment: Path) -> Iterable[dict[str, Any]]:
+    with log_segments.open_segment(segment) as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                payload = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if isinstance(payload, dict):
+                yield payload
+
+
+def segment_columns(segment: Path) -> dict[str, np.ndarray]:
+    builder = ColumnBuilder()
+    for record in iter_segment_records(segment):
+        builder.add_record(record)
+    return builder.build()
+
+
+def cache_path(cache_dir: Path, segment: Path) -> Path:
+    return cache_dir / f"{segment.name}.npz"
+
+
+def load_segment(segment: Path, cache_dir: Optional[Path]) -> dict[str, np.ndarray]:
+    """Colonne di un segmento, dalla cache .npz se il file non e' cambiato da quando e' stata scritta."""
+    stat = segment.stat()
+    meta = np.asarray([CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+    if cache_dir is None:
+        return segment_columns(segment)
+    cached = cache_path(cache_dir, segment)
+    if cached.exists():
+        try:
+            with np.load(cached) as saved:
+                if np.array_equal(saved["meta"], meta):
+                    return {name: saved[name] for name in saved.files if name != "meta"}
+        except (OSError, ValueError, KeyError):
+            pass
+    columns = segment_columns(segment)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+    with tmp_path.open("wb") as fh:
+        np.savez_compressed(fh, meta=meta, **columns)
+    tmp_path.replace(cached)
+    return columns
+
+
+def prune_cache(cache_dir: Path, segments: list[Path]) -> None:
+    """Toglie la cache dei segmenti che non esistono piu' (compressi, compattati o cancellati)."""
+    if not cache_dir.exists():
+        return
+    keep = {cache_path(cache_dir, segment).name for segment in segments}
+    for cached in cache_dir.glob("*.npz"):
+        if cached.name not in keep:
+            cached.unlink(missing_ok=True)
+
+
+def merge_columns(parts: list[dict[str, np.ndarray]]) -> dict[str, np.ndarray]:
+    """Concatena i segmenti riportando i codici di ogni vocabolario locale su un vocabolario unico."""
+    merged: dict[str, np.ndarray] = {
+        name: np.concatenate([part[name] for part in parts]) if parts else np.empty(0, dtype=dtype)
+        for name, dtype in COLUMN_DTYPES.items()
+        if name not in CODED_COLUMNS
+    }
+    for column, vocab in CODED_COLUMNS.items():
+        words = np.concatenate([part[vocab] for part in parts]) if parts else np.empty(0, dtype=str)
+        merged[vocab], inverse = np.unique(words, return_inverse=True)
+        codes = []
+        offset = 0
+        for part in parts:
+            mapping = inverse[offset:offset + len(part[vocab])]
+            offset += len(part[vocab])
+            local = part[column]
+            if len(mapping):
+                codes.append(np.where(local >= 0, mapping[np.maximum(local, 0)], -1))
+            else:
+                codes.append(np.full(len(local), -1))
+        merged[column] = np.concatenate(codes).astype(COLUMN_DTYPES[column]) if codes else np.empty(0, dtype=COLUMN_DTYPES[column])
+    return merged
+
+
+def load_columns(log_path: Path, cache_dir: Optional[Path], since: Optional[str]) -> dict[str, np.ndarray]:
+    segments = log_segments.segment_files(log_path, since=since)
+    if cache_dir is not None and since is None:
+        prune_cache(cache_dir, segments)
+    return merge_columns([load_segment(segment, cache_dir) for segment in segments])
+
+
+def vocab_code(columns: dict[str, np.ndarray], vocab: str, value: str) -> int:
+    words = columns[vocab]
+    index = int(np.searchsorted(words, value))
+    return index if index < len(words) and words[index] == value else -2
+
+
+def filter_rows(columns: dict[str, np.ndarray], mask: np.ndarray) -> dict[str, np.ndarray]:
+    return {name: (values[mask] if name in COLUMN_DTYPES else values) for name, values in columns.items()}
+
+
+def bucket_starts(ts: np.ndarray, bucket: str) -> np.ndarray:
+    """Inizio (epoch s, UTC) del giorno, della settimana ISO o del mese di ogni riga."""
+    days = ts // 86400
+    if bucket == "day":
+        return days * 86400
+    if bucket == "week":
+        # Il 1970-01-01 era giovedi': +3 porta il lunedi' a resto 0.
+        return (days - (days + 3) % 7) * 86400
+    return ts.astype("datetime64[s]").astype("datetime64[M]").astype("datetime64[s]").astype(np.int64)
+
+
+def grouped_percentiles(groups: np.ndarray, values: np.ndarray, size: int, quantiles: Iterable[float]) -> tuple[np.ndarray, dict[float, np.ndarray]]:
+    """Percentili (interpolazione lineare, come np.percentile) per gruppo, senza ciclare sui gruppi."""
+    order = np.lexsort((values, groups))
+    sorted_values = values[order].astype(np.float64)
+    counts = np.bincount(groups, minlength=size)
+    starts = np.cumsum(counts) - counts
+    result = {}
+    for quantile in quantiles:
+        position = starts + quantile * np.maximum(counts - 1, 0)
+        low = np.floor(position).astype(np.int64)
+        high = np.ceil(position).astype(np.int64)
+        if len(sorted_values):
+            low_values = sorted_values[np.minimum(low, len(sorted_values) - 1)]
+            high_values = sorted_values[np.minimum(high, len(sorted_values) - 1)]
+            interpolated = low_values + (high_values - low_values) * (position - low)
+        else:
+            interpolated = np.zeros(size)
+        result[quantile] = np.where(counts > 0, interpolated, np.nan)
+    return counts, result
+
+
+def safe_ratio(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominator > 0, numerator / np.maximum(denominator, 1), np.nan)
+
+
+def build_dashboards(columns: dict[str, np.ndarray], bucket: str, spans: Iterable[str]) -> dict[str, Any]:
+    keys, groups = np.unique(bucket_starts(columns["ts"], bucket), return_inverse=True)
+    size = len(keys)
+    stage = columns["stage"]
+
+    def count(mask: np.ndarray) -> np.ndarray:
+        return np.bincount(groups[mask], minlength=size)
+
+    received = count(stage == vocab_code(columns, "stages", "telegram_received"))
+
+    decisions = (stage == vocab_code(columns, "stages", "confirmation_decision")) & (
+        columns["tipo"] == vocab_code(columns, "tipi", "rinvio")
+    )
+    decided = decisions & (columns["confirmation"] >= 0)
+    fast_known = decisions & (columns["fast_path"] >= 0)
+
+    normalized = (stage == vocab_code(columns, "stages", "parsed_data_normalized")) & np.isfinite(columns["confidence"])
+    confidence_sum = np.bincount(groups[normalized], weights=columns["confidence"][normalized], minlength=size)
+
+    # Una trace fallita conta una volta per periodo anche con piu' eventi pipeline_failed.
+    failed = stage == vocab_code(columns, "stages", "pipeline_failed")
+    failed_pairs = np.unique(groups[failed].astype(np.int64) * max(len(columns["traces"]), 1) + columns["trace"][failed])
+    failed_traces = np.bincount(failed_pairs // max(len(columns["traces"]), 1), minlength=size)
+
+    latency = {}
+    span_rows = (stage == vocab_code(columns, "stages", "span_finished")) & np.isfinite(columns["duration_ms"])
+    for span in spans:
+        mask = span_rows & (columns["span"] == vocab_code(columns, "spans", span))
+        counts, values = grouped_percentiles(groups[mask], columns["duration_ms"][mask], size, (0.5, 0.95))
+        latency[span] = {"count": counts, "p50_ms": values[0.5], "p95_ms": values[0.95]}
+
+    return {
+        "periods": [str(np.datetime64(int(key), "s").astype("datetime64[D]")) for key in keys],
+        "messages": received,
+        "rinvii": count(decided),
+        "confirmation_rate": safe_ratio(count(decided & (columns["confirmation"] == 1)), count(decided)),
+        "fast_path_coverage": safe_ratio(count(fast_known & (columns["fast_path"] == 1)), count(fast_known)),
+        "mean_confidence": safe_ratio(confidence_sum, count(normalized)),
+        "failed_traces": failed_traces,
+        "error_rate": safe_ratio(failed_traces, received),
+        "latency": latency,
+    }
+
+
+def format_rate(value: float) -> str:
+    return "-" if math.isnan(value) else f"{value * 100:5.1f}%"
+
+
+def format_ms(value: float) -> str:
+    return "-" if math.isnan(value) else f"{value:,.0f}"
+
+
+def format_bar(value: float, width: int = 20) -> str:
+    return "" if math.isnan(value) else "#" * int(round(value * width))
+
+
+def print_table(title: str, headers: list[str], rows: list[list[str]]) -> None:
+    widths = [max(len(header), *(len(row[index]) for row in rows)) for index, header in enumerate(headers)]
+    print(f"\n{title}")
+    print("  ".join(header.ljust(width) for header, width in zip(headers, widths)))
+    print("  ".join("-" * width for width in widths))
+    for row in rows:
+        print("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+
+def print_dashboards(dashboards: dict[str, Any], bucket: str) -> None:
+    periods = dashboards["periods"]
+    label = BUCKET_LABELS[bucket]
+    if not periods:
+        print("Nessun evento pipeline nel periodo richiesto.")
+        return
+    print_table(
+        "Conferme sui rinvii",
+        [label, "messaggi", "rinvii", "conferma", "fast-path", "confidence", ""],
+        [
+            [
+                period,
+                str(dashboards["messages"][index]),
+                str(dashboards["rinvii"][index]),
+                format_rate(dashboards["confirmation_rate"][index]),
+                format_rate(dashboards["fast_path_coverage"][index]),
+                "-" if math.isnan(dashboards["mean_confidence"][index]) else f"{dashboards['mean_confidence'][index]:.2f}",
+                format_bar(dashboards["confirmation_rate"][index]),
+            ]
+            for index, period in enumerate(periods)
+        ],
+    )
+    print_table(
+        "Errori",
+        [label, "messaggi", "trace fallite", "tasso", ""],
+        [
+            [
+                period,
+                str(dashboards["messages"][index]),
+                str(dashboards["failed_traces"][index]),
+                format_rate(dashboards["error_rate"][index]),
+                format_bar(dashboards["error_rate"][index]),
+            ]
+            for index, period in enumerate(periods)
+        ],
+    )
+    for span, latency in dashboards["latency"].items():
+        print_table(
+            f"Latenza {span} (ms)",
+            [label, "span", "p50", "p95"],
+            [
+                [period, str(latency["count"][index]), format_ms(latency["p50_ms"][index]), format_ms(latency["p95_ms"][index])]
+                for index, period in enumerate(periods)
+            ],
+        )
+
+
+def json_ready(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {key: json_ready(item) for key, item in value.items()}
+    if isinstance(value, np.ndarray):
+        return [None if isinstance(item, float) and math.isnan(item) else item for item in value.tolist()]
+    return value
+
+
+def parse_args() -> argparse.Namespace:
+    log_dir = Path(os.getenv("RINVIABOT_LOG_DIR", str(ROOT_DIR / "logs")))
+    parser = argparse.ArgumentParser(
+        description="Dashboard dai log pipeline: tasso di conferma, copertura fast-path, errori e latenze per periodo."
+    )
+    parser.add_argument("--pipeline-log", default=str(log_dir / "pipeline" / "jsonl" / "pipeline.jsonl"))
+    parser.add_argument("--bucket", choices=sorted(BUCKET_LABELS), default="week")
+    parser.add_argument("--days", type=int, default=0, help="Solo gli ultimi N giorni (0 = tutto lo storico).")
+    parser.add_argument("--chat-id", type=int, default=None)
+    parser.add_argument("--span", action="append", default=None, help=f"Span di cui calcolare p50/p95 (default: {', '.join(DEFAULT_SPANS)}).")
+    parser.add_argument("--cache-dir", default=str(log_dir / "pipeline" / "analytics"))
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--json", action="store_true")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    since = None
+    if args.days > 0:
+        since = (datetime.utcnow() - timedelta(days=args.days)).replace(microsecond=0).isoformat() + "Z"
+    columns = load_columns(Path(args.pipeline_log), None if args.no_cache else Path(args.cache_dir), since)
+    mask = np.ones(len(columns["ts"]), dtype=bool)
+    if since:
+        mask &= columns["ts"] >= np.datetime64(since[:19], "s").astype(np.int64)
+    if args.chat_id is not None:
+        mask &= columns["chat"] == args.chat_id
+    dashboards = build_dashboards(filter_rows(columns, mask), args.bucket, args.span or DEFAULT_SPANS)
+    if args.json:
+        print(json.dumps(json_ready(dashboards), ensure_ascii=False, indent=2))
+    else:
+        print_dashboards(dashboards, args.bucket)
+
+
+if __name__ == "__main__":
+    main()
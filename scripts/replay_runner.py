@@ -0,0 +1,286 @@
+import argparse
+import json
+import logging
+import shutil
+import sys
+import time
+from typing import Any, Callable
+
+from local_backends import (
+    LocalAnthropicStandIn,
+    LocalCalendarStandIn,
+    ROOT_DIR,
+    bot,
+    build_standin_parsed_data,
+    extract_message_from_prompt,
+    install_local_backends,
+)
+
+
+REPLAY_DIR = ROOT_DIR / "replays"
+INPUTS_DIR = REPLAY_DIR / "inputs"
+EXPECTED_DIR = REPLAY_DIR / "expected"
+OUTPUTS_DIR = REPLAY_DIR / "outputs"
+
+STAGES = ["analysis", "llm", "validation", "confirmation", "calendar_format", "calendar_insert", "total"]
+BOT_CASSETTE_MODE = bot.CASSETTE_MODE
+BOT_MODEL_TIERS = bot.ANTHROPIC_MODEL_TIERS
+
+
+class StageTimer:
+    """Misura le chiamate alle funzioni reali di bot.py, contando solo la chiamata piu' esterna."""
+
+    def __init__(self) -> None:
+        self.current: dict[str, float] = {}
+        self._depth: dict[str, int] = {}
+
+    def reset(self) -> None:
+        self.current = {}
+
+    def wrap(self, stage: str, func: Callable[..., Any]) -> Callable[..., Any]:
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            depth = self._depth.get(stage, 0)
+            self._depth[stage] = depth + 1
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._depth[stage] = depth
+                if depth == 0:
+                    elapsed_ms = (time.perf_counter() - started) * 1000
+                    self.current[stage] = self.current.get(stage, 0.0) + elapsed_ms
+        return wrapper
+
+
+def install_stage_timer(timer: StageTimer, llm: LocalAnthropicStandIn, calendar: LocalCalendarStandIn) -> None:
+    for stage, name in (
+        ("analysis", "build_message_analysis"),
+        ("validation", "validate_and_normalize_parsed_data"),
+        ("confirmation", "should_require_confirmation"),
+        ("calendar_format", "format_calendar_event"),
+    ):
+        setattr(bot, name, timer.wrap(stage, getattr(bot, name)))
+    llm.messages.create = timer.wrap("llm", llm.messages.create)
+    original_insert = calendar.insert
+
+    def timed_insert(*args: Any, **kwargs: Any) -> Any:
+        request = original_insert(*args, **kwargs)
+        request.execute = timer.wrap("calendar_insert", request.execute)
+        return request
+
+    calendar.insert = timed_insert
+
+
+def load_fixtures(selected: list[str]) -> list[dict[str, Any]]:
+    fixtures = []
+    for path in sorted(INPUTS_DIR.glob("*.json")):
+        case_id = path.stem
+        if selected and case_id not in selected:
+            continue
+        payload = json.loads(path.read_text(encoding="utf-8"))
+        payload.setdefault("id", case_id)
+        fixtures.append(payload)
+    return fixtures
+
+
+class FixtureResponder:
+    """Usa le risposte registrate nella fixture, se ci sono, altrimenti la lettura locale.
+
+    "llm_responses" ne registra una per chiamata (livello di modello o tentativo; l'ultima si ripete):
+    {"error": "..."} fa fallire la chiamata, {"tool_input": {...}} risponde con lo strumento.
+    """
+
+    def __init__(self, fixtures: list[dict[str, Any]]) -> None:
+        self.recorded = {
+            bot.normalize_message_text(item.get("message", "")): item.get("llm_responses") or [item["llm_response"]]
+            for item in fixtures
+            if item.get("llm_responses") or item.get("llm_response")
+        }
+        self.queues: dict[str, list[Any]] = {}
+
+    def rewind(self) -> None:
+        self.queues = {key: list(responses) for key, responses in self.recorded.items()}
+
+    def __call__(self, prompt: str) -> Any:
+        message_text = extract_message_from_prompt(prompt)
+        queue = self.queues.get(bot.normalize_message_text(message_text))
+        if not queue:
+            return json.dumps(build_standin_parsed_data(message_text), ensure_ascii=False)
+        response = queue.pop(0) if len(queue) > 1 else queue[0]
+        if isinstance(response, dict) and "error" in response:
+            raise RuntimeError(response["error"])
+        if isinstance(response, dict) and "tool_input" in response:
+            return response
+        return response if isinstance(response, str) else json.dumps(response, ensure_ascii=False)
+
+
+def prepare_case(fixture: dict[str, Any], responder: FixtureResponder) -> None:
+    """Stato del bot per una fixture: livelli di modello, cassette registrate e circuit breaker chiuso."""
+    responder.rewind()
+    bot.ANTHROPIC_MODEL_TIERS = ",".join(fixture.get("model_tiers") or []) or BOT_MODEL_TIERS
+    bot._CLAUDE_BREAKER.update(state="closed", failures=0, probe_at=None)
+    cassette = fixture.get("cassette") or []
+    bot.CASSETTE_MODE = "replay_zero" if cassette else BOT_CASSETTE_MODE
+    bot._CASSETTE_INDEX = None
+    if cassette:
+        # Le voci passano da record_cassette_entry e dal file gzip, come una cassette di produzione.
+        bot.CASSETTE_DIR = OUTPUTS_DIR / "cassettes" / fixture["id"]
+        shutil.rmtree(bot.CASSETTE_DIR, ignore_errors=True)
+        for entry in cassette:
+            bot.record_cassette_entry(entry["kind"], None, {}, latency_ms=0, response=entry["response"])
+
+
+def run_case(fixture: dict[str, Any], timer: StageTimer, responder: FixtureResponder) -> dict[str, Any]:
+    prepare_case(fixture, responder)
+    timer.reset()
+    started = time.perf_counter()
+    parsed_data = bot.parse_message_with_ai(fixture["message"])
+    calendar_events = []
+    if parsed_data and parsed_data.get("tipo") == "rinvio":
+        for evento in parsed_data.get("eventi", []):
+            event_data = bot.format_calendar_event(evento)
+            if not event_data:
+                calendar_events.append(None)
+                continue
+            created = bot.create_google_calendar_event(event_data)
+            calendar_events.append({
+                "title": event_data["title"],
+                "start": event_data["start_time"].isoformat(),
+                "location": event_data["location"],
+                "created": bool(created),
+            })
+    timer.current["total"] = (time.perf_counter() - started) * 1000
+
+    tipo = parsed_data.get("tipo") if parsed_data else None
+    return {
+        "id": fixture["id"],
+        "message": fixture["message"],
+        "tipo": tipo,
+        "confirmation_required": tipo == "conferma",
+        "parsed_data": parsed_data,
+        "calendar_events": calendar_events,
+        "timings_ms": {stage: round(value, 3) for stage, value in timer.current.items()},
+    }
+
+
+def diff_values(expected: Any, actual: Any, path: str = "") -> list[str]:
+    """Confronto parziale: contano solo le chiavi presenti nel file expected."""
+    if isinstance(expected, dict):
+        if not isinstance(actual, dict):
+            return [f"{path or '.'}: atteso oggetto, trovato {actual!r}"]
+        diffs = []
+        for key, value in expected.items():
+            diffs.extend(diff_values(value, actual.get(key), f"{path}.{key}"))
+        return diffs
+    if isinstance(expected, list):
+        if not isinstance(actual, list) or len(actual) != len(expected):
+            return [f"{path or '.'}: atteso {expected!r}, trovato {actual!r}"]
+        diffs = []
+        for index, (exp_item, act_item) in enumerate(zip(expected, actual)):
+            diffs.extend(diff_values(exp_item, act_item, f"{path}[{index}]"))
+        return diffs
+    if expected != actual:
+        return [f"{path or '.'}: atteso {expected!r}, trovato {actual!r}"]
+    return []
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def render_latency_table(results: list[dict[str, Any]]) -> str:
+    lines = [
+        f"{'stage':<16} {'n':>5} {'p50 ms':>10} {'p95 ms':>10} {'max ms':>10}",
+        "-" * 55,
+    ]
+    for stage in STAGES:
+        values = [item["timings_ms"][stage] for item in results if stage in item["timings_ms"]]
+        if not values:
+            continue
+        lines.append(
+            f"{stage:<16} {len(values):>5} {percentile(values, 50):>10.2f} "
+            f"{percentile(values, 95):>10.2f} {max(values):>10.2f}"
+        )
+    return "\n".join(lines)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Esegue le fixture di replays/inputs sulla pipeline reale e confronta con replays/expected."
+    )
+    parser.add_argument("--case", action="append", default=[], help="Esegue solo questa fixture. Ripetibile.")
+    parser.add_argument("--repeat", type=int, default=1, help="Ripete ogni fixture N volte per le statistiche di latenza.")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0, help="Latenza simulata del modello locale.")
+    parser.add_argument("--calendar-latency-ms", type=float, default=0.0, help="Latenza simulata del calendario locale.")
+    parser.add_argument(
+        "--write-expected",
+        action="store_true",
+        help="Scrive l'output corrente come expected per le fixture che non lo hanno ancora.",
+    )
+    parser.add_argument("--verbose", action="store_true", help="Mostra anche i log INFO del bot.")
+    return parser.parse_args()
+
+
+def main() -> None:
+    args = parse_args()
+    if not args.verbose:
+        logging.getLogger(bot.__name__).setLevel(logging.WARNING)
+    fixtures = load_fixtures(args.case)
+    if not fixtures:
+        print(f"Nessuna fixture trovata in {INPUTS_DIR}")
+        return
+
+    responder = FixtureResponder(fixtures)
+    llm = LocalAnthropicStandIn(responder, latency_s=args.llm_latency_ms / 1000)
+    calendar = LocalCalendarStandIn(latency_s=args.calendar_latency_ms / 1000)
+    install_local_backends(llm, calendar)
+    timer = StageTimer()
+    install_stage_timer(timer, llm, calendar)
+
+    OUTPUTS_DIR.mkdir(parents=True, exist_ok=True)
+    results: list[dict[str, Any]] = []
+    failures = 0
+    for fixture in fixtures:
+        for _ in range(max(1, args.repeat)):
+            results.append(run_case(fixture, timer, responder))
+        output = results[-1]
+        (OUTPUTS_DIR / f"{fixture['id']}.json").write_text(
+            json.dumps(bot.safe_json_value(output), ensure_ascii=False, indent=2),
+            encoding="utf-8",
+        )
+
+        expected_path = EXPECTED_DIR / f"{fixture['id']}.json"
+        if not expected_path.exists():
+            if args.write_expected:
+                expected = {key: output[key] for key in ("tipo", "confirmation_required", "parsed_data", "calendar_events")}
+                expected_path.write_text(
+                    json.dumps(bot.safe_json_value(expected), ensure_ascii=False, indent=2),
+                    encoding="utf-8",
+                )
+                print(f"[NEW ] {fixture['id']}")
+            else:
+                print(f"[SKIP] {fixture['id']}: manca {expected_path.relative_to(ROOT_DIR)}")
+            continue
+
+        diffs = diff_values(json.loads(expected_path.read_text(encoding="utf-8")), bot.safe_json_value(output))
+        if diffs:
+            failures += 1
+            print(f"[FAIL] {fixture['id']}")
+            for line in diffs:
+                print(f"       {line}")
+        else:
+            print(f"[ OK ] {fixture['id']}")
+
+    print("")
+    print(render_latency_table(results))
+    print("")
+    print(f"Fixture: {len(fixtures)} | fallite: {failures}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
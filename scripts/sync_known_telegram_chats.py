@@ -1,28 +1,32 @@
+import argparse
 import asyncio
 import json
 import os
-from datetime import datetime
-from pathlib import Path
+import time
 from typing import Any
 
-import pytz
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError
 
 from export_telegram_history import (
+    EXPORT_BATCH_SIZE,
     EXPORT_DIR,
     RAW_LOG_PATH,
-    ROME_TZ,
     SESSION_DIR,
-    append_jsonl,
+    append_export_batch,
+    build_message_item,
+    build_raw_log_record,
+    entity_chat_id,
     entity_title,
     entity_username,
     ensure_directories,
-    extract_text,
-    json_dumps,
-    render_markdown,
+    export_paths,
+    get_cached_sender,
+    load_checkpoint,
+    raw_message_log,
     resolve_entity,
     sanitize_component,
-    stable_trace_id,
+    save_checkpoint,
     utc_now_iso,
 )
 
@@ -31,123 +35,130 @@ KNOWN_CHATS = [
     "-5011341129",
     "-1003792884377",
 ]
-
-
-def load_logged_message_keys() -> set[tuple[str, str]]:
-    keys: set[tuple[str, str]] = set()
-    if not RAW_LOG_PATH.exists():
-        return keys
-
-    with RAW_LOG_PATH.open("r", encoding="utf-8") as fh:
-        for line in fh:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                payload = json.loads(line)
-            except json.JSONDecodeError:
-                continue
-            keys.add((str(payload.get("chat_id")), str(payload.get("message_id"))))
-    return keys
-
-
-async def export_chat(client: TelegramClient, chat_ref: str, logged_keys: set[tuple[str, str]]) -> dict[str, Any]:
+# Per chat: ultimo message_id esportato (min_id del giro successivo), offset dei file e nome base.
+SYNC_STATE_PATH = EXPORT_DIR / "sync_state.json"
+FLOOD_WAIT_RETRIES = 5
+
+
+async def wait_flood_pause(limiter: dict[str, Any]) -> None:
+    """Dopo un FloodWait nessuna chat, nemmeno quelle gia' a meta', manda richieste prima di resume_at."""
+    while True:
+        delay = limiter["resume_at"] - time.monotonic()
+        if delay <= 0:
+            return
+        await asyncio.sleep(delay)
+
+
+async def paced_messages(messages: Any, limiter: dict[str, Any]) -> Any:
+    # iter_messages scarica un blocco quando serve il messaggio successivo: la pausa va prima di ogni passo.
+    while True:
+        await wait_flood_pause(limiter)
+        try:
+            message = await messages.__anext__()
+        except StopAsyncIteration:
+            return
+        yield message
+
+
+async def export_chat(
+    client: TelegramClient,
+    chat_ref: str,
+    sync_state: dict[str, Any],
+    sender_cache: dict[Any, Any],
+    limiter: dict[str, Any],
+) -> dict[str, Any]:
+    await wait_flood_pause(limiter)
     entity = await resolve_entity(client, chat_ref)
     chat_title = entity_title(entity)
-    chat_id = str(getattr(entity, "id", chat_ref))
-    exported_at = utc_now_iso()
-
-    messages: list[dict[str, Any]] = []
-    new_records: list[dict[str, Any]] = []
-
-    async for message in client.iter_messages(entity, reverse=True):
-        if not getattr(message, "id", None):
-            continue
-
-        sender = await message.get_sender()
-        sender_name = entity_title(sender) if sender else ""
-        sender_username = entity_username(sender) if sender else ""
-        sender_id = getattr(sender, "id", None) if sender else None
-        text = extract_text(message)
-        date_utc = message.date
-        if date_utc.tzinfo is None:
-            date_utc = pytz.utc.localize(date_utc)
-        date_local = date_utc.astimezone(ROME_TZ)
-        ts = date_utc.replace(microsecond=0).isoformat().replace("+00:00", "Z")
-        trace_id = stable_trace_id(chat_id, message.id, ts, text)
-
-        item = {
-            "trace_id": trace_id,
-            "chat_id": chat_id,
-            "message_id": message.id,
-            "date_utc": ts,
-            "date_local": date_local.strftime("%d/%m/%Y %H:%M:%S %Z"),
-            "sender_id": sender_id,
-            "sender_name": sender_name,
-            "sender_username": sender_username,
-            "text": text,
-            "reply_to_msg_id": getattr(message, "reply_to_msg_id", None),
-            "views": getattr(message, "views", None),
-            "forwards": getattr(message, "forwards", None),
-        }
-        messages.append(item)
-
-        key = (chat_id, str(message.id))
-        if key not in logged_keys:
-            new_records.append({
-                "ts": ts,
-                "trace_id": trace_id,
-                "chat_id": chat_id,
-                "message_id": message.id,
-                "user_id": sender_id,
-                "username": sender_username or sender_name,
-                "text": text,
-                "source": "telegram_history_import",
-            })
-            logged_keys.add(key)
-
-    for record in new_records:
-        append_jsonl(RAW_LOG_PATH, record)
-
+    chat_id = entity_chat_id(entity, chat_ref)
+    # Checkpoint salvati con l'id non marcato: si riprendono sotto l'id marcato, con lo stesso nome base.
+    state = sync_state.setdefault(chat_id, sync_state.pop(str(getattr(entity, "id", chat_id)), {}))
+    if not state:
+        state.update({
+            "base_name": f"{sanitize_component(chat_id)}-{sanitize_component(chat_title)}",
+            "min_id": 0,
+            "message_count": 0,
+        })
+    paths = export_paths(state["base_name"])
     chat_meta = {
         "chat_id": chat_id,
         "title": chat_title,
         "username": entity_username(entity),
-        "exported_at": exported_at,
-        "message_count": len(messages),
+        "exported_at": utc_now_iso(),
         "source": "telegram-mtproto-userbot",
     }
 
-    base_name = (
-        f"{sanitize_component(chat_id)}-"
-        f"{sanitize_component(chat_title)}-"
-        f"{datetime.now(ROME_TZ).strftime('%Y%m%d-%H%M%S')}"
-    )
-    json_path = EXPORT_DIR / f"{base_name}.json"
-    jsonl_path = EXPORT_DIR / f"{base_name}.jsonl"
-    md_path = EXPORT_DIR / f"{base_name}.md"
-
-    json_path.write_text(
-        json.dumps({"chat": chat_meta, "messages": messages}, ensure_ascii=False, indent=2),
-        encoding="utf-8",
-    )
-    with jsonl_path.open("w", encoding="utf-8") as fh:
-        for item in messages:
-            fh.write(json_dumps(item) + "\n")
-    md_path.write_text(render_markdown(chat_meta, messages), encoding="utf-8")
+    fetched = 0
+    appended = 0
+    batch: list[dict[str, Any]] = []
+
+    def flush() -> None:
+        nonlocal appended
+        append_export_batch(paths, chat_meta, batch, state)
+        appended += raw_message_log.append_messages(RAW_LOG_PATH, [build_raw_log_record(item) for item in batch])
+        if batch:
+            state["min_id"] = batch[-1]["message_id"]
+        state["synced_at"] = chat_meta["exported_at"]
+        save_checkpoint(SYNC_STATE_PATH, sync_state)
+        batch.clear()
+
+    messages = client.iter_messages(entity, min_id=int(state.get("min_id") or 0), reverse=True)
+    async for message in paced_messages(messages, limiter):
+        if not getattr(message, "id", None):
+            continue
+        await wait_flood_pause(limiter)
+        sender = await get_cached_sender(message, sender_cache)
+        batch.append(build_message_item(message, chat_id, sender))
+        fetched += 1
+        if len(batch) >= EXPORT_BATCH_SIZE:
+            flush()
+    if batch or not paths["json"].exists():
+        flush()
 
     return {
         "chat_id": chat_id,
         "title": chat_title,
-        "total_messages": len(messages),
-        "new_messages_appended": len(new_records),
-        "json": str(json_path),
-        "jsonl": str(jsonl_path),
-        "markdown": str(md_path),
+        "total_messages": state["message_count"],
+        "fetched_messages": fetched,
+        "new_messages_appended": appended,
+        "json": str(paths["json"]),
+        "jsonl": str(paths["jsonl"]),
+        "markdown": str(paths["markdown"]),
     }
 
 
-async def main_async() -> None:
+async def sync_chat(
+    client: TelegramClient,
+    chat_ref: str,
+    sync_state: dict[str, Any],
+    sender_cache: dict[Any, Any],
+    limiter: dict[str, Any],
+) -> dict[str, Any]:
+    """Una chat alla volta per slot del semaforo; un FloodWait mette in pausa tutte le chat, anche a meta'."""
+    async with limiter["semaphore"]:
+        for _ in range(FLOOD_WAIT_RETRIES):
+            try:
+                return await export_chat(client, chat_ref, sync_state, sender_cache, limiter)
+            except FloodWaitError as exc:
+                limiter["resume_at"] = max(limiter["resume_at"], time.monotonic() + exc.seconds + 1)
+                print(f"FloodWait su {chat_ref}: pausa di {exc.seconds}s, poi si riparte dal checkpoint.")
+        raise RuntimeError(f"Troppi FloodWait consecutivi su {chat_ref}")
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Sync incrementale delle chat note: scarica solo i messaggi dopo l'ultimo checkpoint."
+    )
+    parser.add_argument("--concurrency", type=int, default=2, help="Chat sincronizzate in parallelo.")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Ignora i checkpoint e riscrive da zero gli export delle chat.",
+    )
+    return parser.parse_args()
+
+
+async def main_async(args: argparse.Namespace) -> None:
     ensure_directories()
 
     api_id = int(os.getenv("TELEGRAM_API_ID", "0") or "0")
@@ -159,17 +170,20 @@ async def main_async() -> None:
     client = TelegramClient(str(session_path), api_id, api_hash)
     await client.start()
     try:
-        logged_keys = load_logged_message_keys()
-        results = []
-        for chat_ref in KNOWN_CHATS:
-            results.append(await export_chat(client, chat_ref, logged_keys))
+        sync_state = {} if args.full else load_checkpoint(SYNC_STATE_PATH)
+        sender_cache: dict[Any, Any] = {}
+        limiter = {"semaphore": asyncio.Semaphore(max(1, args.concurrency)), "resume_at": 0.0}
+        results = await asyncio.gather(*(
+            sync_chat(client, chat_ref, sync_state, sender_cache, limiter)
+            for chat_ref in KNOWN_CHATS
+        ))
         print(json.dumps({"synced_at": utc_now_iso(), "results": results}, ensure_ascii=False, indent=2))
     finally:
         await client.disconnect()
 
 
 def main() -> None:
-    asyncio.run(main_async())
+    asyncio.run(main_async(parse_args()))
 
 
 if __name__ == "__main__":
@@ -1,22 +1,31 @@
 import argparse
 import asyncio
-import json
 import os
 import re
+import sys
+import time
+from collections import OrderedDict
 from datetime import datetime
 from hashlib import sha256
 from pathlib import Path
-from typing import Any
+from typing import Any, Awaitable, Callable
 
 import pytz
 from telethon import TelegramClient, events
 from telethon.tl.types import Channel, Chat, User
 
 
-ROME_TZ = pytz.timezone("Europe/Rome")
 ROOT_DIR = Path(__file__).resolve().parent.parent
+if str(ROOT_DIR) not in sys.path:
+    sys.path.insert(0, str(ROOT_DIR))
+
+import raw_message_log  # noqa: E402
+
+
+ROME_TZ = pytz.timezone("Europe/Rome")
 LOG_DIR = ROOT_DIR / "logs"
 RAW_LOG_PATH = LOG_DIR / "telegram" / "raw" / "messages.jsonl"
+ENTITY_CACHE_TTL_S = 3600.0
 SESSION_DIR = ROOT_DIR / ".telegram-userbot"
 
 
@@ -32,11 +41,6 @@ def ensure_directories() -> None:
         path.mkdir(parents=True, exist_ok=True)
 
 
-def append_jsonl(path: Path, payload: dict[str, Any]) -> None:
-    with path.open("a", encoding="utf-8") as fh:
-        fh.write(json.dumps(payload, ensure_ascii=False) + "\n")
-
-
 def stable_trace_id(chat_id: Any, message_id: Any, message_date: str, text: str) -> str:
     payload = f"{chat_id}:{message_id}:{message_date}:{text}"
     digest = sha256(payload.encode("utf-8")).hexdigest()[:16]
@@ -77,24 +81,24 @@ def parse_chat_filters(values: list[str]) -> tuple[set[int], set[str]]:
     return ids, names
 
 
-def already_logged(chat_id: Any, message_id: Any) -> bool:
-    if not RAW_LOG_PATH.exists():
-        return False
-
-    chat_id_str = str(chat_id)
-    message_id_str = str(message_id)
-    with RAW_LOG_PATH.open("r", encoding="utf-8") as fh:
-        for line in fh:
-            line = line.strip()
-            if not line:
-                continue
-            try:
-                payload = json.loads(line)
-            except json.JSONDecodeError:
-                continue
-            if str(payload.get("chat_id")) == chat_id_str and str(payload.get("message_id")) == message_id_str:
-                return True
-    return False
+async def cached_entity(
+    cache: "OrderedDict[int, tuple[float, Any]]",
+    key: Any,
+    fetch: Callable[[], Awaitable[Any]],
+    max_size: int,
+) -> Any:
+    """LRU con scadenza per chat e mittenti: get_chat/get_sender solo alla prima occorrenza."""
+    entry = cache.get(key) if key is not None else None
+    if entry and time.monotonic() - entry[0] < ENTITY_CACHE_TTL_S:
+        cache.move_to_end(key)
+        return entry[1]
+    entity = await fetch()
+    if key is not None and entity is not None:
+        cache[key] = (time.monotonic(), entity)
+        cache.move_to_end(key)
+        while len(cache) > max_size:
+            cache.popitem(last=False)
+    return entity
 
 
 def parse_args() -> argparse.Namespace:
@@ -114,6 +118,12 @@ def parse_args() -> argparse.Namespace:
         default=[],
         help="Chat da monitorare. Ripetibile: ID numerico, nome o username.",
     )
+    parser.add_argument(
+        "--entity-cache-size",
+        type=int,
+        default=512,
+        help="Chat e mittenti tenuti in memoria per evitare get_chat/get_sender a ogni messaggio.",
+    )
     return parser.parse_args()
 
 
@@ -128,10 +138,12 @@ async def main_async(args: argparse.Namespace) -> None:
     await client.start()
 
     filter_ids, filter_names = parse_chat_filters(args.chat)
+    chat_cache: "OrderedDict[int, tuple[float, Any]]" = OrderedDict()
+    sender_cache: "OrderedDict[int, tuple[float, Any]]" = OrderedDict()
 
     me = await client.get_me()
     print(f"Sessione attiva come: {entity_title(me)}")
-    print(f"Log raw: {RAW_LOG_PATH}")
+    print(f"Log raw: {RAW_LOG_PATH} ({len(raw_message_log.logged_keys(RAW_LOG_PATH))} messaggi gia' registrati)")
     if filter_ids or filter_names:
         print(f"Filtri chat attivi: ids={sorted(filter_ids)} names={sorted(filter_names)}")
     else:
@@ -139,21 +151,22 @@ async def main_async(args: argparse.Namespace) -> None:
 
     @client.on(events.NewMessage)
     async def on_new_message(event: events.NewMessage.Event) -> None:
-        chat = await event.get_chat()
-        sender = await event.get_sender()
         message = event.message
-
         chat_id = int(getattr(event, "chat_id", 0) or 0)
-        chat_name = entity_title(chat) if chat else ""
 
         if filter_ids and chat_id not in filter_ids:
             return
-        if filter_names and chat_name.casefold() not in filter_names and entity_username(chat).casefold() not in filter_names:
+        # flock e append su messages.jsonl possono attendere altri processi: fuori dall'event loop di Telethon.
+        if await asyncio.to_thread(raw_message_log.is_logged, RAW_LOG_PATH, chat_id, message.id):
             return
 
-        if already_logged(chat_id, message.id):
+        chat = await cached_entity(chat_cache, chat_id or None, event.get_chat, args.entity_cache_size)
+        chat_name = entity_title(chat) if chat else ""
+        if filter_names and chat_name.casefold() not in filter_names and entity_username(chat).casefold() not in filter_names:
             return
 
+        sender = await cached_entity(sender_cache, getattr(event, "sender_id", None), event.get_sender, args.entity_cache_size)
+
         date_utc = message.date
         if date_utc.tzinfo is None:
             date_utc = pytz.utc.localize(date_utc)
@@ -174,13 +187,17 @@ async def main_async(args: argparse.Namespace) -> None:
             "reply_to_msg_id": getattr(message, "reply_to_msg_id", None),
             "logged_at": utc_now_iso(),
         }
-        append_jsonl(RAW_LOG_PATH, payload)
+        if not await asyncio.to_thread(raw_message_log.append_messages, RAW_LOG_PATH, [payload]):
+            return
         print(
             f"[{datetime.now(ROME_TZ).strftime('%Y-%m-%d %H:%M:%S')}] "
             f"chat={chat_id} msg={message.id} sender={payload['sender_name'] or payload['username']}"
         )
 
-    await client.run_until_disconnected()
+    try:
+        await client.run_until_disconnected()
+    finally:
+        raw_message_log.save_index(RAW_LOG_PATH, force=True)
 
 
 def main() -> None: